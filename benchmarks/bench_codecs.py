@@ -0,0 +1,80 @@
+"""
+CPU spent encoding JetStream API requests and decoding responses.
+
+Compares the pydantic json()/dict() + stdlib json path with the codec
+layer for every installed codec. Does not need a server.
+
+    python benchmarks/bench_codecs.py
+"""
+from guillotina_nats.codecs import config_payload
+from guillotina_nats.codecs import get_codec
+from guillotina_nats.codecs import msgspec
+from guillotina_nats.codecs import orjson
+from guillotina_nats.models import ConsumerConfig
+from guillotina_nats.models import StreamConfig
+
+import json
+import timeit
+
+NUMBER = 20000
+
+stream = StreamConfig(name="ORDERS", subjects=["ORDERS.*"])
+consumer = ConsumerConfig(
+    durable_name="DISPATCH", filter_subject="ORDERS.processed", ack_wait=int(3e10)
+)
+consumer_info = json.dumps(
+    {
+        "type": "io.nats.jetstream.api.v1.consumer_info_response",
+        "stream_name": "ORDERS",
+        "name": "DISPATCH",
+        "created": "2021-05-21T10:00:00.000000000Z",
+        "config": {**config_payload(consumer), "max_waiting": 512},
+        "delivered": {"consumer_seq": 1200, "stream_seq": 3400},
+        "ack_floor": {"consumer_seq": 1100, "stream_seq": 3300},
+        "num_ack_pending": 100,
+        "num_redelivered": 3,
+        "num_waiting": 1,
+        "num_pending": 25000,
+        "cluster": {"leader": "nats-0"},
+    }
+).encode()
+
+
+def per_call(func):
+    return timeit.timeit(func, number=NUMBER) / NUMBER * 1e6
+
+
+def main():
+    print(f"{'':>10} {'stream create':>14} {'consumer create':>16} {'info parse':>11}")
+    baseline = (
+        per_call(lambda: stream.json().encode()),
+        per_call(
+            lambda: json.dumps(
+                {"stream_name": "ORDERS", "config": consumer.dict()}
+            ).encode()
+        ),
+        per_call(lambda: json.loads(consumer_info)),
+    )
+    print(
+        f"{'before':>10} {baseline[0]:12.2f}us {baseline[1]:14.2f}us {baseline[2]:9.2f}us"
+    )
+    for name, module in (("json", json), ("orjson", orjson), ("msgspec", msgspec)):
+        if module is None:
+            continue
+        codec = get_codec(name)
+        timings = (
+            per_call(lambda: codec.dumps(config_payload(stream))),
+            per_call(
+                lambda: codec.dumps(
+                    {"stream_name": "ORDERS", "config": config_payload(consumer)}
+                )
+            ),
+            per_call(lambda: codec.loads(consumer_info)),
+        )
+        print(
+            f"{name:>10} {timings[0]:12.2f}us {timings[1]:14.2f}us {timings[2]:9.2f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
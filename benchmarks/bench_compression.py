@@ -0,0 +1,58 @@
+"""
+Compression ratio and CPU cost per algorithm and payload size, to pick
+compression and compression_threshold. Payloads are JSON object states
+similar to the ones Guillotina indexes. Does not need a server.
+
+    python benchmarks/bench_compression.py
+"""
+from guillotina_nats.compression import Compressor
+
+import json
+import timeit
+import uuid
+
+
+def object_state(fields: int):
+    return json.dumps(
+        {
+            "uuid": uuid.uuid4().hex,
+            "type_name": "Document",
+            "title": "Guillotina document",
+            "creators": ["root"],
+            "tags": [f"tag-{idx}" for idx in range(10)],
+            **{
+                f"field_{idx}": f"Lorem ipsum dolor sit amet {idx} " * 4
+                for idx in range(fields)
+            },
+        }
+    ).encode()
+
+
+def main():
+    print(
+        f"{'algorithm':>9} {'size':>8} {'ratio':>6} {'compress':>10} {'decompress':>11}"
+    )
+    for algorithm in ("zlib", "lz4", "zstd"):
+        try:
+            compressor = Compressor(algorithm, threshold=0)
+        except ValueError:
+            print(f"{algorithm:>9} not installed")
+            continue
+        for fields in (2, 20, 200, 2000):
+            payload = object_state(fields)
+            compressed = compressor.compress(payload)
+            number = max(10, 200000 // len(payload))
+            compress = timeit.timeit(
+                lambda: compressor.compress(payload), number=number
+            )
+            decompress = timeit.timeit(
+                lambda: compressor.decompress(compressed), number=number
+            )
+            print(
+                f"{algorithm:>9} {len(payload):>8} {len(compressed) / len(payload):6.2f}"
+                f" {compress / number * 1e6:8.1f}us {decompress / number * 1e6:9.1f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
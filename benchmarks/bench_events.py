@@ -0,0 +1,75 @@
+"""
+Time spent by requests publishing EVENTS content events to JetStream for
+each of TRANSACTIONS transactions, inline waiting for every ack as done by
+hand before and with the event bridge after commit.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_events.py
+"""
+from guillotina_nats.events import EventBridge
+from guillotina_nats.models import Storage
+from guillotina_nats.models import StreamConfig
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+TRANSACTIONS = int(os.environ.get("TRANSACTIONS", 1000))
+EVENTS = int(os.environ.get("EVENTS", 3))
+
+
+class Transaction(object):
+    def __init__(self):
+        self._nats_events = [
+            ("BENCH.guillotina.Item.added", {"action": "added", "uid": str(idx)})
+            for idx in range(EVENTS)
+        ]
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 5}
+    )
+    await nats.initialize()
+    await nats.js_stream_create(
+        StreamConfig(name="BENCH", subjects=["BENCH.>"], storage=Storage.memory)
+    )
+    try:
+        request = 0.0
+        start = time.perf_counter()
+        for idx in range(TRANSACTIONS):
+            txn = Transaction()
+            begin = time.perf_counter()
+            for subject, data in txn._nats_events:
+                await nats.js_publish(subject, data, serializer="json")
+            request += time.perf_counter() - begin
+        total = time.perf_counter() - start
+        print(
+            f"  inline: {request / TRANSACTIONS * 1e6:7.1f} us per request, "
+            f"{TRANSACTIONS * EVENTS / total:7.0f} events/s"
+        )
+
+        bridge = EventBridge(nats, jetstream=True)
+        request = 0.0
+        start = time.perf_counter()
+        for idx in range(TRANSACTIONS):
+            txn = Transaction()
+            begin = time.perf_counter()
+            bridge._committed(True, txn)
+            request += time.perf_counter() - begin
+            # Requests yield to the loop while serving
+            await asyncio.sleep(0)
+        await bridge.close()
+        total = time.perf_counter() - start
+        print(
+            f"  bridge: {request / TRANSACTIONS * 1e6:7.1f} us per request, "
+            f"{TRANSACTIONS * EVENTS / total:7.0f} events/s, "
+            f"{bridge.batches} batches"
+        )
+    finally:
+        await nats.js_stream_delete("BENCH")
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,79 @@
+"""
+Tight fetch + ack loop over a JetStream pull consumer.
+
+Compares the previous subscribe/unsubscribe per fetch implementation of
+``js_get_next`` with the shared response inbox.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_js_fetch.py
+"""
+from guillotina_nats.models import ConsumerConfig
+from guillotina_nats.models import StreamConfig
+from guillotina_nats.utility import NatsUtility
+from nats.aio.client import INBOX_PREFIX
+from nats.aio.errors import ErrTimeout
+
+import asyncio
+import json
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 5000))
+
+
+async def legacy_get_next(nats, stream, consumer, timeout=5000000000, batch=1):
+    next_inbox = INBOX_PREFIX[:]
+    next_inbox.extend(nats.nc._nuid.next())
+    inbox = next_inbox.decode()
+
+    future = asyncio.Future()
+
+    async def cb(msg):
+        future.set_result(msg)
+
+    sid = await nats.nc.subscribe(inbox, cb=cb)
+    try:
+        await nats.nc.publish_request(
+            f"$JS.API.CONSUMER.MSG.NEXT.{stream}.{consumer}",
+            inbox,
+            json.dumps({"expires": timeout, "batch": batch}).encode(),
+        )
+        return await asyncio.wait_for(future, timeout / 1e9)
+    except asyncio.TimeoutError:
+        raise ErrTimeout
+    finally:
+        await nats.nc.unsubscribe(sid)
+
+
+async def run(nats, name, get_next):
+    await nats.js_stream_delete("BENCH")
+    await nats.js_stream_create(StreamConfig(name="BENCH", subjects=["BENCH.*"]))
+    await nats.js_consumer_durable_create(
+        "BENCH", ConsumerConfig(durable_name="WORKER", ack_wait=int(3e10))
+    )
+    for idx in range(MESSAGES):
+        await nats.publish("BENCH.data", b"x" * 128)
+    await nats.nc.flush()
+
+    start = time.perf_counter()
+    for idx in range(MESSAGES):
+        msg = await get_next(nats, "BENCH", "WORKER")
+        await nats.nc.publish(msg.reply, b"")
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {MESSAGES / elapsed:10.0f} msg/s")
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 2}
+    )
+    await nats.initialize()
+    try:
+        await run(nats, "before", legacy_get_next)
+        await run(nats, "after", NatsUtility.js_get_next)
+        await nats.js_stream_delete("BENCH")
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,65 @@
+"""
+Durable publishing into a JetStream stream.
+
+Compares waiting for every PubAck with pipelined publishes bounded by
+the js_publish_max_inflight window, with core NATS publish as reference.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_js_publish.py
+"""
+from guillotina_nats.models import StreamConfig
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 20000))
+
+
+async def core(nats):
+    for idx in range(MESSAGES):
+        await nats.publish("BENCH.data", b"x" * 128)
+    await nats.nc.flush()
+
+
+async def serial(nats):
+    for idx in range(MESSAGES):
+        await nats.js_publish("BENCH.data", b"x" * 128)
+
+
+async def pipelined(nats):
+    for idx in range(MESSAGES):
+        await nats.js_publish_async("BENCH.data", b"x" * 128)
+    await nats.js_publish_complete()
+
+
+async def main():
+    nats = NatsUtility(
+        {
+            "hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")],
+            "timeout": 5,
+            "js_publish_max_inflight": int(os.environ.get("INFLIGHT", 256)),
+        }
+    )
+    await nats.initialize()
+    try:
+        for name, publish in (
+            ("core", core),
+            ("serial", serial),
+            ("pipelined", pipelined),
+        ):
+            await nats.js_stream_delete("BENCH")
+            await nats.js_stream_create(
+                StreamConfig(name="BENCH", subjects=["BENCH.*"])
+            )
+            start = time.perf_counter()
+            await publish(nats)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>10}: {MESSAGES / elapsed:10.0f} msg/s")
+        await nats.js_stream_delete("BENCH")
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
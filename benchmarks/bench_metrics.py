@@ -0,0 +1,51 @@
+"""
+Overhead of the metrics hook on core publish and request.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_metrics.py
+"""
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 100000))
+
+
+async def run(settings):
+    nats = NatsUtility(
+        {
+            "hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")],
+            "timeout": 5,
+            **settings,
+        }
+    )
+    await nats.initialize()
+    try:
+        start = time.perf_counter()
+        for idx in range(MESSAGES):
+            await nats.publish("bench.metrics", b"x" * 128)
+        await nats.nc.flush()
+        publish = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for idx in range(MESSAGES // 20):
+            await nats.request("$JS.API.INFO", b"")
+        request = time.perf_counter() - start
+    finally:
+        await nats.finalize(None)
+    return MESSAGES / publish, MESSAGES // 20 / request
+
+
+async def main():
+    for name, settings in (
+        ("disabled", {}),
+        ("metrics", {"metrics": True}),
+        ("prometheus", {"metrics": True, "metrics_prometheus": True}),
+    ):
+        publish, request = await run(settings)
+        print(f"{name:>10}: publish {publish:9.0f} msg/s request {request:7.0f} req/s")
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
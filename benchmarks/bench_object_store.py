@@ -0,0 +1,56 @@
+"""
+Chunked object transfer through a JetStream object store.
+
+Puts and reads back a SIZE bytes blob (default 64MB) and reports the
+throughput and the peak memory allocated while reading, which stays
+around read_ahead chunks instead of the object size.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_object_store.py
+"""
+from guillotina_nats.models import Storage
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+import tracemalloc
+
+SIZE = int(os.environ.get("SIZE", 64 * 1024 * 1024))
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 5,}
+    )
+    await nats.initialize()
+    try:
+        blob = os.urandom(SIZE)
+        for chunk_size in (65536, 131072, 524288):
+            await nats.js_stream_delete("OBJ_bench")
+            store = await nats.object_store(
+                "bench", chunk_size=chunk_size, storage=Storage.memory
+            )
+            start = time.perf_counter()
+            await store.put("blob", blob)
+            put = time.perf_counter() - start
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            size = 0
+            async for chunk in store.get("blob"):
+                size += len(chunk)
+            get = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert size == SIZE
+            print(
+                f"chunk {chunk_size:>7}: put {SIZE / put / 1e6:7.1f} MB/s"
+                f" get {SIZE / get / 1e6:7.1f} MB/s peak {peak / 1e6:6.1f} MB"
+            )
+        await nats.js_stream_delete("OBJ_bench")
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,45 @@
+"""
+Many small core NATS publishes, as done by a request modifying objects.
+
+Measures what the publish buffer costs over direct publishing while
+connected, it is there to bound publishes while reconnecting.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_publish_buffer.py
+"""
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 200000))
+
+
+async def run(name, settings):
+    nats = NatsUtility(
+        {
+            "hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")],
+            "timeout": 2,
+            **settings,
+        }
+    )
+    await nats.initialize()
+    try:
+        start = time.perf_counter()
+        for idx in range(MESSAGES):
+            await nats.publish("BENCH.data", b"x" * 128)
+        await nats.publish_flush()
+        await nats.nc.flush()
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10}: {MESSAGES / elapsed:10.0f} msg/s")
+    finally:
+        await nats.finalize(None)
+
+
+async def main():
+    await run("direct", {})
+    await run("buffered", {"publish_buffer": True})
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,72 @@
+"""
+Cache invalidations of TRANSACTIONS transactions sent to another process
+one message each, as the Redis pubsub does, and batched.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_pubsub.py
+"""
+from guillotina_nats.pubsub import NatsPubSubUtility
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+TRANSACTIONS = int(os.environ.get("TRANSACTIONS", 5000))
+KEYS = int(os.environ.get("KEYS", 4))
+
+
+def pubsub(nats, **settings):
+    utility = NatsPubSubUtility(settings)
+    # Normally found in the component registry
+    utility._utility = nats
+    utility._initialized = True
+    return utility
+
+
+async def run(nats, name, **settings):
+    sender = pubsub(nats, **settings)
+    receiver = pubsub(nats, **settings)
+    done = asyncio.Event()
+    calls = 0
+    keys = 0
+
+    async def invalidate(data=None, sender=None):
+        nonlocal calls, keys
+        calls += 1
+        keys += len(data["keys"])
+        if data["tid"] == TRANSACTIONS - 1:
+            done.set()
+
+    await receiver.subscribe("bench", "cache", invalidate)
+    await nats.nc.flush()
+    start = time.perf_counter()
+    for tid in range(TRANSACTIONS):
+        # Hot objects are invalidated by many transactions
+        await sender.publish(
+            "bench",
+            tid,
+            {"tid": tid, "keys": [f"key-{tid % 50 + k}" for k in range(KEYS)]},
+        )
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:>9}: {TRANSACTIONS / elapsed:7.0f} txn/s, "
+        f"{sender.batches_sent} messages, {calls} callbacks, {keys} keys applied"
+    )
+    await receiver.unsubscribe("bench", "cache")
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 5}
+    )
+    await nats.initialize()
+    try:
+        await run(nats, "unbatched", max_batch=1)
+        await run(nats, "batched")
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,63 @@
+"""
+Scatter-gather to RESPONDERS subscribers collecting every reply, with a
+subscription per call as done by hand before and with request_many on the
+shared inbox.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_request_many.py
+"""
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+CALLS = int(os.environ.get("CALLS", 2000))
+RESPONDERS = int(os.environ.get("RESPONDERS", 3))
+
+
+async def per_call_inbox(nats):
+    replies = asyncio.Queue()
+
+    async def callback(msg):
+        replies.put_nowait(msg)
+
+    inbox = nats.new_inbox()
+    sid = await nats.nc.subscribe(inbox, cb=callback)
+    await nats.nc.publish_request("bench.many", inbox, b"")
+    for idx in range(RESPONDERS):
+        await asyncio.wait_for(replies.get(), 1)
+    await nats.nc.unsubscribe(sid)
+
+
+async def shared_inbox(nats):
+    async for msg in nats.request_many(
+        "bench.many", b"", max_replies=RESPONDERS, timeout=1
+    ):
+        pass
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 5}
+    )
+    await nats.initialize()
+    try:
+
+        async def respond(msg):
+            await nats.publish(msg.reply, b"here")
+
+        for idx in range(RESPONDERS):
+            await nats.subscribe(respond, "bench.many")
+        await nats.nc.flush()
+        for name, call in (("per call", per_call_inbox), ("shared", shared_inbox)):
+            start = time.perf_counter()
+            for idx in range(CALLS):
+                await call(nats)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>9}: {CALLS / elapsed:7.0f} calls/s")
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,67 @@
+"""
+RPC latency percentiles against a queue group of SERVICES members where
+SLOW_RATIO of the requests hit a SLOW_MS pause (a GC, a slow query), with
+and without hedged requests.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_rpc.py
+"""
+from guillotina_nats.rpc import RPCClient
+from guillotina_nats.rpc import Service
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import random
+import time
+
+CALLS = int(os.environ.get("CALLS", 2000))
+SERVICES = int(os.environ.get("SERVICES", 3))
+SLOW_RATIO = float(os.environ.get("SLOW_RATIO", 0.05))
+SLOW_MS = float(os.environ.get("SLOW_MS", 50))
+
+
+async def measure(client):
+    latencies = []
+    for idx in range(CALLS):
+        start = time.perf_counter()
+        await client.call("get", idx)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return [latencies[int(CALLS * q) - 1] * 1000 for q in (0.5, 0.9, 0.99, 1)]
+
+
+async def main():
+    url = os.environ.get("NATS_URL", "nats://localhost:4222")
+    members = []
+    for idx in range(SERVICES):
+        nats = NatsUtility({"hosts": [url], "timeout": 5})
+        await nats.initialize()
+        service = Service("bench")
+
+        @service.endpoint("get")
+        async def get(request):
+            if random.random() < SLOW_RATIO:
+                await asyncio.sleep(SLOW_MS / 1000)
+            return request
+
+        await service.start(nats)
+        await nats.nc.flush()
+        members.append(nats)
+
+    nats = NatsUtility({"hosts": [url], "timeout": 5})
+    await nats.initialize()
+    try:
+        for name, hedge_after in (("no hedging", None), ("hedge 5ms", 0.005)):
+            client = RPCClient(nats, "bench", hedge_after=hedge_after)
+            p50, p90, p99, top = await measure(client)
+            print(
+                f"{name:>10}: p50 {p50:6.2f}ms p90 {p90:6.2f}ms"
+                f" p99 {p99:6.2f}ms max {top:6.2f}ms"
+            )
+    finally:
+        for utility in members + [nats]:
+            await utility.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
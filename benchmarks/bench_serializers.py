@@ -0,0 +1,71 @@
+"""
+CPU spent on typed payloads and stored message decoding.
+
+Compares hand written pydantic json()/parse_raw() in handlers with the
+serializer registry, and base64 decoding of a 1MB stored message. Does not
+need a server.
+
+    python benchmarks/bench_serializers.py
+"""
+from datetime import datetime
+from guillotina_nats.codecs import get_codec
+from guillotina_nats.serializers import SerializerRegistry
+from pydantic import BaseModel
+from typing import List
+
+import base64
+import binascii
+import os
+import timeit
+
+
+class Order(BaseModel):
+    id: int
+    customer: str
+    items: List[str]
+    total: float
+    created: datetime
+
+
+def per_call(func, number):
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def main():
+    order = Order(
+        id=1,
+        customer="guillotina",
+        items=[f"item-{idx}" for idx in range(20)],
+        total=120.5,
+        created=datetime(2021, 5, 21),
+    )
+    data = order.json().encode()
+    print("typed payload")
+    print(
+        f"{'pydantic json()':>20} {per_call(lambda: order.json().encode(), 20000):8.2f}us"
+    )
+    print(
+        f"{'pydantic parse_raw()':>20} {per_call(lambda: Order.parse_raw(data), 20000):8.2f}us"
+    )
+    for name in ("json", "auto"):
+        codec = get_codec(name)
+        serializer = SerializerRegistry(codec).get(Order)
+        print(
+            f"{codec.name + ' dumps':>20} {per_call(lambda: serializer.dumps(order), 20000):8.2f}us"
+        )
+        print(
+            f"{codec.name + ' loads':>20} {per_call(lambda: serializer.loads(data), 20000):8.2f}us"
+        )
+
+    encoded = base64.b64encode(os.urandom(1024 * 1024)).decode()
+    print("1MB stored message")
+    print(
+        f"{'b64decode':>20} {per_call(lambda: base64.b64decode(encoded), 200):8.2f}us"
+    )
+    print(
+        f"{'a2b_base64':>20} {per_call(lambda: binascii.a2b_base64(encoded), 200):8.2f}us"
+    )
+
+
+if __name__ == "__main__":
+    main()
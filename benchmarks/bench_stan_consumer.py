@@ -0,0 +1,77 @@
+"""
+STAN consumer throughput with a handler doing HANDLER_SECONDS of I/O, one
+message at a time with stream_subscribe and concurrently with
+stream_consumer.
+
+    NATS_URL=nats://localhost:4222 STAN_CLUSTER=test-cluster \
+        python benchmarks/bench_stan_consumer.py
+"""
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 2000))
+HANDLER_SECONDS = float(os.environ.get("HANDLER_SECONDS", 0.005))
+MAX_INFLIGHT = int(os.environ.get("MAX_INFLIGHT", 64))
+
+
+async def consume(nats, subject, subscribe):
+    done = asyncio.Event()
+    handled = 0
+
+    async def handler(msg):
+        nonlocal handled
+        await asyncio.sleep(HANDLER_SECONDS)
+        handled += 1
+        if handled == MESSAGES:
+            done.set()
+
+    start = time.perf_counter()
+    sub = await subscribe(handler, subject)
+    await done.wait()
+    return time.perf_counter() - start, sub
+
+
+async def main():
+    nats = NatsUtility(
+        {
+            "hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")],
+            "stan": os.environ.get("STAN_CLUSTER", "test-cluster"),
+            "timeout": 5,
+        }
+    )
+    await nats.initialize()
+    try:
+        subject = f"bench.consumer.{time.time():.0f}"
+        for idx in range(MESSAGES):
+            await nats.stream_publish(subject, b"x" * 128)
+        await nats.stream_publish_complete()
+
+        elapsed, sid = await consume(
+            nats,
+            subject,
+            lambda handler, subject: nats.stream_subscribe(
+                handler, subject, start_at="first"
+            ),
+        )
+        await nats.stream_unsubscribe(sid)
+        print(f"  serial: {MESSAGES / elapsed:7.0f} msgs/s")
+
+        elapsed, consumer = await consume(
+            nats,
+            subject,
+            lambda handler, subject: nats.stream_consumer(
+                handler, subject, max_inflight=MAX_INFLIGHT, start_at="first"
+            ),
+        )
+        print(f"consumer: {MESSAGES / elapsed:7.0f} msgs/s")
+        print(consumer.stats())
+        await nats.stream_consumer_stop(consumer)
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
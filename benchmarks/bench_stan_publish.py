@@ -0,0 +1,48 @@
+"""
+STAN publish throughput waiting for every ack as done before and with the
+pipelined stream_publish.
+
+    NATS_URL=nats://localhost:4222 STAN_CLUSTER=test-cluster \
+        python benchmarks/bench_stan_publish.py
+"""
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 20000))
+SIZE = int(os.environ.get("SIZE", 128))
+
+
+async def main():
+    nats = NatsUtility(
+        {
+            "hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")],
+            "stan": os.environ.get("STAN_CLUSTER", "test-cluster"),
+            "timeout": 5,
+        }
+    )
+    await nats.initialize()
+    try:
+        payload = b"x" * SIZE
+
+        start = time.perf_counter()
+        for idx in range(MESSAGES):
+            await nats.sc.publish("bench.stan", payload)
+        elapsed = time.perf_counter() - start
+        print(f"  waiting: {MESSAGES / elapsed:7.0f} msgs/s")
+
+        start = time.perf_counter()
+        for idx in range(MESSAGES):
+            await nats.stream_publish("bench.stan", payload)
+        await nats.stream_publish_complete()
+        elapsed = time.perf_counter() - start
+        print(f"pipelined: {MESSAGES / elapsed:7.0f} msgs/s")
+        print(nats.stream_publish_stats())
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,57 @@
+"""
+Throughput of a subscription whose handler waits on I/O (HANDLER_MS, a
+database round trip), with the serial client callback and with bounded
+concurrent handlers.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_subscribe.py
+"""
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+MESSAGES = int(os.environ.get("MESSAGES", 2000))
+HANDLER_MS = float(os.environ.get("HANDLER_MS", 5))
+
+
+async def run(nats, options):
+    done = asyncio.Event()
+    handled = []
+
+    async def handler(msg):
+        await asyncio.sleep(HANDLER_MS / 1000)
+        handled.append(msg)
+        if len(handled) == MESSAGES:
+            done.set()
+
+    sid = await nats.subscribe(handler, "bench.subscribe", **options)
+    await nats.nc.flush()
+    start = time.perf_counter()
+    for idx in range(MESSAGES):
+        await nats.publish("bench.subscribe", b"x" * 128)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    await nats.unsubscribe(sid)
+    return MESSAGES / elapsed
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 5}
+    )
+    await nats.initialize()
+    try:
+        for name, options in (
+            ("serial", {}),
+            ("concurrency 16", {"concurrency": 16}),
+            ("concurrency 64", {"concurrency": 64}),
+            ("block 64", {"concurrency": 64, "overflow": "block"}),
+        ):
+            print(f"{name:>15}: {await run(nats, options):8.0f} msg/s")
+    finally:
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
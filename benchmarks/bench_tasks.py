@@ -0,0 +1,64 @@
+"""
+Task queue throughput running TASKS tasks that wait SECONDS each, one at a
+time pulling one message per request and with the worker defaults of
+CONCURRENCY tasks at once and batched pulls.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_tasks.py
+"""
+from guillotina_nats.models import Storage
+from guillotina_nats.tasks import TaskQueue
+from guillotina_nats.tasks import Worker
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import time
+
+TASKS = int(os.environ.get("TASKS", 2000))
+SECONDS = float(os.environ.get("SECONDS", 0.005))
+CONCURRENCY = int(os.environ.get("CONCURRENCY", 32))
+
+
+async def run(nats, queue, done, concurrency, batch):
+    done.clear()
+    futures = [await queue.enqueue_async("work", idx) for idx in range(TASKS)]
+    await asyncio.gather(*futures)
+    worker = Worker(nats, [queue], concurrency=concurrency, batch=batch, expires=0.1)
+    start = time.perf_counter()
+    await worker.start()
+    while len(done) < TASKS:
+        await asyncio.sleep(0.005)
+    total = time.perf_counter() - start
+    await worker.stop()
+    print(
+        f"  concurrency {concurrency:3d} batch {batch:3d}: "
+        f"{TASKS / total:7.0f} tasks/s"
+    )
+
+
+async def main():
+    nats = NatsUtility(
+        {"hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")], "timeout": 5}
+    )
+    await nats.initialize()
+    queue = TaskQueue("BENCH", storage=Storage.memory)
+    done = []
+
+    @queue.task()
+    async def work(idx):
+        await asyncio.sleep(SECONDS)
+        done.append(idx)
+
+    await queue.setup(nats)
+    try:
+        await run(nats, queue, done, 1, 1)
+        await run(nats, queue, done, CONCURRENCY, 1)
+        await run(nats, queue, done, CONCURRENCY, CONCURRENCY)
+    finally:
+        await nats.js_stream_delete("BENCH")
+        await nats.js_stream_delete("BENCH_DLQ")
+        await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,91 @@
+"""
+Task queue throughput running TASKS CPU bound tasks of about one ms with
+one worker process and with PROCESSES supervised ones sharing the durable
+pull consumer.
+
+    NATS_URL=nats://localhost:4222 python benchmarks/bench_workers.py
+"""
+from guillotina_nats.models import Storage
+from guillotina_nats.supervisor import Supervisor
+from guillotina_nats.tasks import TaskQueue
+from guillotina_nats.tasks import Worker
+from guillotina_nats.utility import NatsUtility
+
+import asyncio
+import os
+import signal
+import time
+
+TASKS = int(os.environ.get("TASKS", 5000))
+PROCESSES = int(os.environ.get("PROCESSES", os.cpu_count()))
+SETTINGS = {
+    "hosts": [os.environ.get("NATS_URL", "nats://localhost:4222")],
+    "timeout": 5,
+}
+
+queue = TaskQueue("BENCH", storage=Storage.memory)
+
+
+@queue.task()
+async def work(idx):
+    sum(range(20000))
+
+
+async def enqueue():
+    nats = NatsUtility(SETTINGS)
+    await nats.initialize()
+    await queue.setup(nats)
+    futures = [await queue.enqueue_async("work", idx) for idx in range(TASKS)]
+    await asyncio.gather(*futures)
+    await nats.finalize(None)
+
+
+async def drain(fd):
+    nats = NatsUtility(SETTINGS)
+    await nats.initialize()
+    worker = Worker(nats, [queue], concurrency=16, expires=0.1)
+    await worker.start()
+    stopping = asyncio.Event()
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    while not stopping.is_set():
+        info = await nats.js_consumer_info(queue.stream, queue.consumer)
+        if not info["num_pending"] and not info["num_ack_pending"]:
+            # Done, stops the supervisor and every worker
+            os.kill(os.getppid(), signal.SIGTERM)
+            break
+        await asyncio.sleep(0.01)
+    await stopping.wait()
+    await worker.stop()
+    os.write(fd, f'{{"processed": {worker.processed}}}\n'.encode())
+    await nats.finalize(None)
+
+
+def run(processes):
+    asyncio.new_event_loop().run_until_complete(enqueue())
+    supervisor = Supervisor(
+        lambda fd, slot: asyncio.new_event_loop().run_until_complete(drain(fd)),
+        processes,
+    )
+    start = time.perf_counter()
+    supervisor.run()
+    total = time.perf_counter() - start
+    print(
+        f"  {processes:2d} processes: {TASKS / total:7.0f} tasks/s, "
+        f"{supervisor.stats()['processed']} processed"
+    )
+
+
+async def cleanup():
+    nats = NatsUtility(SETTINGS)
+    await nats.initialize()
+    await nats.js_stream_delete("BENCH")
+    await nats.js_stream_delete("BENCH_DLQ")
+    await nats.finalize(None)
+
+
+if __name__ == "__main__":
+    try:
+        run(1)
+        run(PROCESSES)
+    finally:
+        asyncio.new_event_loop().run_until_complete(cleanup())
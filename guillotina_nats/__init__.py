@@ -1,4 +1,11 @@
+from guillotina import configure
+
+app_settings = {"commands": {"nats-worker": "guillotina_nats.commands.WorkerCommand"}}
+
+
 def includeme(root):
     """
     custom application initialization here
     """
+    configure.scan("guillotina_nats.api")
+    configure.scan("guillotina_nats.events")
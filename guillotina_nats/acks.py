@@ -0,0 +1,60 @@
+from typing import Awaitable
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+import asyncio
+import logging
+
+logger = logging.getLogger("guillotina_nats")
+
+ACK = b"+ACK"
+NAK = b"-NAK"
+WPI = b"+WPI"
+TERM = b"+TERM"
+
+
+class AckBuffer(object):
+    """Coalesce JetStream acknowledgements and publish them fire-and-forget,
+    flushing every flush_interval seconds or once flush_size are pending"""
+
+    def __init__(
+        self,
+        publish: Callable[[str, bytes], Awaitable[None]],
+        flush_interval: float = 0.05,
+        flush_size: int = 100,
+    ):
+        self._publish = publish
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._pending: List[Tuple[str, bytes]] = []
+        self._flush_task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def add(self, reply: str, payload: bytes = ACK):
+        self._pending.append((reply, payload))
+        if len(self._pending) >= self._flush_size or not self._flush_interval:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Could not flush acks")
+
+    async def flush(self):
+        pending, self._pending = self._pending, []
+        for reply, payload in pending:
+            await self._publish(reply, payload)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
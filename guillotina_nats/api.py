@@ -0,0 +1,22 @@
+from guillotina import configure
+from guillotina.component import get_utility
+from guillotina.component import query_utility
+from guillotina.interfaces import IApplication
+from guillotina.interfaces import IPubSubUtility
+from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.pubsub import NatsPubSubUtility
+
+
+@configure.service(
+    context=IApplication,
+    method="GET",
+    permission="guillotina.ReadConfiguration",
+    name="@nats-stats",
+    summary="NATS client stats and metrics",
+)
+async def nats_stats(context, request):
+    stats = get_utility(INatsUtility).stats()
+    pubsub = query_utility(IPubSubUtility)
+    if isinstance(pubsub, NatsPubSubUtility):
+        stats["pubsub"] = pubsub.stats()
+    return stats
@@ -0,0 +1,83 @@
+from nats.aio.errors import ErrBadSubject
+from nats.aio.errors import ErrConnectionClosed
+from nats.aio.errors import ErrMaxPayload
+from typing import Any
+from typing import List
+from typing import Tuple
+
+import asyncio
+import logging
+
+logger = logging.getLogger("guillotina_nats")
+
+
+class PublishBuffer(object):
+    """Bounded buffer of core NATS publishes, handed to the client once per
+    event loop iteration or when max_bytes/max_messages are buffered. While
+    reconnecting messages are kept here and publishers wait once the buffer
+    is full instead of growing the client pending buffer. It does not speed
+    publishing up, the client already writes pending commands together"""
+
+    def __init__(self, utility, max_bytes: int = 1048576, max_messages: int = 1000):
+        self._utility = utility
+        self._max_bytes = max_bytes
+        self._max_messages = max_messages
+        self._pending: List[Tuple[Any, str, bytes]] = []
+        self._size = 0
+        self._scheduled = None
+        self._room = asyncio.Event()
+        self._room.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def full(self):
+        return self._size >= self._max_bytes or len(self._pending) >= self._max_messages
+
+    async def add(self, subject: str, payload: bytes):
+        # The connection is chosen when publishing, so hash and round_robin
+        # routes spread the buffered messages as direct publishes do
+        nc = self._utility.connection("publish", subject)
+        if nc.is_closed:
+            raise ErrConnectionClosed("Could not publish")
+        if subject == "":
+            raise ErrBadSubject
+        if len(payload) > nc.max_payload:
+            raise ErrMaxPayload
+        while self.full:
+            self._room.clear()
+            await self._room.wait()
+        self._pending.append((nc, subject, payload))
+        self._size += len(payload)
+        if self.full:
+            await self.flush()
+        elif self._scheduled is None:
+            self._scheduled = asyncio.ensure_future(self._flush_soon())
+
+    async def _flush_soon(self):
+        # Let the rest of the current tick add to the batch
+        await asyncio.sleep(0)
+        self._scheduled = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Could not flush publish buffer")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._size = 0
+        kept = []
+        for nc, subject, payload in pending:
+            if nc.is_connected:
+                await nc.publish(subject, payload)
+            else:
+                # Kept in order until reconnected_cb flushes again
+                kept.append((nc, subject, payload))
+        if kept:
+            self._pending[:0] = kept
+            self._size += sum(len(payload) for _, _, payload in kept)
+        if not self.full:
+            self._room.set()
@@ -0,0 +1,104 @@
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timezone
+from enum import Enum
+from pydantic import BaseModel
+from uuid import UUID
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None  # type: ignore
+
+
+def encode_default(obj):
+    """Encode the values JSON has no type for, pydantic.json is deprecated
+    in pydantic 2"""
+    if isinstance(obj, BaseModel):
+        if hasattr(obj, "model_dump"):
+            return obj.model_dump()
+        return obj.dict()
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+class JSONCodec(object):
+    name = "json"
+
+    def loads(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, default=encode_default).encode()
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, default=encode_default)
+
+
+class MsgspecCodec(JSONCodec):
+    name = "msgspec"
+
+    def loads(self, data):
+        return msgspec.json.decode(data)
+
+    def dumps(self, obj) -> bytes:
+        return msgspec.json.encode(obj, enc_hook=encode_default)
+
+
+def get_codec(name: str = "auto") -> JSONCodec:
+    """JSON codec by name, auto picks the fastest one installed"""
+    if name in ("auto", "orjson") and orjson is not None:
+        return OrjsonCodec()
+    if name in ("auto", "msgspec") and msgspec is not None:
+        return MsgspecCodec()
+    if name not in ("auto", "json"):
+        raise ValueError(f"JSON codec {name} is not available")
+    return JSONCodec()
+
+
+def rfc3339(value: datetime) -> str:
+    """UTC time as the server reports it back, naive times are taken as UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    value = value.astimezone(timezone.utc)
+    fraction = f".{value.microsecond:06d}".rstrip("0") if value.microsecond else ""
+    return value.strftime("%Y-%m-%dT%H:%M:%S") + fraction + "Z"
+
+
+def config_payload(config: BaseModel) -> dict:
+    """Fields of a flat config model without the unset ones, a lot cheaper
+    than going through pydantic dict()/json()"""
+    payload = {}
+    for key, value in config.__dict__.items():
+        if value is None:
+            continue
+        if isinstance(value, Enum):
+            value = value.value
+        elif isinstance(value, datetime):
+            value = rfc3339(value)
+        payload[key] = value
+    return payload
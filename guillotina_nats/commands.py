@@ -0,0 +1,170 @@
+from copy import deepcopy
+from guillotina.commands import Command
+from guillotina.commands import get_settings
+from guillotina.component import get_utility
+from guillotina.utils import resolve_dotted_name
+from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.supervisor import Supervisor
+from guillotina_nats.tasks import get_queue
+from guillotina_nats.tasks import get_queues
+from guillotina_nats.tasks import Worker
+
+import asyncio
+import importlib
+import json
+import logging
+import os
+import signal
+
+logger = logging.getLogger("guillotina_nats")
+
+
+def process_settings(settings, slot: int):
+    """Settings of a worker process, each one serves the Prometheus metrics
+    on metrics_port plus its slot"""
+    nats = settings.get("load_utilities", {}).get("nats", {}).get("settings", {})
+    if nats.get("metrics_port") is None:
+        return settings
+    settings = deepcopy(settings)
+    nats = settings["load_utilities"]["nats"]["settings"]
+    nats["metrics_port"] = int(nats["metrics_port"]) + slot
+    return settings
+
+
+class WorkerCommand(Command):
+    description = "Run the tasks of NATS task queues and RPC services"
+    # Pipe to the supervisor in forked workers
+    stats_fd = None
+
+    def get_parser(self):
+        parser = super(WorkerCommand, self).get_parser()
+        parser.add_argument(
+            "--module",
+            action="append",
+            default=[],
+            help="Module registering tasks, when not imported by an application",
+        )
+        parser.add_argument(
+            "--queue",
+            action="append",
+            default=[],
+            help="Queue to run, all the registered ones by default",
+        )
+        parser.add_argument(
+            "--service",
+            action="append",
+            default=[],
+            help="Dotted name of an RPC service to start",
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=16, help="Tasks running at once"
+        )
+        parser.add_argument(
+            "--batch", type=int, default=None, help="Tasks pulled per request"
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Worker processes, more than one are run by a supervisor",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=10,
+            help="Seconds between the stats reported by worker processes",
+        )
+        parser.add_argument(
+            "--stop-timeout",
+            type=float,
+            default=60,
+            help="Seconds worker processes are given to stop before being killed",
+        )
+        return parser
+
+    def run_command(self, settings=None, loop=None):
+        if self.arguments.processes <= 1:
+            return super(WorkerCommand, self).run_command(settings, loop)
+        if settings is None:
+            settings = get_settings(
+                self.arguments.configuration, self.arguments.override
+            )
+
+        def worker(fd: int, slot: int):
+            # Every process builds its own application and NATS utility
+            self.stats_fd = fd
+            super(WorkerCommand, self).run_command(
+                process_settings(settings, slot), loop
+            )
+
+        supervisor = Supervisor(
+            worker,
+            self.arguments.processes,
+            interval=self.arguments.stats_interval,
+            stop_timeout=self.arguments.stop_timeout,
+        )
+        supervisor.run()
+        logger.info("Workers stopped")
+
+    def report(self, stats):
+        try:
+            os.write(self.stats_fd, json.dumps(stats).encode() + b"\n")
+        except OSError:
+            logger.warning("Could not report stats to the supervisor")
+
+    async def _report(self, worker, services, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.report(self.stats(worker, services))
+
+    def stats(self, worker, services):
+        stats = worker.stats()
+        stats["services"] = {service.name: service.stats() for service in services}
+        stats["requests"] = sum(
+            endpoint["requests"]
+            for service in stats["services"].values()
+            for endpoint in service.values()
+        )
+        return stats
+
+    async def run(self, arguments, settings, app):
+        for module in arguments.module:
+            importlib.import_module(module)
+        services = [resolve_dotted_name(name) for name in arguments.service]
+        if arguments.queue:
+            queues = [get_queue(name) for name in arguments.queue]
+        else:
+            queues = get_queues()
+        if not queues and not services:
+            logger.error("No task queues registered")
+            return
+
+        utility = get_utility(INatsUtility)
+        while not utility._initialized:
+            await asyncio.sleep(0.05)
+        worker = Worker(
+            utility, queues, concurrency=arguments.concurrency, batch=arguments.batch,
+        )
+        stopping = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+        await worker.start()
+        for service in services:
+            await service.start(utility)
+        reporter = None
+        if self.stats_fd is not None:
+            reporter = asyncio.ensure_future(
+                self._report(worker, services, arguments.stats_interval)
+            )
+        await stopping.wait()
+        logger.info("Stopping, waiting for the running tasks")
+        for service in services:
+            await service.stop()
+        await worker.stop()
+        stats = self.stats(worker, services)
+        if reporter is not None:
+            reporter.cancel()
+            self.report(stats)
+        # The utility finalize drains the connections on cleanup
+        logger.info(f"Worker stopped {stats}")
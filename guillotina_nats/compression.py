@@ -0,0 +1,114 @@
+from typing import Callable
+from typing import Dict
+
+import time
+import zlib
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None  # type: ignore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+
+# Compressed payloads start with MAGIC and the algorithm id, NATS core
+# messages have no headers to flag them. Text and JSON never start with \0,
+# raw binary payloads starting with MAGIC and an id are taken as compressed.
+MAGIC = b"\x00NZ"
+ZLIB = b"z"
+LZ4 = b"4"
+ZSTD = b"s"
+
+
+class Compressor(object):
+    """Compress payloads over threshold bytes with zlib, lz4 or zstd and
+    decompress any marked payload whatever algorithm the publisher used"""
+
+    def __init__(self, algorithm: str = "zlib", threshold: int = 1024, level=None):
+        self.algorithm = algorithm
+        self.threshold = threshold
+        if algorithm == "zlib":
+            self._marker = MAGIC + ZLIB
+            self._compress = lambda data: zlib.compress(
+                data, -1 if level is None else level
+            )
+        elif algorithm == "lz4" and lz4 is not None:
+            self._marker = MAGIC + LZ4
+            self._compress = lambda data: lz4.compress(
+                data, compression_level=level or 0
+            )
+        elif algorithm == "zstd" and zstandard is not None:
+            self._marker = MAGIC + ZSTD
+            self._compress = zstandard.ZstdCompressor(level=level or 3).compress
+        else:
+            raise ValueError(f"Compression {algorithm} is not available")
+        self._decompressors: Dict[int, Callable[[bytes], bytes]] = {
+            ZLIB[0]: zlib.decompress
+        }
+        if lz4 is not None:
+            self._decompressors[LZ4[0]] = lz4.decompress
+        if zstandard is not None:
+            self._decompressors[ZSTD[0]] = zstandard.ZstdDecompressor().decompress
+        self.stats = {
+            "compressed": 0,
+            "skipped": 0,
+            "decompressed": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "compress_seconds": 0.0,
+            "decompress_seconds": 0.0,
+        }
+
+    @property
+    def ratio(self):
+        """Compressed size over original size of the compressed payloads"""
+        if not self.stats["bytes_in"]:
+            return 1.0
+        return self.stats["bytes_out"] / self.stats["bytes_in"]
+
+    def compress(self, payload):
+        size = len(payload)
+        if size < self.threshold:
+            return payload
+        start = time.perf_counter()
+        compressed = self._marker + self._compress(payload)
+        self.stats["compress_seconds"] += time.perf_counter() - start
+        if len(compressed) >= size:
+            # Incompressible, not worth the decompression on every consumer
+            self.stats["skipped"] += 1
+            return payload
+        self.stats["compressed"] += 1
+        self.stats["bytes_in"] += size
+        self.stats["bytes_out"] += len(compressed)
+        return compressed
+
+    def decompress(self, data):
+        if data[:3] != MAGIC:
+            return data
+        decompress = self._decompressors.get(data[3])
+        if decompress is None:
+            raise ValueError(f"Compression {data[3:4]} is not available")
+        start = time.perf_counter()
+        data = decompress(memoryview(data)[4:])
+        self.stats["decompress_seconds"] += time.perf_counter() - start
+        self.stats["decompressed"] += 1
+        return data
+
+    def decompress_msg(self, msg):
+        """Decompress a received NATS or STAN message in place"""
+        if hasattr(msg, "proto"):
+            # STAN messages read data from their protocol buffer
+            msg.proto.data = self.decompress(msg.proto.data)
+        else:
+            msg.data = self.decompress(msg.data)
+        return msg
+
+    def wrap(self, handler):
+        async def callback(msg):
+            await handler(self.decompress_msg(msg))
+
+        return callback
@@ -0,0 +1,173 @@
+from guillotina import configure
+from guillotina.component import query_utility
+from guillotina.interfaces import IObjectAddedEvent
+from guillotina.interfaces import IObjectModifiedEvent
+from guillotina.interfaces import IObjectRemovedEvent
+from guillotina.interfaces import IResource
+from guillotina.transactions import get_transaction
+from guillotina.utils import find_container
+from guillotina.utils import get_content_path
+from guillotina_nats.interfaces import INatsUtility
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import asyncio
+import logging
+
+logger = logging.getLogger("guillotina_nats")
+
+DEFAULT_SUBJECT = "guillotina.{container}.{type_name}.{action}"
+
+
+class EventBridge(object):
+    """Publish the content events of a transaction once it is committed.
+    Events are kept on the transaction, an after commit hook hands them to
+    a background flush so publishing is off the request path, aborted
+    transactions publish nothing. Transactions committed while a flush is
+    running are published together in the next one, in commit order.
+
+    subject is the template for every content type and subjects the one of
+    specific types, with subject None only those types are published. The
+    template gets container, type_name, action and uid"""
+
+    def __init__(
+        self,
+        utility,
+        subject: Optional[str] = DEFAULT_SUBJECT,
+        subjects: Optional[Dict[str, str]] = None,
+        jetstream: bool = False,
+        serializer="json",
+        max_pending: int = 10000,
+    ):
+        self._utility = utility
+        self.subject = subject
+        self.subjects = subjects or {}
+        self.jetstream = jetstream
+        self.serializer = serializer
+        self.max_pending = max_pending
+        self._pending: List[Tuple[str, Dict]] = []
+        self._flushing: Optional[asyncio.Future] = None
+        self.published = 0
+        self.batches = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "published": self.published,
+            "batches": self.batches,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+    def template(self, type_name: str) -> Optional[str]:
+        return self.subjects.get(type_name, self.subject)
+
+    def record(self, obj, event, action: str):
+        template = self.template(obj.type_name)
+        if template is None:
+            return
+        txn = get_transaction()
+        if txn is None:
+            return
+        container = find_container(obj)
+        data = {
+            "action": action,
+            "uid": obj.__uuid__,
+            "type_name": obj.type_name,
+            "path": get_content_path(obj),
+            "container": container.id if container is not None else None,
+        }
+        if action == "modified":
+            data["changed"] = sorted(event.payload or {})
+        subject = template.format(
+            container=data["container"],
+            type_name=obj.type_name,
+            action=action,
+            uid=obj.__uuid__,
+        )
+        events = getattr(txn, "_nats_events", None)
+        if events is None:
+            events = txn._nats_events = []
+            txn.add_after_commit_hook(self._committed, txn)
+        events.append((subject, data))
+
+    def _committed(self, status: bool, txn):
+        events = txn._nats_events
+        del txn._nats_events
+        if not status:
+            return
+        room = self.max_pending - len(self._pending)
+        if len(events) > room:
+            self.dropped += len(events) - room
+            logger.error(
+                f"Dropped {len(events) - room} content events, too many pending"
+            )
+            events = events[:room]
+        self._pending.extend(events)
+        if self._flushing is None:
+            self._flushing = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        try:
+            while self._pending:
+                try:
+                    await self.flush()
+                except Exception:
+                    logger.exception("Could not publish content events")
+        finally:
+            self._flushing = None
+
+    async def flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        self.batches += 1
+        if self.jetstream:
+            futures = [
+                await self._utility.js_publish_async(
+                    subject, data, serializer=self.serializer
+                )
+                for subject, data in pending
+            ]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            for (subject, _), result in zip(pending, results):
+                if isinstance(result, Exception):
+                    self.failed += 1
+                    logger.error(f"Content event not stored on {subject}: {result}")
+                else:
+                    self.published += 1
+        else:
+            for subject, data in pending:
+                await self._utility.publish(subject, data, serializer=self.serializer)
+            self.published += len(pending)
+
+    async def close(self):
+        """Wait for the committed events to be published"""
+        if self._flushing is not None:
+            await self._flushing
+
+
+def _record(obj, event, action: str):
+    utility = query_utility(INatsUtility)
+    if utility is None or utility._events is None:
+        return
+    utility._events.record(obj, event, action)
+
+
+@configure.subscriber(for_=(IResource, IObjectAddedEvent))
+async def object_added(obj, event):
+    _record(obj, event, "added")
+
+
+@configure.subscriber(for_=(IResource, IObjectModifiedEvent))
+async def object_modified(obj, event):
+    _record(obj, event, "modified")
+
+
+@configure.subscriber(for_=(IResource, IObjectRemovedEvent))
+async def object_removed(obj, event):
+    _record(obj, event, "removed")
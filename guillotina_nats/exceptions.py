@@ -0,0 +1,67 @@
+from nats.aio.errors import NatsError
+from typing import Optional
+
+
+class ConsumerStalled(NatsError):
+    def __init__(self, stream: str, consumer: str):
+        self.stream = stream
+        self.consumer = consumer
+
+    def __str__(self):
+        return f"nats: consumer {self.consumer} on {self.stream} missed heartbeats"
+
+
+class JetStreamError(NatsError):
+    def __init__(self, code: int, description: str):
+        self.code = code
+        self.description = description
+
+    def __str__(self):
+        return f"nats: jetstream error {self.code} {self.description}"
+
+
+class ObjectNotFound(NatsError):
+    def __init__(self, bucket: str, name: str):
+        self.bucket = bucket
+        self.name = name
+
+    def __str__(self):
+        return f"nats: object {self.name} not found in {self.bucket}"
+
+
+class ObjectCorrupted(NatsError):
+    def __init__(self, bucket: str, name: str, reason: str):
+        self.bucket = bucket
+        self.name = name
+        self.reason = reason
+
+    def __str__(self):
+        return f"nats: object {self.name} in {self.bucket} is corrupted, {self.reason}"
+
+
+class RPCError(NatsError):
+    def __init__(self, code: int, message: str, error_type: Optional[str] = None):
+        self.code = code
+        self.message = message
+        self.type = error_type or self.__class__.__name__
+
+    def as_dict(self):
+        return {"code": self.code, "type": self.type, "message": self.message}
+
+    def __str__(self):
+        return f"nats: rpc error {self.code} {self.type}: {self.message}"
+
+
+class RPCTimeout(RPCError):
+    def __init__(self, subject: str):
+        super().__init__(408, f"no reply from {subject}")
+        self.subject = subject
+
+
+class StanPublishError(NatsError):
+    def __init__(self, subject: str, error: str):
+        self.subject = subject
+        self.error = error
+
+    def __str__(self):
+        return f"stan: could not publish to {self.subject}, {self.error}"
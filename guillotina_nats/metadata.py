@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+import copy
+import time
+
+
+class MetadataCache(object):
+    """TTL and size bounded cache of JetStream API responses, keys are
+    tuples starting with the kind of response and the stream name. Callers
+    get copies, changing them does not change the cached responses"""
+
+    def __init__(self, ttl: float = 0, max_size: int = 1024):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def enabled(self):
+        return self._ttl > 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        if not self.enabled or "error" in value:
+            return
+        self._data[key] = (time.monotonic() + self._ttl, copy.deepcopy(value))
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def invalidate_stream(self, stream: str):
+        """Drop the stream, its consumers and the stream listing"""
+        for key in list(self._data):
+            if key[0] == "streams" or (len(key) > 1 and key[1] == stream):
+                del self._data[key]
+
+    def invalidate_consumer(self, stream: str, consumer: str):
+        self.invalidate(("consumer", stream, consumer))
+        self.invalidate(("consumers", stream))
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,267 @@
+from typing import Dict
+from typing import Tuple
+
+import logging
+
+logger = logging.getLogger("guillotina_nats")
+
+try:
+    import prometheus_client
+
+    COUNTERS = {
+        "publish": prometheus_client.Counter(
+            "guillotina_nats_publish_total",
+            "Total published messages by kind of publish",
+            labelnames=["kind"],
+        ),
+        "publish_bytes": prometheus_client.Counter(
+            "guillotina_nats_publish_bytes_total",
+            "Total published payload bytes by kind of publish",
+            labelnames=["kind"],
+        ),
+        "request_timeouts": prometheus_client.Counter(
+            "guillotina_nats_request_timeouts_total",
+            "Total requests without a response by subject family",
+            labelnames=["family"],
+        ),
+        "fetch_messages": prometheus_client.Counter(
+            "guillotina_nats_fetch_messages_total",
+            "Total messages pulled from JetStream consumers",
+        ),
+        "fetch_timeouts": prometheus_client.Counter(
+            "guillotina_nats_fetch_timeouts_total",
+            "Total js_get_next calls without a message",
+        ),
+        "callback_errors": prometheus_client.Counter(
+            "guillotina_nats_callback_errors_total",
+            "Total subscription callbacks that raised by subscription",
+            labelnames=["subject"],
+        ),
+        "dropped_messages": prometheus_client.Counter(
+            "guillotina_nats_dropped_messages_total",
+            "Total messages dropped by bounded subscriptions by subscription",
+            labelnames=["subject"],
+        ),
+        "slow_consumers": prometheus_client.Counter(
+            "guillotina_nats_slow_consumers_total", "Total slow consumer errors",
+        ),
+        "rpc_errors": prometheus_client.Counter(
+            "guillotina_nats_rpc_errors_total",
+            "Total RPC requests replied with an error by endpoint",
+            labelnames=["endpoint"],
+        ),
+        "stan_publish_retries": prometheus_client.Counter(
+            "guillotina_nats_stan_publish_retries_total",
+            "Total NATS Streaming publishes sent again after an ack timeout",
+        ),
+        "stan_disconnects": prometheus_client.Counter(
+            "guillotina_nats_stan_disconnects_total",
+            "Total NATS Streaming connections lost",
+        ),
+        "stan_reconnects": prometheus_client.Counter(
+            "guillotina_nats_stan_reconnects_total",
+            "Total NATS Streaming reconnections",
+        ),
+        "stan_redeliveries": prometheus_client.Counter(
+            "guillotina_nats_stan_redeliveries_total",
+            "Total NATS Streaming messages redelivered to consumers by subject",
+            labelnames=["subject"],
+        ),
+        "pubsub_duplicates": prometheus_client.Counter(
+            "guillotina_nats_pubsub_duplicates_total",
+            "Total pubsub messages dropped on receipt as already seen",
+        ),
+        "task_failures": prometheus_client.Counter(
+            "guillotina_nats_task_failures_total",
+            "Total task runs that raised by task subject",
+            labelnames=["task"],
+        ),
+        "task_dead_letters": prometheus_client.Counter(
+            "guillotina_nats_task_dead_letters_total",
+            "Total tasks moved to the dead letter stream by task subject",
+            labelnames=["task"],
+        ),
+        "disconnects": prometheus_client.Counter(
+            "guillotina_nats_disconnects_total", "Total disconnections"
+        ),
+        "reconnects": prometheus_client.Counter(
+            "guillotina_nats_reconnects_total", "Total reconnections"
+        ),
+        "errors": prometheus_client.Counter(
+            "guillotina_nats_errors_total", "Total asynchronous client errors"
+        ),
+    }
+    HISTOGRAMS = {
+        "request": prometheus_client.Histogram(
+            "guillotina_nats_request_seconds",
+            "Histogram of request latency by subject family (in seconds)",
+            labelnames=["family"],
+        ),
+        "fetch": prometheus_client.Histogram(
+            "guillotina_nats_fetch_seconds",
+            "Histogram of JetStream pull latency (in seconds)",
+        ),
+        "rpc": prometheus_client.Histogram(
+            "guillotina_nats_rpc_seconds",
+            "Histogram of RPC endpoint processing time by endpoint (in seconds)",
+            labelnames=["endpoint"],
+        ),
+        "stan_ack": prometheus_client.Histogram(
+            "guillotina_nats_stan_ack_seconds",
+            "Histogram of NATS Streaming publish ack latency (in seconds)",
+        ),
+        "stan_lag": prometheus_client.Histogram(
+            "guillotina_nats_stan_lag_seconds",
+            "Histogram of the time from publish to handling of NATS Streaming "
+            "consumer messages by subject (in seconds)",
+            labelnames=["subject"],
+        ),
+        "pubsub_latency": prometheus_client.Histogram(
+            "guillotina_nats_pubsub_latency_seconds",
+            "Histogram of the time from publish to receipt of pubsub batches "
+            "(in seconds)",
+        ),
+        "pubsub_batch_size": prometheus_client.Histogram(
+            "guillotina_nats_pubsub_batch_size",
+            "Histogram of the messages per received pubsub batch",
+            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+        ),
+        "task": prometheus_client.Histogram(
+            "guillotina_nats_task_seconds",
+            "Histogram of task run time by task subject (in seconds)",
+            labelnames=["task"],
+        ),
+        "callback": prometheus_client.Histogram(
+            "guillotina_nats_callback_seconds",
+            "Histogram of subscription callback duration by subscription "
+            "(in seconds)",
+            labelnames=["subject"],
+        ),
+    }
+    GAUGES = {
+        "pending_bytes": prometheus_client.Gauge(
+            "guillotina_nats_pending_bytes",
+            "Bytes waiting in the client buffers to be written",
+        ),
+        "subscription_pending_msgs": prometheus_client.Gauge(
+            "guillotina_nats_subscription_pending_msgs",
+            "Messages waiting in subscription queues to be processed",
+        ),
+        "subscription_pending_bytes": prometheus_client.Gauge(
+            "guillotina_nats_subscription_pending_bytes",
+            "Bytes waiting in subscription queues to be processed",
+        ),
+    }
+except ImportError:
+    prometheus_client = None  # type: ignore
+
+
+def request_family(subject: str):
+    """Low cardinality label for a request subject"""
+    if subject.startswith("$JS.API."):
+        # $JS.API.STREAM.INFO.<stream>, $JS.API.CONSUMER.MSG.NEXT.<s>.<c>
+        tokens = subject.split(".")
+        if tokens[2] in ("STREAM", "CONSUMER"):
+            if tokens[3] in ("MSG", "DURABLE"):
+                return ".".join(tokens[2:5])
+            return ".".join(tokens[2:4])
+        return tokens[2]
+    if subject.startswith("$JS.ACK."):
+        return "ACK"
+    return "core"
+
+
+class Metrics(object):
+    """Counters and duration summaries of the utility hot paths. Hooks are
+    called with (kind, name, value, labels) on every record, kind being
+    counter or histogram"""
+
+    def __init__(self):
+        self.counters: Dict[Tuple, float] = {}
+        self.histograms: Dict[Tuple, list] = {}
+        self.hooks = []
+
+    def inc(self, name: str, value: float = 1, **labels):
+        # Labels are always passed in the same order by the utility
+        key = (name, tuple(labels.items()))
+        try:
+            self.counters[key] += value
+        except KeyError:
+            self.counters[key] = value
+        if self.hooks:
+            for hook in self.hooks:
+                hook("counter", name, value, labels)
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(labels.items()))
+        summary = self.histograms.get(key)
+        if summary is None:
+            # count, sum, max
+            self.histograms[key] = [1, seconds, seconds]
+        else:
+            summary[0] += 1
+            summary[1] += seconds
+            if seconds > summary[2]:
+                summary[2] = seconds
+        if self.hooks:
+            for hook in self.hooks:
+                hook("histogram", name, seconds, labels)
+
+    def snapshot(self):
+        counters: Dict = {}
+        for (name, labels), value in self.counters.items():
+            counters.setdefault(name, []).append(
+                {"labels": dict(labels), "value": value}
+            )
+        histograms: Dict = {}
+        for (name, labels), (total, seconds, maximum) in self.histograms.items():
+            histograms.setdefault(name, []).append(
+                {
+                    "labels": dict(labels),
+                    "count": total,
+                    "sum": seconds,
+                    "avg": seconds / total,
+                    "max": maximum,
+                }
+            )
+        return {"counters": counters, "histograms": histograms}
+
+
+class PrometheusExporter(object):
+    """Metrics hook recording into the prometheus_client default registry,
+    gauges are read from the utility on scrape"""
+
+    def __init__(self, utility, port=None):
+        if prometheus_client is None:
+            raise ValueError("prometheus_client is not installed")
+        self._utility = utility
+        self._children: Dict = {}
+        for name, gauge in GAUGES.items():
+            gauge.set_function(lambda name=name: utility.client_stats()[name])
+        if port is not None:
+            prometheus_client.start_http_server(int(port))
+            logger.info(f"Serving NATS metrics on port {port}")
+
+    def _child(self, metric, name: str, labels: Dict[str, str]):
+        # labels() takes a lock and builds the key on every call
+        key = (name, tuple(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = metric.labels(**labels)
+        return child
+
+    def __call__(self, kind: str, name: str, value: float, labels: Dict[str, str]):
+        if kind == "counter":
+            counter = COUNTERS.get(name)
+            if counter is not None:
+                if labels:
+                    self._child(counter, name, labels).inc(value)
+                else:
+                    counter.inc(value)
+        else:
+            histogram = HISTOGRAMS.get(name)
+            if histogram is not None:
+                if labels:
+                    self._child(histogram, name, labels).observe(value)
+                else:
+                    histogram.observe(value)
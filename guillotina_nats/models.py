@@ -1,5 +1,7 @@
+from datetime import datetime
 from enum import Enum
 from pydantic import BaseModel
+from typing import Dict
 from typing import List
 from typing import Optional
 
@@ -36,6 +38,7 @@ class DeliverPolicy(str, Enum):
     new = "new"
     by_start_sequence = "by_start_sequence"
     by_start_time = "by_start_time"
+    last_per_subject = "last_per_subject"
 
 
 class AckPolicy(str, Enum):
@@ -62,7 +65,68 @@ class ConsumerConfig(BaseModel):
     max_deliver: Optional[int] = None
     max_waiting: Optional[int] = None
     opt_start_seq: Optional[int] = None
-    opt_start_time: Optional[int] = None
+    opt_start_time: Optional[datetime] = None
     rate_limit_bps: Optional[int] = None
     replay_policy: ReplayPolicy = ReplayPolicy.instant
     sample_freq: Optional[str] = None
+
+
+class PubAck(BaseModel):
+    stream: str
+    seq: int
+    duplicate: bool = False
+
+
+class StreamState(BaseModel):
+    messages: int = 0
+    bytes: int = 0
+    first_seq: int = 0
+    last_seq: int = 0
+    consumer_count: int = 0
+
+
+class StreamInfo(BaseModel):
+    config: StreamConfig
+    created: datetime
+    state: StreamState
+
+
+class SequencePair(BaseModel):
+    consumer_seq: int = 0
+    stream_seq: int = 0
+
+
+class ConsumerInfo(BaseModel):
+    stream_name: str
+    name: str
+    created: datetime
+    config: ConsumerConfig
+    delivered: SequencePair
+    ack_floor: SequencePair
+    num_ack_pending: int = 0
+    num_redelivered: int = 0
+    num_waiting: int = 0
+    num_pending: int = 0
+
+
+class StoredMessage(BaseModel):
+    subject: str
+    seq: int
+    data: bytes = b""
+    time: datetime
+    headers: Optional[Dict[str, str]] = None
+
+
+class ObjectInfo(BaseModel):
+    bucket: str
+    name: str
+    nuid: str
+    size: int = 0
+    chunks: int = 0
+    chunk_size: int = 0
+    digest: str = ""
+    first_seq: int = 0
+    last_seq: int = 0
+    mtime: datetime
+    deleted: bool = False
+    metadata: Dict[str, str] = {}
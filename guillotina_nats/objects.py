@@ -0,0 +1,183 @@
+from datetime import datetime
+from datetime import timezone
+from guillotina_nats.exceptions import ObjectCorrupted
+from guillotina_nats.exceptions import ObjectNotFound
+from guillotina_nats.models import ObjectInfo
+from typing import AsyncIterator
+from typing import Dict
+from typing import Optional
+
+import asyncio
+import base64
+import hashlib
+import inspect
+import uuid
+
+
+def encode_name(name: str):
+    # Object names may contain dots and spaces, not valid subject tokens
+    return base64.urlsafe_b64encode(name.encode()).decode()
+
+
+def encode_digest(digest):
+    return "SHA-256=" + base64.urlsafe_b64encode(digest.digest()).decode()
+
+
+class ObjectStore(object):
+    """Objects of any size stored as chunks in a JetStream stream. Chunks go
+    to $O.<bucket>.C.<nuid> and a manifest with the size, chunk count and
+    digest to $O.<bucket>.M.<name>, only the last manifest of a name is
+    kept"""
+
+    def __init__(self, utility, bucket: str, chunk_size: int = 131072, read_ahead=4):
+        self._utility = utility
+        self.bucket = bucket
+        self.stream = f"OBJ_{bucket}"
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+
+    def chunk_subject(self, nuid: str):
+        return f"$O.{self.bucket}.C.{nuid}"
+
+    def meta_subject(self, name: str):
+        return f"$O.{self.bucket}.M.{encode_name(name)}"
+
+    async def _chunks(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            # Slices of the view, the payload is not copied
+            view = memoryview(data).cast("B")
+            for offset in range(0, len(view), self.chunk_size):
+                end = offset + self.chunk_size
+                yield view[offset:end]
+        elif hasattr(data, "read"):
+            while True:
+                chunk = data.read(self.chunk_size)
+                if inspect.isawaitable(chunk):
+                    chunk = await chunk
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            buffer = bytearray()
+            async for part in data:
+                buffer.extend(part)
+                while len(buffer) >= self.chunk_size:
+                    yield bytes(buffer[: self.chunk_size])
+                    del buffer[: self.chunk_size]
+            if buffer:
+                yield bytes(buffer)
+
+    async def put(
+        self, name: str, data, metadata: Optional[Dict[str, str]] = None
+    ) -> ObjectInfo:
+        """Store bytes, a file like object or an async iterator of bytes
+        under name, replacing the previous version once it is complete"""
+        try:
+            previous = await self.info(name)
+        except ObjectNotFound:
+            previous = None
+        nuid = uuid.uuid4().hex
+        subject = self.chunk_subject(nuid)
+        digest = hashlib.sha256()
+        size = 0
+        futures = []
+        try:
+            # Chunks are pipelined, js_publish_max_inflight bounds the
+            # unacknowledged ones
+            async for chunk in self._chunks(data):
+                digest.update(chunk)
+                size += len(chunk)
+                futures.append(await self._utility.js_publish_async(subject, chunk))
+            acks = await asyncio.gather(*futures)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            await self._utility.js_stream_purge(self.stream, subject)
+            raise
+        info = ObjectInfo(
+            bucket=self.bucket,
+            name=name,
+            nuid=nuid,
+            size=size,
+            chunks=len(acks),
+            chunk_size=self.chunk_size,
+            digest=encode_digest(digest),
+            first_seq=acks[0].seq if acks else 0,
+            last_seq=acks[-1].seq if acks else 0,
+            mtime=datetime.now(timezone.utc),
+            metadata=metadata or {},
+        )
+        await self._utility.js_publish(
+            self.meta_subject(name), info, serializer=ObjectInfo
+        )
+        await self._utility.js_stream_purge(
+            self.stream, self.meta_subject(name), keep=1
+        )
+        if previous is not None:
+            await self._utility.js_stream_purge(
+                self.stream, self.chunk_subject(previous.nuid)
+            )
+        return info
+
+    async def info(self, name: str) -> ObjectInfo:
+        stored = await self._utility.js_get_last_message(
+            self.stream, self.meta_subject(name)
+        )
+        if stored is None:
+            raise ObjectNotFound(self.bucket, name)
+        info = ObjectInfo.parse_raw(stored.data)
+        if info.deleted:
+            raise ObjectNotFound(self.bucket, name)
+        return info
+
+    async def get(self, name: str) -> AsyncIterator[bytes]:
+        """Chunks of the object in order, read_ahead chunks are fetched at
+        a time. Raises ObjectCorrupted after the last chunk when the size
+        or digest do not match the manifest"""
+        info = await self.info(name)
+        digest = hashlib.sha256()
+        size = 0
+        chunks = 0
+        if info.chunks:
+            async for stored in self._utility.js_get_messages(
+                self.stream,
+                start=info.first_seq,
+                end=info.last_seq,
+                subject=self.chunk_subject(info.nuid),
+                batch=self.read_ahead,
+            ):
+                digest.update(stored.data)
+                size += len(stored.data)
+                chunks += 1
+                yield stored.data
+        if chunks != info.chunks or size != info.size:
+            raise ObjectCorrupted(
+                self.bucket, name, f"{chunks} of {info.chunks} chunks"
+            )
+        if encode_digest(digest) != info.digest:
+            raise ObjectCorrupted(self.bucket, name, "digest mismatch")
+
+    async def get_bytes(self, name: str) -> bytes:
+        return b"".join([chunk async for chunk in self.get(name)])
+
+    async def delete(self, name: str):
+        info = await self.info(name)
+        info.deleted = True
+        info.size = info.chunks = info.first_seq = info.last_seq = 0
+        info.digest = ""
+        info.mtime = datetime.now(timezone.utc)
+        await self._utility.js_publish(
+            self.meta_subject(name), info, serializer=ObjectInfo
+        )
+        await self._utility.js_stream_purge(
+            self.stream, self.meta_subject(name), keep=1
+        )
+        await self._utility.js_stream_purge(self.stream, self.chunk_subject(info.nuid))
+
+    async def list(self) -> AsyncIterator[ObjectInfo]:
+        async for stored in self._utility.js_get_messages(
+            self.stream, subject=f"$O.{self.bucket}.M.>"
+        ):
+            info = ObjectInfo.parse_raw(stored.data)
+            if not info.deleted:
+                yield info
@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from functools import partial
+from guillotina.component import get_utility
+from guillotina_nats.interfaces import INatsUtility
+from nats.aio.errors import ErrConnectionClosed
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import asyncio
+import logging
+import pickle
+import time
+import uuid
+
+logger = logging.getLogger("guillotina_nats")
+
+
+def is_invalidation(data: Any) -> bool:
+    return isinstance(data, dict) and "keys" in data and "tid" in data
+
+
+def merge_invalidations(messages: List[Dict]) -> Dict:
+    """Single cache invalidation with the effect of applying messages in
+    order, keys are deduplicated and pushed values of keys invalidated by
+    a later message dropped"""
+    keys: Dict[str, None] = {}
+    push: Dict[str, Any] = {}
+    for data in messages:
+        for key in data["keys"]:
+            keys[key] = None
+            push.pop(key, None)
+        push.update(data.get("push") or {})
+    return {"tid": messages[-1]["tid"], "keys": list(keys), "push": push}
+
+
+class NatsPubSubUtility(object):
+    """Guillotina IPubSubUtility over the NATS utility, usable as the cache
+    updates_channel transport instead of Redis.
+
+    Publishes to a channel are sent together in one message every
+    batch_interval seconds or once max_batch are pending. On receipt
+    messages already seen are dropped and the cache invalidations of
+    other processes in a batch are merged into a single callback"""
+
+    def __init__(self, settings=None):
+        settings = settings or {}
+        self._prefix = settings.get("subject_prefix", "guillotina.pubsub.")
+        self._batch_interval = float(settings.get("batch_interval", 0.005))
+        self._max_batch = int(settings.get("max_batch", 100))
+        self._dedupe_size = int(settings.get("dedupe_size", 1024))
+        self._uid = uuid.uuid4().hex
+        self._utility = None
+        self._subscribers: Dict[str, Dict[str, Callable]] = {}
+        self._sids: Dict[str, Any] = {}
+        self._pending: Dict[str, List[Tuple[str, Any]]] = {}
+        self._flushes: Dict[str, asyncio.Future] = {}
+        self._seen: OrderedDict = OrderedDict()
+        self._initialized = False
+        self.published = 0
+        self.batches_sent = 0
+        self.received = 0
+        self.batches_received = 0
+        self.duplicates = 0
+
+    async def initialized(self):
+        while not self._initialized:
+            await asyncio.sleep(0.05)
+
+    async def initialize(self, app=None):
+        self._utility = get_utility(INatsUtility)
+        while not self._utility._initialized:
+            await asyncio.sleep(0.05)
+        self._initialized = True
+
+    async def finalize(self, app):
+        for flushing in self._flushes.values():
+            flushing.cancel()
+        self._flushes.clear()
+        # The NATS utility may have been finalized first
+        try:
+            for channel_name in list(self._pending):
+                await self.flush(channel_name)
+            for channel_name in list(self._sids):
+                await self._utility.unsubscribe(self._sids.pop(channel_name))
+        except ErrConnectionClosed:
+            logger.warning("NATS connection closed before pubsub finalize")
+        self._pending.clear()
+        self._sids.clear()
+        self._subscribers.clear()
+        self._initialized = False
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "batches_sent": self.batches_sent,
+            "received": self.received,
+            "batches_received": self.batches_received,
+            "duplicates": self.duplicates,
+        }
+
+    def subject(self, channel_name: str):
+        return self._prefix + channel_name
+
+    async def subscribe(self, channel_name: str, rid: str, callback: Callable):
+        if channel_name in self._subscribers:
+            self._subscribers[channel_name][rid] = callback
+            return
+        self._subscribers[channel_name] = {rid: callback}
+        self._sids[channel_name] = await self._utility.subscribe(
+            partial(self._received, channel_name), self.subject(channel_name)
+        )
+
+    async def unsubscribe(self, channel_name: str, req_id: str):
+        subscribers = self._subscribers.get(channel_name)
+        if subscribers is None:
+            return
+        subscribers.pop(req_id, None)
+        if not subscribers:
+            del self._subscribers[channel_name]
+            await self._utility.unsubscribe(self._sids.pop(channel_name))
+
+    async def publish(self, channel_name: str, rid: str, data: Any):
+        pending = self._pending.setdefault(channel_name, [])
+        pending.append((rid, data))
+        self.published += 1
+        if len(pending) >= self._max_batch:
+            await self.flush(channel_name)
+        elif channel_name not in self._flushes:
+            self._flushes[channel_name] = asyncio.ensure_future(
+                self._flush_later(channel_name)
+            )
+
+    async def _flush_later(self, channel_name: str):
+        await asyncio.sleep(self._batch_interval)
+        self._flushes.pop(channel_name, None)
+        try:
+            await self.flush(channel_name)
+        except Exception:
+            logger.exception(f"Could not publish to {channel_name}")
+
+    async def flush(self, channel_name: str):
+        messages = self._pending.pop(channel_name, None)
+        if not messages:
+            return
+        self.batches_sent += 1
+        batch = {"origin": self._uid, "sent": time.time(), "messages": messages}
+        await self._utility.publish(
+            self.subject(channel_name), pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        )
+
+    def _duplicate(self, rid: str, data: Any) -> bool:
+        tid = data.get("tid") if isinstance(data, dict) else None
+        if tid is None:
+            return False
+        key = (rid, tid)
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[key] = None
+        if len(self._seen) > self._dedupe_size:
+            self._seen.popitem(last=False)
+        return False
+
+    async def _received(self, channel_name: str, msg):
+        try:
+            batch = pickle.loads(msg.data)
+        except (TypeError, pickle.UnpicklingError):
+            logger.warning("Invalid pubsub message", exc_info=True)
+            return
+        messages = [
+            (rid, data)
+            for rid, data in batch["messages"]
+            if not self._duplicate(rid, data)
+        ]
+        self.received += len(messages)
+        self.batches_received += 1
+        metrics = self._utility._metrics
+        if metrics is not None:
+            metrics.observe("pubsub_latency", time.time() - batch["sent"])
+            metrics.observe("pubsub_batch_size", len(batch["messages"]))
+            if len(messages) < len(batch["messages"]):
+                metrics.inc("pubsub_duplicates", len(batch["messages"]) - len(messages))
+        if batch["origin"] != self._uid:
+            messages = self._merge(messages)
+        for rid, data in messages:
+            for req, callback in list(self._subscribers.get(channel_name, {}).items()):
+                if rid == req:
+                    continue
+                try:
+                    await callback(data=data, sender=rid)
+                except Exception:
+                    logger.error("Unhandled error with pubsub message.", exc_info=True)
+
+    def _merge(self, messages: List[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
+        # Our own invalidations go one by one so the cache utility can
+        # match and forget the transactions it ignores
+        invalidations = [data for _, data in messages if is_invalidation(data)]
+        if len(invalidations) < 2:
+            return messages
+        merged = merge_invalidations(invalidations)
+        others = [(rid, data) for rid, data in messages if not is_invalidation(data)]
+        return others + [(merged["tid"], merged)]
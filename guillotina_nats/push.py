@@ -0,0 +1,112 @@
+from guillotina_nats.exceptions import ConsumerStalled
+from typing import List
+from typing import Optional
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("guillotina_nats")
+
+
+class PushSubscription(object):
+    """Subscription to the deliver subject of a JetStream push consumer,
+    messages are dispatched to a bounded pool of handler workers"""
+
+    def __init__(
+        self,
+        utility,
+        stream: str,
+        deliver_subject: str,
+        handler,
+        concurrency: int = 1,
+        auto_ack: bool = True,
+        idle_heartbeat: Optional[int] = None,
+        stop_timeout: float = 30,
+    ):
+        self._utility = utility
+        self._handler = handler
+        self._concurrency = concurrency
+        self._auto_ack = auto_ack
+        self._idle_heartbeat = idle_heartbeat
+        self._stop_timeout = stop_timeout
+        # Bounded so a slow handler stops reading from the subscription and
+        # flow control replies are delayed until the workers catch up.
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+        self._workers: List[asyncio.Task] = []
+        self._monitor = None
+        self.stream = stream
+        self.consumer = None
+        self.deliver_subject = deliver_subject
+        self.sid = None
+        self._nc = None
+        self.last_activity = time.monotonic()
+        self.stalled = False
+
+    async def start(self):
+        self._nc = self._utility.connection("subscribe", self.deliver_subject)
+        self.sid = await self._nc.subscribe(self.deliver_subject, cb=self._process)
+        self._workers = [
+            asyncio.ensure_future(self._work()) for _ in range(self._concurrency)
+        ]
+        if self._idle_heartbeat:
+            self._monitor = asyncio.ensure_future(self._watch())
+
+    async def stop(self):
+        """Wait up to stop_timeout seconds for the queued messages, the
+        handlers still running then are cancelled and their messages
+        delivered again after ack_wait"""
+        if self.sid is not None:
+            await self._nc.unsubscribe(self.sid)
+            self.sid = None
+        try:
+            await asyncio.wait_for(self._queue.join(), self._stop_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Messages of {self.deliver_subject} not handled in time, "
+                "cancelling the handlers"
+            )
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+
+    async def _process(self, msg):
+        self.last_activity = time.monotonic()
+        self.stalled = False
+        if msg.reply.startswith("$JS.ACK."):
+            await self._queue.put(msg)
+        elif msg.reply:
+            # Flow control request, answer so the server keeps delivering
+            await self._nc.publish(msg.reply, b"")
+        # Otherwise it is an idle heartbeat
+
+    async def _work(self):
+        while True:
+            msg = await self._queue.get()
+            try:
+                await self._handler(msg)
+            except Exception:
+                logger.exception("Error handling message " + msg.subject)
+                if self._auto_ack:
+                    await self._utility.js_nak(msg)
+            else:
+                if self._auto_ack:
+                    await self._utility.js_ack(msg)
+            finally:
+                self._queue.task_done()
+
+    async def _watch(self):
+        interval = self._idle_heartbeat / 1e9
+        while True:
+            await asyncio.sleep(interval)
+            if self._queue.full() or self.stalled:
+                # Busy workers hold back heartbeats as well
+                continue
+            if time.monotonic() - self.last_activity > 2 * interval:
+                self.stalled = True
+                await self._utility.error_cb(
+                    ConsumerStalled(self.stream, self.consumer)
+                )
@@ -0,0 +1,219 @@
+from guillotina_nats.exceptions import RPCError
+from guillotina_nats.exceptions import RPCTimeout
+from guillotina_nats.utility import NatsUtility
+from nats.aio.errors import ErrTimeout
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("guillotina_nats")
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float, error: bool):
+        self.requests += 1
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        if error:
+            self.errors += 1
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_seconds": self.seconds / self.requests if self.requests else 0,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class Service(object):
+    """Request/reply endpoints on <name>.<endpoint> subjects, every
+    instance subscribes with the same queue group so requests are spread
+    between them. Replies are JSON {"result": ...} or {"error": {"code",
+    "type", "message"}}, raise RPCError for a specific code"""
+
+    def __init__(
+        self,
+        name: str,
+        group: Optional[str] = None,
+        max_workers: int = 16,
+        serializer="json",
+        pending_msgs_limit: Optional[int] = None,
+    ):
+        self.name = name
+        self.group = name if group is None else group
+        self.max_workers = max_workers
+        self.serializer = serializer
+        self.pending_msgs_limit = pending_msgs_limit
+        self._endpoints: Dict = {}
+        self._stats: Dict[str, EndpointStats] = {}
+        self._sids: List[Any] = []
+        self._utility: Optional[NatsUtility] = None
+
+    def endpoint(self, name: str):
+        """Register the decorated coroutine as the name endpoint handler, it
+        receives the decoded request and returns the result"""
+
+        def register(handler):
+            self._endpoints[name] = handler
+            self._stats[name] = EndpointStats()
+            return handler
+
+        return register
+
+    def subject(self, endpoint: str):
+        return f"{self.name}.{endpoint}"
+
+    async def start(self, utility):
+        self._utility = utility
+        for name, handler in self._endpoints.items():
+            sid = await utility.subscribe(
+                self._callback(utility, name, handler),
+                self.subject(name),
+                group=self.group,
+                concurrency=self.max_workers,
+                overflow="block",
+                pending_msgs_limit=self.pending_msgs_limit,
+            )
+            self._sids.append(sid)
+
+    async def stop(self):
+        """Stop taking requests and wait for the running ones"""
+        if self._utility is not None:
+            for sid in self._sids:
+                await self._utility.unsubscribe(sid)
+        self._sids = []
+
+    def stats(self):
+        return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+    def _callback(self, utility: NatsUtility, name: str, handler):
+        serializer = utility._serializers.get(self.serializer)
+        codec = utility._codec
+        metrics = utility._metrics
+        stats = self._stats[name]
+        subject = self.subject(name)
+
+        async def callback(msg):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = await handler(serializer.loads(msg.data))
+                response = codec.dumps({"result": result})
+                failed = False
+            except RPCError as error:
+                response = codec.dumps({"error": error.as_dict()})
+            except Exception as error:
+                logger.exception(f"Error handling {subject} request")
+                response = codec.dumps(
+                    {
+                        "error": {
+                            "code": 500,
+                            "type": error.__class__.__name__,
+                            "message": str(error),
+                        }
+                    }
+                )
+            seconds = time.perf_counter() - start
+            stats.record(seconds, failed)
+            if metrics is not None:
+                metrics.observe("rpc", seconds, endpoint=subject)
+                if failed:
+                    metrics.inc("rpc_errors", endpoint=subject)
+            if msg.reply:
+                await utility.publish(msg.reply, response)
+
+        return callback
+
+
+class RPCClient(object):
+    """Calls the endpoints of a service. Timeouts are retried up to retries
+    times, with hedge_after a second request is sent when there is no
+    reply after that many seconds and the first reply wins, which usually
+    goes to another member of the queue group"""
+
+    def __init__(
+        self,
+        utility,
+        service: str,
+        timeout: Optional[float] = None,
+        retries: int = 0,
+        retry_backoff: float = 0.1,
+        hedge_after: Optional[float] = None,
+        serializer="json",
+    ):
+        self._utility = utility
+        self.service = service
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.hedge_after = hedge_after
+        self.serializer = serializer
+
+    async def call(self, endpoint: str, request=None, model=None):
+        subject = f"{self.service}.{endpoint}"
+        payload = self._utility._encode(request, self.serializer)
+        timeout = self.timeout or self._utility._timeout
+        for attempt in range(self.retries + 1):
+            try:
+                msg = await self._request(subject, payload, timeout)
+                break
+            except ErrTimeout:
+                if attempt == self.retries:
+                    raise RPCTimeout(subject)
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+        data = msg.data
+        if self._utility._compressor is not None:
+            data = self._utility._compressor.decompress(data)
+        response = self._utility._codec.loads(data)
+        if "error" in response:
+            error = response["error"]
+            raise RPCError(error["code"], error["message"], error.get("type"))
+        if model is not None:
+            return model.parse_obj(response["result"])
+        return response["result"]
+
+    async def _request(self, subject: str, payload, timeout: float):
+        # Through the utility for its connection routing and request metrics
+        if self.hedge_after is None or self.hedge_after >= timeout:
+            return await self._send(subject, payload, timeout)
+        first = asyncio.ensure_future(self._send(subject, payload, timeout))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        hedge = asyncio.ensure_future(
+            self._send(subject, payload, timeout - self.hedge_after)
+        )
+        pending = {first, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+            # Neither got a reply, raises the error of the first one
+            return first.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _send(self, subject: str, payload, timeout: float):
+        msg = await self._utility.request(subject, payload, timeout)
+        if msg is None:
+            # The utility returns None on timeouts
+            raise ErrTimeout
+        return msg
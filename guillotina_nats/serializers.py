@@ -0,0 +1,124 @@
+from guillotina_nats.codecs import JSONCodec
+from pydantic import BaseModel
+from typing import Dict
+from typing import Type
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Message(object):
+    """Received message with its payload decoded by a serializer, any other
+    attribute is the one of the NATS or STAN message it wraps"""
+
+    __slots__ = ("msg", "value")
+
+    def __init__(self, msg, value):
+        self.msg = msg
+        self.value = value
+
+    def __getattr__(self, name):
+        return getattr(self.msg, name)
+
+    def __repr__(self):
+        return f"<Message: subject='{self.msg.subject}' value={self.value!r}>"
+
+
+class RawSerializer(object):
+    """Payload as is, buffers are passed through without copying them"""
+
+    name = "raw"
+
+    def dumps(self, obj):
+        if isinstance(obj, str):
+            return obj.encode()
+        if isinstance(obj, memoryview) and (obj.ndim != 1 or obj.format != "B"):
+            return obj.cast("B")
+        return obj
+
+    def loads(self, data):
+        return data
+
+
+class JSONSerializer(object):
+    name = "json"
+
+    def __init__(self, codec: JSONCodec):
+        self._codec = codec
+
+    def dumps(self, obj):
+        return self._codec.dumps(obj)
+
+    def loads(self, data):
+        return self._codec.loads(data)
+
+
+class MsgpackSerializer(object):
+    name = "msgpack"
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        # unpackb reads straight from any buffer
+        return msgpack.unpackb(data, raw=False)
+
+
+class PydanticSerializer(object):
+    """JSON encoded pydantic model"""
+
+    def __init__(self, model: Type[BaseModel], codec: JSONCodec):
+        self.name = model.__name__
+        self._model = model
+        self._codec = codec
+
+    def dumps(self, obj):
+        return self._codec.dumps(obj.dict())
+
+    def loads(self, data):
+        return self._model.parse_obj(self._codec.loads(data))
+
+
+class SerializerRegistry(object):
+    """Serializers by name, pydantic models can be used directly as the
+    serializer of their own payloads"""
+
+    def __init__(self, codec: JSONCodec):
+        self._codec = codec
+        self._serializers: Dict = {}
+        self.register("raw", RawSerializer())
+        self.register("json", JSONSerializer(codec))
+        if msgpack is not None:
+            self.register("msgpack", MsgpackSerializer())
+
+    def register(self, name, serializer):
+        self._serializers[name] = serializer
+
+    def get(self, serializer):
+        if not isinstance(serializer, str) and hasattr(serializer, "loads"):
+            return serializer
+        try:
+            return self._serializers[serializer]
+        except KeyError:
+            pass
+        if isinstance(serializer, type) and issubclass(serializer, BaseModel):
+            self._serializers[serializer] = PydanticSerializer(serializer, self._codec)
+            return self._serializers[serializer]
+        raise ValueError(f"Serializer {serializer} is not registered")
+
+    def dumps(self, serializer, obj):
+        return self.get(serializer).dumps(obj)
+
+    def loads(self, serializer, msg) -> Message:
+        return Message(msg, self.get(serializer).loads(msg.data))
+
+    def wrap(self, handler, serializer):
+        """Subscription callback receiving decoded messages"""
+        serializer = self.get(serializer)
+
+        async def callback(msg):
+            await handler(Message(msg, serializer.loads(msg.data)))
+
+        return callback
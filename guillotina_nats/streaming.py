@@ -0,0 +1,575 @@
+from collections import deque
+from guillotina_nats.acks import AckBuffer
+from guillotina_nats.exceptions import StanPublishError
+from nats.aio.errors import ErrConnectionClosed
+from nats.aio.errors import ErrTimeout
+from stan.aio.client import Client as STAN
+from stan.aio.errors import StanError
+from stan.pb import protocol_pb2 as protocol
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Optional
+
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger("guillotina_nats")
+
+
+class StanPublisher(object):
+    """Pipelined NATS Streaming publishes resolved on ack. Up to
+    max_inflight publishes wait for their ack at once, a publish without
+    ack after ack_wait seconds is sent again up to retries times, so
+    subscribers may see duplicates.
+
+    While the session is reconnecting publishes are kept in order in a
+    buffer of up to buffer_max_messages/buffer_max_bytes, publishers wait
+    once it is full. Unacknowledged messages are sent again on reconnect"""
+
+    def __init__(
+        self,
+        utility,
+        max_inflight: int = 1024,
+        ack_wait=30,
+        retries=3,
+        buffer_max_messages: int = 8192,
+        buffer_max_bytes: int = 8388608,
+    ):
+        self._utility = utility
+        self.max_inflight = max_inflight
+        self.ack_wait = ack_wait
+        self.retries = retries
+        self.buffer_max_messages = buffer_max_messages
+        self.buffer_max_bytes = buffer_max_bytes
+        self._window = asyncio.Semaphore(max_inflight)
+        # future: [subject, payload, attempt, send task]
+        self._pending: Dict[asyncio.Future, list] = {}
+        self._buffer: Deque = deque()
+        self.buffered_bytes = 0
+        self._room = asyncio.Event()
+        self._room.set()
+        self._draining: Optional[asyncio.Future] = None
+        self._started = time.monotonic()
+        self.published = 0
+        self.acked = 0
+        self.retried = 0
+        self.failed = 0
+        self._latency = [0, 0.0, 0.0]
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def connected(self):
+        session = self._utility._stan_session
+        return session is not None and session.connected
+
+    @property
+    def full(self):
+        if len(self._buffer) >= self.buffer_max_messages:
+            return True
+        return self.buffered_bytes >= self.buffer_max_bytes
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started
+        count, seconds, maximum = self._latency
+        return {
+            "published": self.published,
+            "acked": self.acked,
+            "retried": self.retried,
+            "failed": self.failed,
+            "inflight": len(self._pending),
+            "buffered": len(self._buffer),
+            "buffered_bytes": self.buffered_bytes,
+            "acks_per_second": self.acked / elapsed if elapsed else 0,
+            "avg_ack_seconds": seconds / count if count else 0,
+            "max_ack_seconds": maximum,
+        }
+
+    async def publish(self, subject: str, payload: bytes) -> asyncio.Future:
+        """Send the message and return a future resolved with the PubAck,
+        waits while max_inflight publishes are unacknowledged or the
+        reconnection buffer is full"""
+        future = asyncio.get_event_loop().create_future()
+        if self._buffer or not self.connected:
+            while self.full:
+                self._room.clear()
+                await self._room.wait()
+        if self._buffer or not self.connected:
+            # Sent in order once reconnected
+            self._buffer.append((future, subject, payload))
+            self.buffered_bytes += len(payload)
+            self.published += 1
+            return future
+        await self._window.acquire()
+        self._track(future, subject, payload)
+        self._start(future, 0)
+        self.published += 1
+        return future
+
+    async def complete(self):
+        """Wait for the acks of every pending and buffered publish"""
+        futures = set(self._pending)
+        futures.update(future for future, _, _ in self._buffer)
+        if futures:
+            await asyncio.wait(futures)
+
+    def resume(self):
+        """Send again the unacknowledged messages and the buffered ones,
+        called by the session once reconnected"""
+        for future, entry in list(self._pending.items()):
+            # Waiting for an ack from the previous connection
+            if entry[3] is not None:
+                entry[3].cancel()
+            self.retried += 1
+            self._start(future, entry[2])
+        if self._buffer and self._draining is None:
+            self._draining = asyncio.ensure_future(self._drain())
+
+    def fail(self, error: Exception):
+        """Fail every pending and buffered publish"""
+        for future, entry in list(self._pending.items()):
+            if entry[3] is not None:
+                entry[3].cancel()
+            if not future.done():
+                future.set_exception(error)
+        while self._buffer:
+            future, _, payload = self._buffer.popleft()
+            self.buffered_bytes -= len(payload)
+            if not future.done():
+                future.set_exception(error)
+        self._room.set()
+
+    async def _drain(self):
+        try:
+            while self._buffer and self.connected:
+                future, subject, payload = self._buffer[0]
+                if not future.done():
+                    await self._window.acquire()
+                    if not self.connected:
+                        # Lost again, kept for the next resume
+                        self._window.release()
+                        break
+                self._buffer.popleft()
+                self.buffered_bytes -= len(payload)
+                self._room.set()
+                if future.done():
+                    # Cancelled while buffered
+                    continue
+                self._track(future, subject, payload)
+                self._start(future, 0)
+        finally:
+            self._draining = None
+
+    def _track(self, future, subject: str, payload: bytes):
+        self._pending[future] = [subject, payload, 0, None]
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        # The send task is left to finish, the client removes its ack
+        # handler once the ack arrives or ack_wait expires
+        if self._pending.pop(future, None) is not None:
+            self._window.release()
+
+    def _start(self, future, attempt: int):
+        entry = self._pending[future]
+        entry[2] = attempt
+        # Tasks start in order, so messages are written in publish order
+        entry[3] = asyncio.ensure_future(self._send(future, entry))
+
+    async def _send(self, future, entry: list):
+        subject, payload, attempt = entry[0], entry[1], entry[2]
+        start = time.perf_counter()
+        try:
+            ack = await self._utility.sc.publish(
+                subject, payload, ack_wait=self.ack_wait
+            )
+        except asyncio.TimeoutError:
+            self._expired(future, entry, attempt)
+            return
+        except Exception as error:
+            if not future.done():
+                self.failed += 1
+                future.set_exception(error)
+            return
+        if future.done():
+            # Cancelled while waiting for the ack
+            return
+        if ack.error:
+            self.failed += 1
+            future.set_exception(StanPublishError(subject, ack.error))
+            return
+        self._acked(time.perf_counter() - start)
+        future.set_result(ack)
+
+    def _expired(self, future, entry: list, attempt: int):
+        if future.done() or self._pending.get(future) is not entry:
+            return
+        entry[3] = None
+        if not self.connected:
+            # Sent again by resume
+            return
+        if attempt >= self.retries:
+            self.failed += 1
+            logger.error(f"No ack for message published to {entry[0]}")
+            future.set_exception(StanPublishError(entry[0], "ack timeout"))
+            return
+        self.retried += 1
+        if self._utility._metrics is not None:
+            self._utility._metrics.inc("stan_publish_retries")
+        self._start(future, attempt + 1)
+
+    def _acked(self, seconds: float):
+        self.acked += 1
+        self._latency[0] += 1
+        self._latency[1] += seconds
+        if seconds > self._latency[2]:
+            self._latency[2] = seconds
+        if self._utility._metrics is not None:
+            self._utility._metrics.observe("stan_ack", seconds)
+
+
+class StreamSubscription(object):
+    """NATS Streaming subscription restored by the session after a
+    reconnection. Durable subscriptions resume where the server left them,
+    the others at the message after the last one received"""
+
+    def __init__(self, subject: str, handler, params: Dict):
+        self.subject = subject
+        self.handler = handler
+        self.params = params
+        self.sub = None
+        self.last_sequence = 0
+        self._session: Optional["StanSession"] = None
+
+    def __getattr__(self, name):
+        # Subscription attributes like pending_queue_size
+        sub = self.__dict__.get("sub")
+        if sub is None:
+            raise AttributeError(name)
+        return getattr(sub, name)
+
+    @property
+    def durable_name(self):
+        return self.params.get("durable_name")
+
+    async def _callback(self, msg):
+        self.last_sequence = msg.proto.sequence
+        await self.handler(msg)
+
+    async def start(self, sc):
+        params = self.params
+        if self.last_sequence and self.durable_name is None:
+            params = {
+                name: value
+                for name, value in params.items()
+                if name not in ("deliver_all_available", "time")
+            }
+            params["start_at"] = "sequence"
+            params["sequence"] = self.last_sequence + 1
+        self.sub = await sc.subscribe(self.subject, cb=self._callback, **params)
+
+    async def unsubscribe(self):
+        """Remove the subscription, durable ones forget their position"""
+        await self._session.remove(self, "unsubscribe")
+
+    async def close(self):
+        """Remove the subscription, durable ones keep their position"""
+        await self._session.remove(self, "close")
+
+
+class StanSession(object):
+    """Supervised NATS Streaming connection over the utility main NATS
+    connection. A connection lost after ping_max_out unanswered pings is
+    reopened with the same client id, waiting from timeout up to
+    ping_interval * ping_max_out seconds between attempts, the stream
+    subscriptions are created again and the publisher resumed"""
+
+    def __init__(
+        self,
+        utility,
+        cluster_id: str,
+        client_id: str,
+        ping_interval: int = 5,
+        ping_max_out: int = 3,
+        timeout: float = 2,
+        max_pub_acks_inflight: int = 1024,
+    ):
+        self._utility = utility
+        self.cluster_id = cluster_id
+        self.client_id = client_id
+        self.ping_interval = ping_interval
+        self.ping_max_out = ping_max_out
+        self.timeout = timeout
+        self.max_pub_acks_inflight = max_pub_acks_inflight
+        self.connected = False
+        self._connected = asyncio.Event()
+        self._reconnecting: Optional[asyncio.Future] = None
+        self._closing = False
+        self.disconnects = 0
+        self.reconnects = 0
+        self.last_error: Optional[str] = None
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "disconnects": self.disconnects,
+            "reconnects": self.reconnects,
+            "subscriptions": len(self._utility._stream_subscriptions),
+            "last_error": self.last_error,
+        }
+
+    async def connect(self):
+        retries = self._utility._stan_publisher.retries
+        sc = STAN()
+        await sc.connect(
+            self.cluster_id,
+            self.client_id,
+            nats=self._utility.nc,
+            ping_interval=self.ping_interval,
+            ping_max_out=self.ping_max_out,
+            connect_timeout=self.timeout,
+            conn_lost_cb=self._lost,
+            # The client frees a slot when an ack arrives, late acks of
+            # retried sends included, so every send of the publisher window
+            # gets one. Acks never received hold theirs until reconnected.
+            max_pub_acks_inflight=self.max_pub_acks_inflight * (retries + 1),
+        )
+        try:
+            for subscription in self._utility._stream_subscriptions:
+                await subscription.start(sc)
+        except BaseException:
+            await self._close(sc)
+            raise
+        self._utility.sc = sc
+        self.connected = True
+        self._connected.set()
+        self._utility._stan_publisher.resume()
+
+    async def wait_connected(self, timeout: Optional[float] = None):
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def subscribe(self, subject: str, handler, params: Dict):
+        """Subscription kept for reconnections, created when reconnected if
+        the session is down"""
+        subscription = StreamSubscription(subject, handler, params)
+        subscription._session = self
+        if self.connected:
+            await subscription.start(self._utility.sc)
+        self._utility._stream_subscriptions.append(subscription)
+        return subscription
+
+    async def remove(self, subscription: StreamSubscription, how: str):
+        self._utility._stream_subscriptions.remove(subscription)
+        if self.connected and subscription.sub is not None:
+            await getattr(subscription.sub, how)()
+
+    async def close(self):
+        self._closing = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self.connected:
+            self.connected = False
+            self._connected.clear()
+            await self._close(self._utility.sc)
+
+    async def _close(self, sc):
+        try:
+            await sc.close()
+        except (ErrConnectionClosed, ErrTimeout, StanError):
+            pass
+
+    async def _lost(self, error):
+        # Called from the client ping task, which is already cancelled
+        self.connected = False
+        self._connected.clear()
+        self.disconnects += 1
+        self.last_error = str(error)
+        logger.warning(f"Lost stan connection: {error}")
+        metrics = self._utility._metrics
+        if metrics is not None:
+            metrics.inc("stan_disconnects")
+        if not self._closing and self._reconnecting is None:
+            self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.timeout
+        max_delay = max(self.ping_interval * self.ping_max_out, self.timeout)
+        try:
+            while not self._closing:
+                # Jitter so the instances of a deployment spread their attempts
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+                try:
+                    await self.connect()
+                except (ErrConnectionClosed, ErrTimeout, StanError) as error:
+                    # The server refuses the client id until it finds the
+                    # previous connection dead
+                    self.last_error = str(error)
+                    logger.warning(f"Could not reconnect to stan: {error}")
+                    delay = min(delay * 2, max_delay)
+                    continue
+                self.reconnects += 1
+                logger.info("Reconnected to stan")
+                if self._utility._metrics is not None:
+                    self._utility._metrics.inc("stan_reconnects")
+                break
+        finally:
+            self._reconnecting = None
+
+
+class StanConsumer(object):
+    """NATS Streaming subscription with manual acks running up to
+    max_inflight handlers at once. A message is acked once its handler
+    returns, acks are published in batches of ack_batch or every
+    ack_interval seconds, failed messages are left for the server to
+    redeliver after ack_wait.
+
+    With ordered_by, a callable returning the key of a decoded message,
+    the messages of a key are handled one at a time in delivery order"""
+
+    def __init__(
+        self,
+        utility,
+        subject: str,
+        handler,
+        max_inflight: int = 16,
+        ordered_by: Optional[Callable] = None,
+        serializer=None,
+        ack_batch: Optional[int] = None,
+        ack_interval: float = 0.05,
+    ):
+        self._utility = utility
+        self.subject = subject
+        self.max_inflight = max_inflight
+        self.ordered_by = ordered_by
+        self.ack_batch = ack_batch or max(1, max_inflight // 2)
+        self._acks = AckBuffer(
+            self._publish_ack, flush_interval=ack_interval, flush_size=self.ack_batch
+        )
+        self._handler = handler
+        if utility._metrics is not None:
+            self._handler = utility._timed_handler(handler, subject)
+        # Decoded before dispatching so ordered_by sees the value
+        self._callback = self._dispatch
+        if serializer is not None:
+            self._callback = utility._serializers.wrap(self._callback, serializer)
+        if utility._compressor is not None:
+            self._callback = utility._compressor.wrap(self._callback)
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._tasks: set = set()
+        self._last: Dict = {}
+        self.subscription: Optional[StreamSubscription] = None
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.redelivered = 0
+        self.waiting = 0
+        self.last_sequence = 0
+        self._lag = [0, 0.0, 0.0]
+
+    def stats(self):
+        count, seconds, maximum = self._lag
+        return {
+            "subject": self.subject,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "redelivered": self.redelivered,
+            "active": len(self._tasks) - self.waiting,
+            "waiting": self.waiting,
+            "pending_acks": len(self._acks),
+            "last_sequence": self.last_sequence,
+            "avg_lag_seconds": seconds / count if count else 0,
+            "max_lag_seconds": maximum,
+        }
+
+    async def start(self, session: "StanSession", params: Dict):
+        params = dict(params, manual_acks=True)
+        # Room for the acks waiting in the buffer so the server keeps
+        # delivering while a batch fills
+        params["max_inflight"] = self.max_inflight + self.ack_batch
+        self.subscription = await session.subscribe(
+            self.subject, self._callback, params
+        )
+
+    async def stop(self, close: bool = False):
+        """Stop receiving, wait for the running handlers and flush the acks.
+        close keeps the position of durable subscriptions"""
+        if self.subscription is not None:
+            if close:
+                await self.subscription.close()
+            else:
+                await self.subscription.unsubscribe()
+            self.subscription = None
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        await self._acks.close()
+
+    async def _dispatch(self, msg):
+        # Called in order by the client subscription task, waiting here
+        # leaves the next messages in the client queue
+        await self._slots.acquire()
+        self.received += 1
+        proto = msg.proto
+        self.last_sequence = proto.sequence
+        if proto.redelivered:
+            self.redelivered += 1
+            if self._utility._metrics is not None:
+                self._utility._metrics.inc("stan_redeliveries", subject=self.subject)
+        previous = key = None
+        if self.ordered_by is not None:
+            key = self.ordered_by(msg)
+            previous = self._last.get(key)
+        task = asyncio.ensure_future(self._run(msg, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if self.ordered_by is not None:
+            self._last[key] = task
+            task.add_done_callback(lambda task: self._forget(key, task))
+
+    def _forget(self, key, task):
+        if self._last.get(key) is task:
+            del self._last[key]
+
+    async def _run(self, msg, previous):
+        try:
+            if previous is not None:
+                self.waiting += 1
+                try:
+                    await asyncio.wait({previous})
+                finally:
+                    self.waiting -= 1
+            self._observe_lag(time.time() - msg.proto.timestamp / 1e9)
+            try:
+                await self._handler(msg)
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Error handling message {self.subject}")
+                return
+            self.processed += 1
+            ack = protocol.Ack()
+            ack.subject = msg.proto.subject
+            ack.sequence = msg.proto.sequence
+            await self._acks.add(msg.sub.ack_inbox, ack.SerializeToString())
+        finally:
+            self._slots.release()
+
+    async def _publish_ack(self, ack_inbox: str, payload: bytes):
+        # Raw protocol buffers on the connection of the STAN client, never
+        # compressed nor counted as core publishes
+        nc = self._utility.nc
+        if nc.is_connected:
+            await nc.publish(ack_inbox, payload)
+        else:
+            raise ErrConnectionClosed("Could not acknowledge")
+
+    def _observe_lag(self, seconds: float):
+        self._lag[0] += 1
+        self._lag[1] += seconds
+        if seconds > self._lag[2]:
+            self._lag[2] = seconds
+        if self._utility._metrics is not None:
+            self._utility._metrics.observe("stan_lag", seconds, subject=self.subject)
@@ -0,0 +1,171 @@
+from collections import deque
+from enum import Enum
+from nats.aio.errors import ErrSlowConsumer
+from typing import Deque
+from typing import List
+
+import asyncio
+import logging
+
+logger = logging.getLogger("guillotina_nats")
+
+DEFAULT_PENDING_MSGS_LIMIT = 65536
+DEFAULT_PENDING_BYTES_LIMIT = 64 * 1024 * 1024
+
+
+class Overflow(str, Enum):
+    drop_oldest = "drop_oldest"
+    drop_newest = "drop_newest"
+    block = "block"
+
+
+class BoundedSubscription(object):
+    """Core NATS subscription with pending message and byte limits, an
+    overflow policy and up to concurrency handlers running at once.
+
+    drop_newest and drop_oldest keep the pending messages here and drop
+    when the limits are reached, block waits for a free handler and leaves
+    the pending messages in the client queue, which drops new messages
+    once the limits are reached. Drops are reported once per slow period
+    to the utility error_cb with ErrSlowConsumer"""
+
+    def __init__(
+        self,
+        utility,
+        key: str,
+        handler,
+        group: str = "",
+        pending_msgs_limit: int = DEFAULT_PENDING_MSGS_LIMIT,
+        pending_bytes_limit: int = DEFAULT_PENDING_BYTES_LIMIT,
+        overflow: Overflow = Overflow.drop_newest,
+        concurrency: int = 1,
+    ):
+        self._utility = utility
+        self._handler = handler
+        self.key = key
+        self.group = group
+        self.pending_msgs_limit = pending_msgs_limit
+        self.pending_bytes_limit = pending_bytes_limit
+        self.overflow = Overflow(overflow)
+        self.concurrency = concurrency
+        self.sid = None
+        self._pending: Deque = deque()
+        self.pending_bytes = 0
+        self._available = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._workers: List[asyncio.Task] = []
+        self._tasks: set = set()
+        self._closing = False
+        self.active = 0
+        self.dropped = 0
+        self.slow = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def start(self, nc):
+        if self.overflow == Overflow.block:
+            self.sid = await nc.subscribe(
+                self.key,
+                queue=self.group,
+                cb=self._dispatch,
+                pending_msgs_limit=self.pending_msgs_limit,
+                pending_bytes_limit=self.pending_bytes_limit,
+            )
+        else:
+            self.sid = await nc.subscribe(self.key, queue=self.group, cb=self._process)
+            self._workers = [
+                asyncio.ensure_future(self._work()) for _ in range(self.concurrency)
+            ]
+        return self.sid
+
+    async def stop(self):
+        """Wait for the pending messages, the subscription must be
+        unsubscribed first"""
+        self._closing = True
+        self._available.set()
+        if self._workers:
+            await asyncio.gather(*self._workers)
+            self._workers = []
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def stats(self):
+        return {
+            "subject": self.key,
+            "group": self.group,
+            "overflow": self.overflow.value,
+            "pending_msgs": len(self._pending),
+            "pending_bytes": self.pending_bytes,
+            "active": self.active,
+            "dropped": self.dropped,
+            "slow": self.slow,
+        }
+
+    async def _handle(self, msg):
+        self.active += 1
+        try:
+            await self._handler(msg)
+        except Exception:
+            logger.exception("Error handling message " + msg.subject)
+        finally:
+            self.active -= 1
+
+    async def _dispatch(self, msg):
+        # Called in order by the client subscription task, waiting here keeps
+        # the next messages in the client queue
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._run(msg))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, msg):
+        try:
+            await self._handle(msg)
+        finally:
+            self._semaphore.release()
+
+    def _full(self, size: int):
+        if len(self._pending) >= self.pending_msgs_limit:
+            return True
+        return self.pending_bytes + size > self.pending_bytes_limit
+
+    async def _process(self, msg):
+        size = len(msg.data)
+        dropped = 0
+        if self.overflow == Overflow.drop_oldest:
+            while self._pending and self._full(size):
+                oldest = self._pending.popleft()
+                self.pending_bytes -= len(oldest.data)
+                dropped += 1
+        if self._full(size):
+            dropped += 1
+        else:
+            self._pending.append(msg)
+            self.pending_bytes += size
+            self._available.set()
+        if dropped:
+            await self._dropped(dropped)
+
+    async def _dropped(self, count: int):
+        self.dropped += count
+        if self._utility._metrics is not None:
+            self._utility._metrics.inc("dropped_messages", count, subject=self.key)
+        if not self.slow:
+            self.slow = True
+            await self._utility.error_cb(
+                ErrSlowConsumer(subject=self.key, sid=self.sid)
+            )
+
+    async def _work(self):
+        while True:
+            while not self._pending:
+                if self._closing:
+                    return
+                # Caught up
+                self.slow = False
+                self._available.clear()
+                await self._available.wait()
+            msg = self._pending.popleft()
+            self.pending_bytes -= len(msg.data)
+            await self._handle(msg)
@@ -0,0 +1,206 @@
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import json
+import logging
+import os
+import selectors
+import signal
+import time
+
+logger = logging.getLogger("guillotina_nats")
+
+
+class WorkerProcess(object):
+    def __init__(self, slot: int, pid: int, fd: int):
+        self.slot = slot
+        self.pid = pid
+        self.fd = fd
+        self.buffer = b""
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.stats: Dict = {}
+        self.rate = 0.0
+        self.restarts = 0
+        # When it was sent SIGTERM for not reporting
+        self.terminated: Optional[float] = None
+
+    @staticmethod
+    def handled(stats: Dict):
+        return stats.get("processed", 0) + stats.get("requests", 0)
+
+    def report(self, stats: Dict):
+        now = time.monotonic()
+        handled = self.handled(stats) - self.handled(self.stats)
+        self.rate = handled / (now - self.last_report)
+        self.stats = stats
+        self.last_report = now
+
+
+class Supervisor(object):
+    """Fork processes each running worker(fd, slot), a callable writing JSON
+    stats lines to fd, slot being the process number kept on restarts. The
+    throughput is the processed tasks and requests, totals include the
+    processes that exited. Processes that exit or do not report for three
+    intervals are started again, those not reporting get SIGTERM and are
+    killed after stop_timeout seconds. SIGTERM and SIGINT are forwarded and
+    the processes waited for up to stop_timeout seconds"""
+
+    def __init__(
+        self,
+        worker: Callable[[int, int], None],
+        processes: int,
+        interval: float = 10,
+        stop_timeout: float = 60,
+    ):
+        self.worker = worker
+        self.processes = processes
+        self.interval = interval
+        self.stop_timeout = stop_timeout
+        self._workers: Dict[int, WorkerProcess] = {}
+        self._restarts: Dict[int, int] = {}
+        # Counters of the processes that exited
+        self._exited: Dict[str, int] = {}
+        self._selector = selectors.DefaultSelector()
+        self._stopping: Optional[float] = None
+
+    def _spawn(self, slot: int):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self._selector.close()
+            for process in self._workers.values():
+                os.close(process.fd)
+            code = 0
+            try:
+                self.worker(write_fd, slot)
+            except BaseException:
+                logger.exception(f"Worker {slot} failed")
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        process = WorkerProcess(slot, pid, read_fd)
+        process.restarts = self._restarts.get(slot, 0)
+        self._workers[pid] = process
+        self._selector.register(read_fd, selectors.EVENT_READ, process)
+        logger.info(f"Started worker {slot} pid {pid}")
+
+    def _stop(self, signum, frame):
+        if self._stopping is None:
+            self._stopping = time.monotonic()
+            logger.info("Stopping workers")
+            for pid in self._workers:
+                os.kill(pid, signal.SIGTERM)
+
+    def _read(self, process: WorkerProcess):
+        try:
+            data = os.read(process.fd, 65536)
+        except BlockingIOError:
+            return
+        process.buffer += data
+        *lines, process.buffer = process.buffer.split(b"\n")
+        for line in lines:
+            try:
+                process.report(json.loads(line))
+            except ValueError:
+                logger.warning(f"Invalid stats from worker {process.slot}")
+
+    def _reap(self):
+        while self._workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            process = self._workers.pop(pid, None)
+            if process is None:
+                continue
+            self._read(process)
+            self._selector.unregister(process.fd)
+            os.close(process.fd)
+            for key in ("processed", "failed", "dead", "requests"):
+                self._exited[key] = self._exited.get(key, 0) + process.stats.get(key, 0)
+            if self._stopping is not None:
+                logger.info(f"Worker {process.slot} stopped {process.stats}")
+                continue
+            logger.warning(
+                f"Worker {process.slot} pid {pid} exited with status {status}"
+            )
+            if time.monotonic() - process.started < 1:
+                # Do not restart in a tight loop when failing on start
+                time.sleep(1)
+            self._restarts[process.slot] = process.restarts + 1
+            self._spawn(process.slot)
+
+    def _check(self):
+        now = time.monotonic()
+        for process in self._workers.values():
+            if process.terminated is not None:
+                if now - process.terminated > self.stop_timeout:
+                    logger.warning(
+                        f"Worker {process.slot} pid {process.pid} did not stop, "
+                        "killing it"
+                    )
+                    os.kill(process.pid, signal.SIGKILL)
+                    # Not killed again until it is started again
+                    process.terminated = None
+                    process.last_report = now
+            elif now - process.last_report > 3 * self.interval:
+                logger.warning(
+                    f"Worker {process.slot} pid {process.pid} is not reporting"
+                )
+                # Let it close its connections and give back its messages
+                os.kill(process.pid, signal.SIGTERM)
+                process.terminated = now
+
+    def stats(self):
+        workers: List[Dict] = []
+        keys = ("processed", "failed", "dead", "running", "requests")
+        totals: Dict = dict.fromkeys(keys, 0)
+        totals.update(self._exited)
+        totals["rate"] = 0.0
+        now = time.monotonic()
+        for process in sorted(self._workers.values(), key=lambda p: p.slot):
+            workers.append(
+                dict(
+                    process.stats,
+                    slot=process.slot,
+                    pid=process.pid,
+                    rate=process.rate,
+                    restarts=process.restarts,
+                    healthy=now - process.last_report <= 3 * self.interval,
+                )
+            )
+            for key in keys:
+                totals[key] += process.stats.get(key, 0)
+            totals["rate"] += process.rate
+        return dict(totals, workers=workers)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(self.processes):
+            self._spawn(slot)
+        next_report = time.monotonic() + self.interval
+        while self._workers:
+            for key, _ in self._selector.select(timeout=min(self.interval, 1)):
+                self._read(key.data)
+            self._reap()
+            now = time.monotonic()
+            if self._stopping is not None:
+                if now - self._stopping > self.stop_timeout:
+                    logger.warning("Workers did not stop in time, killing them")
+                    for pid in self._workers:
+                        os.kill(pid, signal.SIGKILL)
+                    self._stopping = now
+                continue
+            self._check()
+            if now >= next_report:
+                next_report = now + self.interval
+                logger.info(f"Workers stats {json.dumps(self.stats())}")
+        self._selector.close()
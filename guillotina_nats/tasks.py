@@ -0,0 +1,303 @@
+from guillotina.component import get_utility
+from guillotina_nats.exceptions import JetStreamError
+from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.models import AckPolicy
+from guillotina_nats.models import ConsumerConfig
+from guillotina_nats.models import PubAck
+from guillotina_nats.models import RetentionPolicy
+from guillotina_nats.models import Storage
+from guillotina_nats.models import StreamConfig
+from guillotina_nats.rpc import EndpointStats
+from guillotina_nats.utility import ack_metadata
+from guillotina_nats.utility import NatsUtility
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("guillotina_nats")
+
+_queues: Dict[str, "TaskQueue"] = {}
+
+
+def get_queue(name: str) -> "TaskQueue":
+    return _queues[name]
+
+
+def get_queues() -> List["TaskQueue"]:
+    return list(_queues.values())
+
+
+class TaskQueue(object):
+    """Tasks of a JetStream workqueue stream, <name> on tasks.<name>.<task>
+    subjects, pulled by the workers through the durable consumer "workers".
+    A task is retried with an exponential delay from retry_backoff up to
+    retry_backoff_max seconds and, once max_deliver deliveries failed,
+    stored in the <name>_DLQ stream"""
+
+    def __init__(
+        self,
+        name: str,
+        max_deliver: int = 5,
+        ack_wait: float = 30,
+        retry_backoff: float = 1,
+        retry_backoff_max: float = 60,
+        storage: Storage = Storage.file,
+        serializer="json",
+    ):
+        if "." in name:
+            raise ValueError(f"Invalid queue name {name}")
+        self.name = name
+        self.stream = name
+        self.consumer = "workers"
+        self.dead_letter_stream = f"{name}_DLQ"
+        self.max_deliver = max_deliver
+        self.ack_wait = ack_wait
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.storage = storage
+        self.serializer = serializer
+        self._tasks: Dict[str, Callable] = {}
+        self._names: Dict[Callable, str] = {}
+        self._stats: Dict[str, EndpointStats] = {}
+        self._utility: Optional[NatsUtility] = None
+        _queues[name] = self
+
+    def task(self, name: Optional[str] = None):
+        """Register the decorated coroutine as a task, called with the
+        arguments it was enqueued with"""
+
+        def register(func):
+            task_name = name or func.__name__
+            self._tasks[task_name] = func
+            self._names[func] = task_name
+            self._stats[task_name] = EndpointStats()
+            return func
+
+        return register
+
+    def subject(self, task: str):
+        return f"tasks.{self.name}.{task}"
+
+    def dead_letter_subject(self, task: str):
+        return f"tasks.{self.name}_DLQ.{task}"
+
+    def retry_delay(self, delivered: int) -> float:
+        return min(self.retry_backoff * 2 ** (delivered - 1), self.retry_backoff_max)
+
+    async def setup(self, utility=None):
+        """Create the streams and the consumer of the queue"""
+        if utility is None:
+            utility = get_utility(INatsUtility)
+        configs = [
+            StreamConfig(
+                name=self.stream,
+                subjects=[self.subject(">")],
+                retention=RetentionPolicy.workqueue,
+                storage=self.storage,
+            ),
+            StreamConfig(
+                name=self.dead_letter_stream,
+                subjects=[self.dead_letter_subject(">")],
+                storage=self.storage,
+            ),
+        ]
+        for config in configs:
+            res = await utility.ensure_stream(config)
+            if "error" in res:
+                raise JetStreamError(res["error"]["code"], res["error"]["description"])
+        res = await utility.ensure_consumer(
+            self.stream,
+            ConsumerConfig(
+                durable_name=self.consumer,
+                ack_policy=AckPolicy.explicit,
+                ack_wait=int(self.ack_wait * 1e9),
+                max_deliver=self.max_deliver,
+            ),
+        )
+        if "error" in res:
+            raise JetStreamError(res["error"]["code"], res["error"]["description"])
+        self._utility = utility
+
+    async def enqueue_async(self, task, *args, **kwargs) -> asyncio.Future:
+        """Publish the task without waiting for the stream ack, returns a
+        future resolved with the PubAck. task is its name or function"""
+        if self._utility is None:
+            await self.setup()
+        assert self._utility is not None
+        name = self._names.get(task, task)
+        return await self._utility.js_publish_async(
+            self.subject(name),
+            {"args": list(args), "kwargs": kwargs},
+            serializer=self.serializer,
+        )
+
+    async def enqueue(self, task, *args, **kwargs) -> PubAck:
+        """Publish the task once it is stored"""
+        return await (await self.enqueue_async(task, *args, **kwargs))
+
+    def stats(self):
+        return {name: stats.as_dict() for name, stats in self._stats.items()}
+
+
+class Worker(object):
+    """Run the tasks of queues, up to concurrency at once. Each queue pulls
+    batches of up to batch messages, no more than the free slots when the
+    pull starts, and tasks running longer than half ack_wait are reported
+    in progress"""
+
+    def __init__(
+        self,
+        utility,
+        queues: List[TaskQueue],
+        concurrency: int = 16,
+        batch: Optional[int] = None,
+        expires: float = 5,
+    ):
+        self._utility = utility
+        self.queues = queues
+        self.concurrency = concurrency
+        self.batch = batch or concurrency
+        self.expires = expires
+        self._slots = asyncio.Semaphore(concurrency)
+        self._fetchers: List[asyncio.Future] = []
+        self._running: Set[asyncio.Future] = set()
+        self._stopping = False
+        self.processed = 0
+        self.failed = 0
+        self.dead = 0
+
+    async def start(self):
+        for queue in self.queues:
+            await queue.setup(self._utility)
+            self._fetchers.append(asyncio.ensure_future(self._fetch(queue)))
+            logger.info(f"Running tasks of {queue.name}")
+
+    async def stop(self):
+        """Stop pulling tasks and wait for the running ones and their acks.
+        Pending pulls are let expire, their messages would otherwise wait
+        for ack_wait to be delivered to another worker"""
+        self._stopping = True
+        if self._fetchers:
+            _, pending = await asyncio.wait(
+                self._fetchers, timeout=self.expires + self._utility._timeout
+            )
+            for fetcher in pending:
+                fetcher.cancel()
+        self._fetchers = []
+        if self._running:
+            await asyncio.wait(list(self._running))
+        await self._utility.js_ack_flush()
+
+    def stats(self):
+        return {
+            "running": len(self._running),
+            "processed": self.processed,
+            "failed": self.failed,
+            "dead": self.dead,
+            "tasks": {queue.name: queue.stats() for queue in self.queues},
+        }
+
+    async def _fetch(self, queue: TaskQueue):
+        while True:
+            # Wait for a free slot without holding it during the pull, so an
+            # idle queue does not keep the slots from the busy ones
+            await self._slots.acquire()
+            self._slots.release()
+            if self._stopping:
+                return
+            free = max(1, min(self.batch, self.concurrency - len(self._running)))
+            try:
+                messages = await self._utility.js_fetch(
+                    queue.stream,
+                    queue.consumer,
+                    batch=free,
+                    expires=int(self.expires * 1e9),
+                )
+            except Exception:
+                logger.exception(f"Could not pull tasks of {queue.name}")
+                messages = []
+                await asyncio.sleep(self.expires)
+            for msg in messages:
+                # Other queues may have taken the slots meanwhile
+                await self._slots.acquire()
+                task = asyncio.ensure_future(self._run(queue, msg))
+                self._running.add(task)
+                task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._running.discard(task)
+        self._slots.release()
+
+    async def _in_progress(self, msg, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self._utility.js_in_progress(msg)
+
+    async def _run(self, queue: TaskQueue, msg):
+        name = msg.subject.rsplit(".", 1)[-1]
+        metadata = ack_metadata(msg.reply)
+        metrics = self._utility._metrics
+        progress = asyncio.ensure_future(self._in_progress(msg, queue.ack_wait / 2))
+        start = time.perf_counter()
+        failed = True
+        request = None
+        try:
+            func = queue._tasks.get(name)
+            if func is None:
+                raise KeyError(f"Unknown task {name}")
+            request = self._utility._serializers.get(queue.serializer).loads(msg.data)
+            await func(*request["args"], **request["kwargs"])
+            failed = False
+        except Exception as error:
+            logger.exception(f"Error running task {msg.subject}")
+            failure = error
+        finally:
+            progress.cancel()
+        seconds = time.perf_counter() - start
+        stats = queue._stats.get(name)
+        if stats is not None:
+            stats.record(seconds, failed)
+        if metrics is not None:
+            metrics.observe("task", seconds, task=msg.subject)
+        self.processed += 1
+        if not failed:
+            await self._utility.js_ack(msg)
+            return
+        self.failed += 1
+        if metrics is not None:
+            metrics.inc("task_failures", task=msg.subject)
+        if metadata["delivered"] < queue.max_deliver:
+            delay = queue.retry_delay(metadata["delivered"])
+            await self._utility.js_nak(msg, delay=int(delay * 1e9))
+            return
+        await self._dead_letter(queue, name, msg, metadata, request, failure)
+
+    async def _dead_letter(
+        self, queue: TaskQueue, name: str, msg, metadata, request, error
+    ):
+        try:
+            await self._utility.js_publish(
+                queue.dead_letter_subject(name),
+                {
+                    "task": name,
+                    "request": request,
+                    "error": f"{error.__class__.__name__}: {error}",
+                    "delivered": metadata["delivered"],
+                    "stream_seq": metadata["stream_seq"],
+                },
+                serializer="json",
+            )
+        except Exception:
+            # Left for the server to redeliver after ack_wait
+            logger.exception(f"Could not dead letter task {msg.subject}")
+            return
+        self.dead += 1
+        if self._utility._metrics is not None:
+            self._utility._metrics.inc("task_dead_letters", task=msg.subject)
+        await self._utility.js_term(msg)
@@ -30,8 +30,11 @@ testing.configure_with(base_settings_configurator)
 
 @pytest.fixture(scope="function")
 def natsd():
-    if not os.path.isfile("nats-server"):
-        version = "v2.2.4"
+    # The JetStream tests need a recent server, the version is in the file
+    # name so an older cached binary is not reused
+    version = "v2.10.25"
+    bin_name = f"nats-server-{version}"
+    if not os.path.isfile(bin_name):
         arch = platform.machine()
         if arch == "x86_64":
             arch = "amd64"
@@ -44,12 +47,12 @@ def natsd():
 
         file = zipfile.open(f"nats-server-{version}-{system}-{arch}/nats-server")
         content = file.read()
-        with open("nats-server", "wb") as f:
+        with open(bin_name, "wb") as f:
             f.write(content)
-        os.chmod("nats-server", 755)
+        os.chmod(bin_name, 0o755)
 
     server = Gnatsd(port=4222)
-    server.bin_name = "nats-server"
+    server.bin_name = bin_name
     server.path = os.getcwd()
     start_gnatsd(server)
     print("Started natsd")
@@ -1,6 +1,8 @@
 from guillotina.component import get_utility
 from guillotina_nats.interfaces import INatsUtility
+from prometheus_client import REGISTRY
 
+import asyncio
 import pytest
 
 
@@ -10,3 +12,97 @@ async def test_connection(natsd, container_requester):
         nats = get_utility(INatsUtility)
 
         assert nats._initialized
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {
+                    "pool_size": 3,
+                    "pool_routes": {"publish": 1, "jetstream": 2, "subscribe": "hash"},
+                }
+            }
+        }
+    }
+)
+async def test_connection_pool(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        assert len(nats.connections) == 3
+        assert nats.nc is nats.connections[0]
+        assert nats.js_nc is nats.connections[2]
+        assert nats.connection("publish") is nats.connections[1]
+
+        received = []
+
+        async def callback(msg):
+            received.append(msg.subject)
+
+        subjects = [f"pool.{idx}" for idx in range(6)]
+        sids = [await nats.subscribe(callback, subject) for subject in subjects]
+        # Subscriptions are spread over the pool, publishes go through one
+        await nats.flush()
+        for subject in subjects:
+            await nats.publish(subject, b"hola")
+        await asyncio.sleep(0.5)
+        assert sorted(received) == subjects
+        assert nats.connections[1].stats["out_msgs"] == 6
+
+        for sid in sids:
+            await nats.unsubscribe(sid)
+        assert nats._subscriptions == []
+
+        res = await nats.js_info()
+        assert "error" not in res
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {"settings": {"metrics": True, "metrics_prometheus": True}}
+        }
+    }
+)
+async def test_metrics(natsd, container_requester):
+    async with container_requester as requester:
+        nats = get_utility(INatsUtility)
+        published = REGISTRY.get_sample_value(
+            "guillotina_nats_publish_total", {"kind": "core"}
+        )
+
+        async def callback(msg):
+            await asyncio.sleep(0.01)
+
+        await nats.subscribe(callback, "metrics.*")
+        await nats.connection("subscribe").flush()
+        for idx in range(5):
+            await nats.publish("metrics.data", b"hola")
+        await nats.js_info()
+        await asyncio.sleep(0.3)
+
+        resp, status = await requester("GET", "/@nats-stats")
+        assert status == 200
+        assert resp["client"]["connections"][0]["out_msgs"] >= 5
+        assert resp["client"]["pending_bytes"] == 0
+        counters = {
+            (metric["labels"].get("kind"), name): metric["value"]
+            for name, values in resp["counters"].items()
+            for metric in values
+        }
+        assert counters[("core", "publish")] == 5
+        assert counters[("core", "publish_bytes")] == 20
+        (callback_time,) = resp["histograms"]["callback"]
+        assert callback_time["labels"] == {"subject": "metrics.*"}
+        assert callback_time["count"] == 5
+        assert callback_time["avg"] >= 0.01
+        (request_time,) = resp["histograms"]["request"]
+        assert request_time["labels"] == {"family": "INFO"}
+
+        published_now = REGISTRY.get_sample_value(
+            "guillotina_nats_publish_total", {"kind": "core"}
+        )
+        assert published_now - (published or 0) == 5
@@ -0,0 +1,129 @@
+from guillotina.component import get_global_components
+from guillotina.component import get_utility
+from guillotina.interfaces import IObjectAddedEvent
+from guillotina.interfaces import IResource
+from guillotina.transactions import get_transaction
+from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.models import Storage
+from guillotina_nats.models import StreamConfig
+
+import asyncio
+import json
+import pytest
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings({"load_utilities": {"nats": {"settings": {"events": True}}}})
+async def test_content_events(natsd, container_requester):
+    async with container_requester as requester:
+        nats = get_utility(INatsUtility)
+        # The container itself
+        published = nats.stats()["events"]["published"]
+
+        received = []
+
+        async def callback(msg):
+            received.append((msg.subject, msg.value))
+
+        await nats.subscribe(callback, "guillotina.guillotina.>", serializer="json")
+
+        _, status = await requester(
+            "POST", "/db/guillotina/", data=json.dumps({"@type": "Item", "id": "item"})
+        )
+        assert status == 201
+        _, status = await requester(
+            "PATCH", "/db/guillotina/item", data=json.dumps({"title": "Item"})
+        )
+        assert status == 204
+        _, status = await requester("DELETE", "/db/guillotina/item")
+        assert status == 200
+        # Aborted, nothing is published
+        _, status = await requester(
+            "POST", "/db/guillotina/", data=json.dumps({"@type": "Item", "id": "item"})
+        )
+        assert status == 201
+        _, status = await requester(
+            "POST", "/db/guillotina/", data=json.dumps({"@type": "Item", "id": "item"})
+        )
+        assert status == 409
+
+        # Aborted after the event was recorded
+        recorded = []
+
+        async def broken(obj, event):
+            recorded.append(len(get_transaction()._nats_events))
+            raise ValueError("broken")
+
+        components = get_global_components()
+        components.registerHandler(broken, (IResource, IObjectAddedEvent))
+        try:
+            _, status = await requester(
+                "POST",
+                "/db/guillotina/",
+                data=json.dumps({"@type": "Item", "id": "other"}),
+            )
+        finally:
+            components.unregisterHandler(broken, (IResource, IObjectAddedEvent))
+        assert status == 500
+        assert recorded == [1]
+
+        await asyncio.sleep(0.5)
+        assert [subject for subject, _ in received] == [
+            "guillotina.guillotina.Item.added",
+            "guillotina.guillotina.Item.modified",
+            "guillotina.guillotina.Item.removed",
+            "guillotina.guillotina.Item.added",
+        ]
+        added = received[0][1]
+        assert added["action"] == "added"
+        assert added["path"] == "/item"
+        assert added["container"] == "guillotina"
+        assert received[1][1]["changed"] == ["title"]
+        assert all(value["uid"] == added["uid"] for _, value in received[:3])
+        assert nats.stats()["events"]["published"] == published + 4
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {
+                    "events": {
+                        "subject": None,
+                        "subjects": {"Item": "CONTENT.{container}.{action}"},
+                        "jetstream": True,
+                    }
+                }
+            }
+        }
+    }
+)
+async def test_content_events_jetstream(natsd, container_requester):
+    async with container_requester as requester:
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(
+            name="CONTENT", subjects=["CONTENT.>"], storage=Storage.memory
+        )
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        for type_name, name in (("Item", "item"), ("Folder", "folder")):
+            _, status = await requester(
+                "POST",
+                "/db/guillotina/",
+                data=json.dumps({"@type": type_name, "id": name}),
+            )
+            assert status == 201
+
+        await nats._events.close()
+        stats = nats.stats()["events"]
+        assert stats["published"] == 1
+        assert stats["failed"] == 0
+        messages = [
+            stored async for stored in nats.js_get_messages("CONTENT", subject=">")
+        ]
+        assert [stored.subject for stored in messages] == ["CONTENT.guillotina.added"]
+        assert json.loads(messages[0].data)["type_name"] == "Item"
+        await nats.js_stream_delete("CONTENT")
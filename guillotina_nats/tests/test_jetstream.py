@@ -1,10 +1,17 @@
+from datetime import datetime
+from datetime import timezone
 from guillotina.component import get_utility
+from guillotina_nats.exceptions import ObjectNotFound
 from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.models import AckPolicy
 from guillotina_nats.models import ConsumerConfig
 from guillotina_nats.models import DeliverPolicy
+from guillotina_nats.models import Storage
 from guillotina_nats.models import StreamConfig
 from nats.aio.errors import ErrTimeout
 
+import asyncio
+import os
 import pytest
 
 
@@ -80,3 +87,510 @@ async def test_js_stream(natsd, container_requester):
         assert message3 == b"Hola de nou"
         message4 = await nats.js_get_message("ORDERS", 5)
         assert message4 is None
+
+
+@pytest.mark.asyncio
+async def test_js_get_next_shared_inbox(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="EVENTS", subjects=["EVENTS.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        for name in ("ONE", "TWO"):
+            config = ConsumerConfig(durable_name=name, ack_wait=int(3e10))
+            res = await nats.js_consumer_durable_create("EVENTS", config)
+            assert "error" not in res
+
+        for idx in range(4):
+            await nats.publish("EVENTS.created", f"event {idx}".encode())
+
+        bodies = await asyncio.gather(
+            nats.js_get_next("EVENTS", "ONE"),
+            nats.js_get_next("EVENTS", "TWO"),
+            nats.js_get_next("EVENTS", "ONE"),
+        )
+        assert sorted(body.data for body in bodies) == [
+            b"event 0",
+            b"event 0",
+            b"event 1",
+        ]
+        for body in bodies:
+            await nats.js_consumer_ack(body.reply)
+
+        # The response inbox is created once and reused by every fetch
+        prefix = nats._js_inbox_prefix
+        body = await nats.js_get_next("EVENTS", "TWO")
+        assert body.data == b"event 1"
+        assert nats._js_inbox_prefix == prefix
+        assert nats._js_pulls == {}
+        assert nats._js_pull_waiters == {}
+
+
+@pytest.mark.asyncio
+async def test_js_fetch_batch(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="INDEX", subjects=["INDEX.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        config = ConsumerConfig(durable_name="INDEXER", ack_wait=int(3e10))
+        res = await nats.js_consumer_durable_create("INDEX", config)
+        assert "error" not in res
+
+        for idx in range(150):
+            await nats.publish("INDEX.modified", f"{idx}".encode())
+
+        messages = await nats.js_fetch("INDEX", "INDEXER", batch=100)
+        assert [msg.data for msg in messages] == [f"{i}".encode() for i in range(100)]
+        for msg in messages:
+            await nats.js_consumer_ack(msg.reply)
+
+        # Only 50 left, the request returns once it expires
+        messages = await nats.js_fetch("INDEX", "INDEXER", batch=100, expires=int(5e8))
+        assert len(messages) == 50
+        assert messages[-1].data == b"149"
+
+        messages = await nats.js_fetch("INDEX", "INDEXER", batch=10, no_wait=True)
+        assert messages == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {
+                    "compression": "zlib",
+                    "compression_threshold": 4,
+                    "publish_buffer": True,
+                    "metrics": True,
+                }
+            }
+        }
+    }
+)
+async def test_js_acks(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="JOBS", subjects=["JOBS.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        config = ConsumerConfig(
+            durable_name="ALL", ack_policy=AckPolicy.all, ack_wait=int(3e10)
+        )
+        res = await nats.js_consumer_durable_create("JOBS", config)
+        assert "error" not in res
+        config = ConsumerConfig(durable_name="EXPLICIT", ack_wait=int(3e10))
+        res = await nats.js_consumer_durable_create("JOBS", config)
+        assert "error" not in res
+
+        for idx in range(10):
+            await nats.publish("JOBS.new", f"{idx}".encode())
+
+        messages = await nats.js_fetch("JOBS", "ALL", batch=10)
+        assert len(messages) == 10
+        await nats.js_ack_all(messages)
+        await nats.js_ack_flush()
+        await asyncio.sleep(0.2)
+        res = await nats.js_consumer_info("JOBS", "ALL")
+        assert res["num_ack_pending"] == 0
+        assert res["ack_floor"]["consumer_seq"] == 10
+
+        messages = await nats.js_fetch("JOBS", "EXPLICIT", batch=3)
+        await nats.js_nak(messages[0])
+        await nats.js_term(messages[1])
+        assert await nats.js_ack(messages[2], sync=True) is not None
+        # Buffered acks are published on the flush interval
+        await asyncio.sleep(0.2)
+        body = await nats.js_get_next("JOBS", "EXPLICIT")
+        assert body.data == b"0"
+        # Delivery count in $JS.ACK.<stream>.<consumer>.<delivered>...
+        assert body.reply.split(".")[4] == "2"
+        await nats.js_in_progress(body)
+        await nats.js_ack(body)
+        await nats.js_ack_flush()
+        await asyncio.sleep(0.2)
+        res = await nats.js_consumer_info("JOBS", "EXPLICIT")
+        assert res["num_ack_pending"] == 0
+        # Acks are neither compressed nor buffered nor counted as publishes
+        (published,) = nats.stats()["counters"]["publish"]
+        assert published["value"] == 10
+
+
+@pytest.mark.asyncio
+async def test_js_push_subscribe(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="PUSH", subjects=["PUSH.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        received = []
+        running = []
+
+        async def handler(msg):
+            running.append(msg)
+            await asyncio.sleep(0.1)
+            received.append(msg.data)
+
+        config = ConsumerConfig(
+            durable_name="PUSHER",
+            flow_control=True,
+            idle_heartbeat=int(2e8),
+            max_ack_pending=100,
+        )
+        sub = await nats.js_push_subscribe("PUSH", config, handler, concurrency=4)
+        assert sub.consumer == "PUSHER"
+
+        for idx in range(8):
+            await nats.publish("PUSH.new", f"{idx}".encode())
+
+        await asyncio.sleep(0.05)
+        # Handlers run concurrently up to the worker limit
+        assert len(running) == 4
+        await asyncio.sleep(0.5)
+        assert sorted(received) == [f"{idx}".encode() for idx in range(8)]
+
+        await asyncio.sleep(0.5)
+        assert not sub.stalled
+        res = await nats.js_consumer_info("PUSH", "PUSHER")
+        assert res["num_ack_pending"] == 0
+
+        # No more heartbeats once the consumer is gone
+        await nats.js_consumer_delete("PUSH", "PUSHER")
+        await asyncio.sleep(1)
+        assert sub.stalled
+
+        await nats.js_push_unsubscribe(sub)
+
+        # Ephemeral consumer replaying the stream
+        received.clear()
+        sub = await nats.js_push_subscribe("PUSH", ConsumerConfig(), handler)
+        assert sub.consumer is not None
+        await asyncio.sleep(1)
+        assert len(received) == 8
+        await nats.js_push_unsubscribe(sub)
+
+        # Handlers that never return are cancelled after stop_timeout
+        async def hung(msg):
+            running.append(msg)
+            await asyncio.sleep(3600)
+
+        running.clear()
+        sub = await nats.js_push_subscribe(
+            "PUSH", ConsumerConfig(), hung, concurrency=2, stop_timeout=0.2
+        )
+        await asyncio.sleep(0.2)
+        assert len(running) == 2
+        await asyncio.wait_for(nats.js_push_unsubscribe(sub), 2)
+        assert sub._workers == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {"load_utilities": {"nats": {"settings": {"js_publish_max_inflight": 16}}}}
+)
+async def test_js_publish(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="STORE", subjects=["STORE.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        ack = await nats.js_publish("STORE.object", b"first")
+        assert ack.stream == "STORE"
+        assert ack.seq == 1
+
+        futures = [
+            await nats.js_publish_async("STORE.object", f"{idx}".encode())
+            for idx in range(200)
+        ]
+        assert len(nats._js_pending_publishes) <= 16
+        acks = await asyncio.gather(*futures)
+        assert [ack.seq for ack in acks] == list(range(2, 202))
+
+        for idx in range(10):
+            await nats.js_publish_async("STORE.object", b"more")
+        await nats.js_publish_complete()
+        res = await nats.js_stream("STORE")
+        assert res["state"]["messages"] == 211
+
+        # Nobody stores this subject, so no ack arrives
+        with pytest.raises(ErrTimeout):
+            await nats.js_publish("NOSTREAM.object", b"lost")
+        assert nats._js_replies == {}
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {"settings": {"js_cache_ttl": 60, "js_cache_advisories": True}}
+        }
+    }
+)
+async def test_js_metadata_cache(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        calls = []
+        request = nats.request
+
+        async def counted_request(key, value, timeout=None):
+            calls.append(key)
+            return await request(key, value, timeout)
+
+        nats.request = counted_request
+
+        config = StreamConfig(name="CACHED", subjects=["CACHED.*"])
+        res = await nats.ensure_stream(config)
+        assert res["type"] == "io.nats.jetstream.api.v1.stream_create_response"
+        res = await nats.ensure_stream(config)
+        assert res["config"]["name"] == "CACHED"
+        res = await nats.ensure_stream(config)
+        assert calls == [
+            "$JS.API.STREAM.INFO.CACHED",
+            "$JS.API.STREAM.CREATE.CACHED",
+            "$JS.API.STREAM.INFO.CACHED",
+        ]
+
+        # Cached responses are not changed through the returned ones
+        info = await nats.js_stream("CACHED")
+        info["config"]["subjects"].append("OTHER.*")
+        assert (await nats.js_stream("CACHED"))["config"]["subjects"] == ["CACHED.*"]
+
+        config.max_msgs = 100
+        res = await nats.ensure_stream(config)
+        assert res["type"] == "io.nats.jetstream.api.v1.stream_update_response"
+        assert (await nats.js_stream("CACHED"))["config"]["max_msgs"] == 100
+
+        calls.clear()
+        consumer = ConsumerConfig(durable_name="READER", max_deliver=5)
+        await nats.ensure_consumer("CACHED", consumer)
+        await nats.ensure_consumer("CACHED", consumer)
+        await nats.ensure_consumer("CACHED", consumer)
+        assert calls == [
+            "$JS.API.CONSUMER.INFO.CACHED.READER",
+            "$JS.API.CONSUMER.DURABLE.CREATE.CACHED.READER",
+            "$JS.API.CONSUMER.INFO.CACHED.READER",
+        ]
+        with pytest.raises(ValueError):
+            await nats.ensure_consumer("CACHED", ConsumerConfig(max_deliver=5))
+
+        # Deleted behind our back, the advisory invalidates the cache
+        await nats.nc.request("$JS.API.CONSUMER.DELETE.CACHED.READER", b"")
+        await asyncio.sleep(0.2)
+        res = await nats.js_consumer_info("CACHED", "READER")
+        assert res["error"]["code"] == 404
+
+        await nats.js_stream_delete("CACHED")
+        res = await nats.js_stream("CACHED")
+        assert res["error"]["code"] == 404
+
+
+@pytest.mark.asyncio
+async def test_js_listings(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        for name in ("LISTA", "LISTB", "LISTC"):
+            res = await nats.js_stream_create(
+                StreamConfig(name=name, subjects=[f"{name}.*"])
+            )
+            assert "error" not in res
+
+        streams = [stream async for stream in nats.js_streams_iter()]
+        assert sorted(stream.config.name for stream in streams) == [
+            "LISTA",
+            "LISTB",
+            "LISTC",
+        ]
+        assert streams[0].state.messages == 0
+
+        # More consumers than fit in one page
+        for idx in range(300):
+            res = await nats.js_consumer_durable_create(
+                "LISTA", ConsumerConfig(durable_name=f"C{idx}")
+            )
+            assert "error" not in res
+        res = await nats.js_consumer_list("LISTA")
+        assert len(res["consumers"]) < 300
+
+        consumers = [
+            consumer
+            async for consumer in nats.js_consumers_iter("LISTA", prefetch=True)
+        ]
+        assert len(consumers) == 300
+        assert {consumer.name for consumer in consumers} == {
+            f"C{idx}" for idx in range(300)
+        }
+        assert consumers[0].config.deliver_policy == DeliverPolicy.all
+
+        async for consumer in nats.js_consumers_iter("LISTA"):
+            assert consumer.stream_name == "LISTA"
+            break
+
+        # The server reports start times as RFC3339 strings
+        start = datetime(2021, 5, 21, 10, 30, 0, 250000, tzinfo=timezone.utc)
+        config = ConsumerConfig(
+            durable_name="START",
+            deliver_policy=DeliverPolicy.by_start_time,
+            opt_start_time=start,
+        )
+        res = await nats.js_consumer_durable_create("LISTB", config)
+        assert "error" not in res
+        consumers = [consumer async for consumer in nats.js_consumers_iter("LISTB")]
+        assert consumers[0].config.opt_start_time == start
+        info = await nats.ensure_consumer("LISTB", config)
+        assert info["created"] == res["created"]
+
+
+@pytest.mark.asyncio
+async def test_js_get_messages(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="REPLAY", subjects=["REPLAY.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+
+        for idx in range(100):
+            subject = "REPLAY.even" if idx % 2 == 0 else "REPLAY.odd"
+            await nats.js_publish(subject, f"{idx}".encode())
+
+        messages = [msg async for msg in nats.js_get_messages("REPLAY", concurrency=8)]
+        assert [msg.seq for msg in messages] == list(range(1, 101))
+        assert messages[0].data == b"0"
+        assert messages[0].subject == "REPLAY.even"
+        assert messages[0].time <= messages[-1].time
+
+        messages = [msg async for msg in nats.js_get_messages("REPLAY", 10, 20)]
+        assert [msg.data for msg in messages] == [f"{i}".encode() for i in range(9, 20)]
+
+        messages = [
+            msg
+            async for msg in nats.js_get_messages(
+                "REPLAY", start=11, end=30, subject="REPLAY.odd"
+            )
+        ]
+        assert [msg.seq for msg in messages] == list(range(12, 31, 2))
+        assert messages[0].data == b"11"
+
+        res = await nats.js_consumer_list("REPLAY")
+        assert res["total"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {"load_utilities": {"nats": {"settings": {"json_codec": "json"}}}}
+)
+async def test_js_stdlib_codec(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+        assert nats._codec.name == "json"
+
+        config = StreamConfig(name="CODEC", subjects=["CODEC.*"])
+        res = await nats.js_stream_create(config)
+        assert res["config"]["subjects"] == ["CODEC.*"]
+
+        config = ConsumerConfig(durable_name="DECODER", ack_wait=int(3e10))
+        res = await nats.js_consumer_durable_create("CODEC", config)
+        assert res["config"]["ack_wait"] == int(3e10)
+
+        await nats.publish("CODEC.new", b"hola")
+        body = await nats.js_get_next("CODEC", "DECODER")
+        assert body.data == b"hola"
+
+        await nats.js_publish("CODEC.new", {"hola": 1}, serializer="json")
+        body = await nats.js_get_next("CODEC", "DECODER", serializer="json")
+        assert body.value == {"hola": 1}
+        assert body.subject == "CODEC.new"
+
+        # Models, times and enums
+        created = datetime(2021, 5, 21, tzinfo=timezone.utc)
+        value = {"created": created, "storage": Storage.file, "config": config}
+        await nats.js_publish("CODEC.new", value, serializer="json")
+        body = await nats.js_get_next("CODEC", "DECODER", serializer="json")
+        assert body.value["created"] == "2021-05-21T00:00:00+00:00"
+        assert body.value["storage"] == "file"
+        assert body.value["config"]["durable_name"] == "DECODER"
+        assert body.reply.startswith("$JS.ACK.CODEC.DECODER.")
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {"load_utilities": {"nats": {"settings": {"compression": "zlib"}}}}
+)
+async def test_js_compression(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        config = StreamConfig(name="STATES", subjects=["STATES.*"])
+        res = await nats.js_stream_create(config)
+        assert "error" not in res
+        config = ConsumerConfig(durable_name="READER", ack_wait=int(3e10))
+        res = await nats.js_consumer_durable_create("STATES", config)
+        assert "error" not in res
+
+        state = b"x" * 100000
+        ack = await nats.js_publish("STATES.saved", state)
+        res = await nats.js_stream("STATES")
+        assert res["state"]["bytes"] < 1000
+
+        body = await nats.js_get_next("STATES", "READER")
+        assert body.data == state
+        assert await nats.js_get_message("STATES", ack.seq) == state
+        stored = [msg async for msg in nats.js_get_messages("STATES")]
+        assert stored[0].data == state
+
+
+@pytest.mark.asyncio
+async def test_js_object_store(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        store = await nats.object_store(
+            "files", chunk_size=65536, read_ahead=2, storage=Storage.memory
+        )
+        blob = os.urandom(3 * nats.js_nc.max_payload + 100)
+        info = await store.put("attachments/report.pdf", blob, {"type": "pdf"})
+        assert info.size == len(blob)
+        assert info.chunks == len(blob) // 65536 + 1
+        assert info.digest.startswith("SHA-256=")
+
+        chunks = [chunk async for chunk in store.get("attachments/report.pdf")]
+        assert len(chunks) == info.chunks
+        assert b"".join(chunks) == blob
+
+        # Replacing an object drops the previous chunks
+        async def parts():
+            for idx in range(3):
+                yield b"%d" % idx * 50000
+
+        info = await store.put("attachments/report.pdf", parts())
+        assert info.chunks == 3
+        assert await store.get_bytes("attachments/report.pdf") == (
+            b"0" * 50000 + b"1" * 50000 + b"2" * 50000
+        )
+        res = await nats.js_stream("OBJ_files")
+        assert res["state"]["messages"] == 4
+
+        await store.put("empty", b"")
+        assert await store.get_bytes("empty") == b""
+        names = sorted([info.name async for info in store.list()])
+        assert names == ["attachments/report.pdf", "empty"]
+
+        await store.delete("empty")
+        with pytest.raises(ObjectNotFound):
+            await store.info("empty")
+        names = [info.name async for info in store.list()]
+        assert names == ["attachments/report.pdf"]
+        await nats.js_stream_delete("OBJ_files")
@@ -1,8 +1,12 @@
+from datetime import datetime
 from guillotina.component import get_utility
 from guillotina_nats.interfaces import INatsUtility
+from pydantic import BaseModel
+from typing import List
 
 import asyncio
 import pytest
+import time
 
 
 @pytest.mark.asyncio
@@ -20,3 +24,229 @@ async def test_pubsub(natsd, container_requester):
 
         await asyncio.sleep(1)
         assert variable[0] == "done"
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {"publish_buffer": True, "publish_buffer_max_messages": 10}
+            }
+        }
+    }
+)
+async def test_publish_buffer(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = []
+
+        async def callback(msg):
+            received.append(msg.data)
+
+        await nats.subscribe(callback, "buffered")
+        await nats.nc.flush()
+        for idx in range(25):
+            await nats.publish("buffered", f"{idx}".encode())
+        # The last 5 wait for the next loop iteration
+        assert len(nats._publish_buffer) == 5
+        await nats.publish_flush()
+        assert len(nats._publish_buffer) == 0
+
+        await asyncio.sleep(0.5)
+        assert received == [f"{idx}".encode() for idx in range(25)]
+        assert nats.nc.stats["out_msgs"] >= 25
+
+        async def responder(msg):
+            received.append(msg.data)
+            await nats.publish(msg.reply, b"ok")
+
+        await nats.subscribe(responder, "buffered.request")
+        await nats.nc.flush()
+        await nats.publish("buffered", b"before")
+        # The request writes the buffer first instead of overtaking it
+        reply = await nats.request("buffered.request", b"request", timeout=1)
+        assert reply.data == b"ok"
+        assert received[-2:] == [b"before", b"request"]
+
+
+class Order(BaseModel):
+    id: int
+    items: List[str]
+    created: datetime
+
+
+@pytest.mark.asyncio
+async def test_pubsub_serializers(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = []
+
+        async def callback(msg):
+            received.append((msg.subject, msg.value))
+
+        await nats.subscribe(callback, "typed.json", serializer="json")
+        await nats.subscribe(callback, "typed.order", serializer=Order)
+        await nats.subscribe(callback, "typed.raw", serializer="raw")
+        await nats.nc.flush()
+
+        order = Order(id=1, items=["a", "b"], created=datetime(2021, 5, 21))
+        await nats.publish("typed.json", {"hola": [1, 2]}, serializer="json")
+        await nats.publish("typed.order", order, serializer=Order)
+        await nats.publish(
+            "typed.raw", memoryview(bytearray(b"hola")), serializer="raw"
+        )
+        await asyncio.sleep(0.5)
+        assert sorted(received) == [
+            ("typed.json", {"hola": [1, 2]}),
+            ("typed.order", order),
+            ("typed.raw", b"hola"),
+        ]
+
+        with pytest.raises(ValueError):
+            await nats.publish("typed.json", b"", serializer="unknown")
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {"settings": {"compression": "zlib", "compression_threshold": 100}}
+        }
+    }
+)
+async def test_pubsub_compression(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = []
+
+        async def callback(msg):
+            received.append(msg.value)
+
+        await nats.subscribe(callback, "compressed", serializer="json")
+        await nats.nc.flush()
+
+        state = {"title": "hola " * 1000}
+        await nats.publish("compressed", state, serializer="json")
+        await nats.publish("compressed", {"small": True}, serializer="json")
+        await asyncio.sleep(0.5)
+        assert received == [state, {"small": True}]
+        assert nats.nc.stats["out_bytes"] < 200
+
+        stats = nats.compression_stats()
+        assert stats["compressed"] == 1
+        assert stats["decompressed"] == 1
+        assert stats["ratio"] < 0.1
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings({"load_utilities": {"nats": {"settings": {"metrics": True}}}})
+async def test_subscribe_overflow(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = {"oldest": [], "newest": []}
+        release = asyncio.Event()
+
+        def handler(name):
+            async def callback(msg):
+                await release.wait()
+                received[name].append(int(msg.data))
+
+            return callback
+
+        oldest = await nats.subscribe(
+            handler("oldest"), "slow", pending_msgs_limit=3, overflow="drop_oldest"
+        )
+        newest = await nats.subscribe(
+            handler("newest"), "slow", pending_msgs_limit=3, overflow="drop_newest"
+        )
+        await nats.nc.flush()
+        await nats.publish("slow", b"0")
+        await asyncio.sleep(0.1)
+        for idx in range(1, 10):
+            await nats.publish("slow", b"%d" % idx)
+        await nats.nc.flush()
+        await asyncio.sleep(0.2)
+
+        stats = nats.stats()
+        assert [sub["dropped"] for sub in stats["subscriptions"]] == [6, 6]
+        assert stats["client"]["subscription_pending_msgs"] == 6
+        (slow,) = stats["counters"]["slow_consumers"]
+        assert slow["value"] == 2
+
+        release.set()
+        await asyncio.sleep(0.2)
+        # The first message was already being handled
+        assert received["oldest"] == [0, 7, 8, 9]
+        assert received["newest"] == [0, 1, 2, 3]
+        await nats.unsubscribe(oldest)
+        await nats.unsubscribe(newest)
+        assert nats._bounded_subscriptions == {}
+
+
+@pytest.mark.asyncio
+async def test_subscribe_concurrency(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        running = []
+        done = []
+
+        async def callback(msg):
+            running.append(msg.data)
+            await asyncio.sleep(0.3)
+            done.append(msg.data)
+
+        sid = await nats.subscribe(callback, "busy", concurrency=4, overflow="block")
+        await nats.nc.flush()
+        for idx in range(6):
+            await nats.publish("busy", b"%d" % idx)
+        await asyncio.sleep(0.2)
+        assert len(running) == 4
+        assert done == []
+
+        # Unsubscribing waits for the handlers of the received messages
+        await asyncio.sleep(0.2)
+        await nats.unsubscribe(sid)
+        assert len(done) == 6
+
+
+@pytest.mark.asyncio
+async def test_request_many(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        def responder(name, delay):
+            async def callback(msg):
+                await asyncio.sleep(delay)
+                await nats.publish(msg.reply, {"name": name}, serializer="json")
+
+            return callback
+
+        for name, delay in (("a", 0), ("b", 0.05), ("c", 0.1), ("late", 0.8)):
+            await nats.subscribe(responder(name, delay), "who.has")
+        await nats.nc.flush()
+
+        start = time.monotonic()
+        replies = [
+            msg.value["name"]
+            async for msg in nats.request_many(
+                "who.has", {"oid": "1"}, timeout=2, stall_timeout=0.3, serializer="json"
+            )
+        ]
+        assert replies == ["a", "b", "c"]
+        assert time.monotonic() - start < 0.6
+
+        replies = [
+            msg async for msg in nats.request_many("who.has", b"", max_replies=2)
+        ]
+        assert len(replies) == 2
+
+        replies = [msg async for msg in nats.request_many("nobody", b"", timeout=0.1)]
+        assert replies == []
+        await asyncio.sleep(1)
+        assert nats._inbox_replies == {}
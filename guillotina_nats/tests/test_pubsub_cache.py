@@ -0,0 +1,87 @@
+from guillotina.component import get_utility
+from guillotina.interfaces import ICacheUtility
+from guillotina.interfaces import IPubSubUtility
+from guillotina_nats.pubsub import merge_invalidations
+from guillotina_nats.pubsub import NatsPubSubUtility
+
+import asyncio
+import pytest
+
+
+def test_merge_invalidations():
+    merged = merge_invalidations(
+        [
+            {"tid": 1, "keys": ["a", "b"], "push": {"c": 1, "d": 1}},
+            {"tid": 2, "keys": ["b", "c"], "push": {"b": 2}},
+        ]
+    )
+    assert merged == {"tid": 2, "keys": ["a", "b", "c"], "push": {"d": 1, "b": 2}}
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "applications": ["guillotina.contrib.cache"],
+        "cache": {"updates_channel": "invalidations", "driver": None},
+        "load_utilities": {
+            "guillotina_pubsub": {
+                "provides": "guillotina.interfaces.IPubSubUtility",
+                "factory": "guillotina_nats.pubsub.NatsPubSubUtility",
+                "settings": {},
+            },
+            "nats": {"settings": {"metrics": True}},
+        },
+    }
+)
+async def test_cache_invalidations(natsd, container_requester):
+    async with container_requester as requester:
+        cache = get_utility(ICacheUtility)
+        pubsub = get_utility(IPubSubUtility)
+        assert isinstance(pubsub, NatsPubSubUtility)
+        assert cache._subscriber is pubsub
+        for key in ("a", "b", "c"):
+            cache._memory_cache.set(key, key, 1)
+        # Creating the container already went through it
+        await asyncio.sleep(0.1)
+        before = pubsub.stats()
+
+        # Another instance
+        other = NatsPubSubUtility({"batch_interval": 0.05})
+        await other.initialize()
+        await other.publish(
+            "invalidations", "tid1", {"tid": "tid1", "keys": ["a"], "push": {"d": "d"}}
+        )
+        await other.publish(
+            "invalidations",
+            "tid2",
+            {"tid": "tid2", "keys": ["b", "d"], "push": {"e": "e"}},
+        )
+        await other.publish("invalidations", "tid1", {"tid": "tid1", "keys": ["a"]})
+        await asyncio.sleep(0.3)
+
+        assert "a" not in cache._memory_cache
+        assert "b" not in cache._memory_cache
+        assert "c" in cache._memory_cache
+        assert "d" not in cache._memory_cache
+        assert cache._memory_cache["e"] == "e"
+        stats = pubsub.stats()
+        assert stats["received"] - before["received"] == 2
+        assert stats["batches_received"] - before["batches_received"] == 1
+        assert stats["duplicates"] == 1
+        assert other.stats()["batches_sent"] == 1
+
+        # Our own invalidations are ignored by the cache utility
+        cache.ignore_tid("tid3")
+        await cache.send_invalidation(["c"])
+        await pubsub.publish(
+            "invalidations", "tid3", {"tid": "tid3", "keys": ["c"], "push": {}}
+        )
+        await asyncio.sleep(0.1)
+        assert "c" in cache._memory_cache
+        assert cache._ignored_tids == []
+
+        resp, status = await requester("GET", "/@nats-stats")
+        assert status == 200
+        assert resp["pubsub"]["batches_received"] == stats["batches_received"] + 1
+        histograms = resp["histograms"]
+        assert histograms["pubsub_batch_size"][0]["max"] == 3
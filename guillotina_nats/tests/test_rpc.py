@@ -0,0 +1,90 @@
+from guillotina.component import get_utility
+from guillotina_nats.exceptions import RPCError
+from guillotina_nats.exceptions import RPCTimeout
+from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.rpc import RPCClient
+from guillotina_nats.rpc import Service
+
+import asyncio
+import pytest
+import time
+
+
+@pytest.mark.asyncio
+async def test_rpc_service(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        service = Service("calc", max_workers=4)
+        running = []
+
+        @service.endpoint("add")
+        async def add(request):
+            running.append(request)
+            await asyncio.sleep(0.1)
+            return request["a"] + request["b"]
+
+        @service.endpoint("div")
+        async def div(request):
+            if request["b"] == 0:
+                raise RPCError(400, "division by zero")
+            return request["a"] / request["b"]
+
+        await service.start(nats)
+        await nats.nc.flush()
+        client = RPCClient(nats, "calc", timeout=1)
+
+        results = await asyncio.gather(
+            *[client.call("add", {"a": idx, "b": 1}) for idx in range(8)]
+        )
+        assert results == list(range(1, 9))
+        assert await client.call("div", {"a": 1, "b": 2}) == 0.5
+        with pytest.raises(RPCError) as error:
+            await client.call("div", {"a": 1, "b": 0})
+        assert error.value.code == 400
+        with pytest.raises(RPCError) as error:
+            await client.call("div", {"a": 1})
+        assert error.value.code == 500
+        assert error.value.type == "KeyError"
+
+        stats = service.stats()
+        assert stats["add"]["requests"] == 8
+        assert stats["add"]["avg_seconds"] >= 0.1
+        assert stats["div"]["errors"] == 2
+
+        await service.stop()
+        with pytest.raises(RPCTimeout):
+            await RPCClient(nats, "calc", timeout=0.1, retries=1).call("add", {})
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings({"load_utilities": {"nats": {"settings": {"metrics": True}}}})
+async def test_rpc_hedged_requests(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        service = Service("lookup")
+        seen = set()
+
+        @service.endpoint("get")
+        async def get(request):
+            # The first copy of every request gets stuck
+            if request not in seen:
+                seen.add(request)
+                await asyncio.sleep(1)
+                return "first"
+            return "hedged"
+
+        await service.start(nats)
+        await nats.nc.flush()
+
+        client = RPCClient(nats, "lookup", timeout=2, hedge_after=0.05)
+        start = time.monotonic()
+        results = await asyncio.gather(*[client.call("get", idx) for idx in range(5)])
+        assert results == ["hedged"] * 5
+        assert time.monotonic() - start < 1
+
+        # Client requests go through the utility and are measured
+        (request_time,) = nats.stats()["histograms"]["request"]
+        assert request_time["labels"] == {"family": "core"}
+        assert request_time["count"] >= 5
@@ -1,5 +1,6 @@
 from guillotina.component import get_utility
 from guillotina_nats.interfaces import INatsUtility
+from stan.aio.errors import StanError
 
 import asyncio
 import pytest
@@ -25,3 +26,232 @@ async def test_stream(stand, container_requester):
         await asyncio.sleep(1)
 
         assert variable[0] == "done"
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {
+                    "stan": "test-cluster",
+                    "compression": "zlib",
+                    "compression_threshold": 4,
+                }
+            }
+        }
+    }
+)
+async def test_stream_encoded(stand, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = []
+
+        async def callback(msg):
+            received.append(msg.value)
+
+        await nats.stream("testingencoded", {"items": ["a"] * 64}, serializer="json")
+        await nats.stream_subscribe(
+            callback, "testingencoded", serializer="json", start_at="first"
+        )
+
+        await asyncio.sleep(1)
+
+        assert received == [{"items": ["a"] * 64}]
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {"stan": "test-cluster", "stan_max_pub_acks_inflight": 8}
+            }
+        }
+    }
+)
+async def test_stan_publish_pipeline(stand, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = []
+
+        async def callback(msg):
+            received.append(msg.data)
+
+        await nats.stream_subscribe(callback, "testingpipeline", start_at="first")
+
+        futures = [
+            await nats.stream_publish("testingpipeline", str(idx).encode())
+            for idx in range(50)
+        ]
+        await nats.stream_publish_complete()
+        acks = [future.result() for future in futures]
+        assert all(not ack.error for ack in acks)
+        assert len({ack.guid for ack in acks}) == 50
+
+        stats = nats.stream_publish_stats()
+        assert stats["published"] == 50
+        assert stats["acked"] == 50
+        assert stats["inflight"] == 0
+
+        await asyncio.sleep(1)
+        assert received == [str(idx).encode() for idx in range(50)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {
+                    "stan": "test-cluster",
+                    "stan_max_pub_acks_inflight": 4,
+                    "stan_ack_wait": 0.2,
+                    "stan_publish_retries": 2,
+                }
+            }
+        }
+    }
+)
+async def test_stan_publish_dropped_acks(stand, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        # Lose the acks of the first sends, the publishes are retried
+        (ack_sub,) = [
+            sub for sub in nats.nc._subs.values() if sub.subject == nats.sc._ack_subject
+        ]
+        process_ack = ack_sub.coro
+        dropped = []
+
+        async def drop_ack(msg):
+            if len(dropped) < 8:
+                dropped.append(msg)
+            else:
+                await process_ack(msg)
+
+        ack_sub.coro = drop_ack
+
+        futures = [
+            await nats.stream_publish("testingdropped", str(idx).encode())
+            for idx in range(8)
+        ]
+        await asyncio.wait_for(nats.stream_publish_complete(), 5)
+        assert all(not future.result().error for future in futures)
+        assert len(dropped) == 8
+        stats = nats.stream_publish_stats()
+        assert stats["retried"] == 8
+        assert stats["acked"] == 8
+        assert stats["inflight"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {
+        "load_utilities": {
+            "nats": {
+                "settings": {
+                    "stan": "test-cluster",
+                    "stan_ping_interval": 1,
+                    "stan_timeout": 1,
+                }
+            }
+        }
+    }
+)
+async def test_stan_reconnect(stand, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        durable = []
+        received = []
+
+        async def durable_callback(msg):
+            durable.append(msg.data)
+
+        async def callback(msg):
+            received.append(msg.data)
+
+        await nats.stream_subscribe(
+            durable_callback, "testingreconnect", durable_name="durable"
+        )
+        await nats.stream_subscribe(callback, "testingreconnect")
+        await nats.stream("testingreconnect", b"before")
+
+        # What the client does after ping_max_out unanswered pings
+        await nats.sc._close_due_to_ping(StanError("stan: connection lost"))
+        assert nats.stats()["stan"]["connected"] is False
+
+        futures = [
+            await nats.stream_publish("testingreconnect", str(idx).encode())
+            for idx in range(10)
+        ]
+        assert nats.stream_publish_stats()["buffered"] == 10
+
+        # The server waits for the previous connection to be found dead
+        await nats._stan_session.wait_connected(30)
+        await asyncio.wait(futures, timeout=5)
+        assert all(not future.result().error for future in futures)
+
+        await asyncio.sleep(1)
+        expected = [b"before"] + [str(idx).encode() for idx in range(10)]
+        assert durable == expected
+        assert received == expected
+        stats = nats.stats()["stan"]
+        assert stats["disconnects"] == 1
+        assert stats["reconnects"] == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.app_settings(
+    {"load_utilities": {"nats": {"settings": {"stan": "test-cluster"}}}}
+)
+async def test_stan_consumer(stand, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        received = []
+        running = []
+        failed = set()
+
+        async def handler(msg):
+            running.append(1)
+            assert len(running) <= 4
+            await asyncio.sleep(0.1)
+            running.pop()
+            if msg.value["idx"] == 3 and 3 not in failed:
+                # Redelivered after ack_wait
+                failed.add(3)
+                raise ValueError("retry")
+            received.append((msg.value["key"], msg.value["idx"]))
+
+        consumer = await nats.stream_consumer(
+            handler,
+            "testingconsumer",
+            max_inflight=4,
+            ordered_by=lambda msg: msg.value["key"],
+            serializer="json",
+            start_at="first",
+            ack_wait=1,
+        )
+        for idx in range(12):
+            await nats.stream_publish(
+                "testingconsumer", {"key": idx % 2, "idx": idx}, serializer="json"
+            )
+        await nats.stream_publish_complete()
+
+        await asyncio.sleep(3)
+        assert sorted(idx for _, idx in received) == list(range(12))
+        evens = [idx for key, idx in received if key == 0]
+        assert evens == sorted(evens)
+
+        stats = consumer.stats()
+        assert stats["processed"] == 12
+        assert stats["failed"] == 1
+        assert stats["redelivered"] == 1
+        assert stats["max_lag_seconds"] > 0
+
+        await nats.stream_consumer_stop(consumer)
+        assert consumer.stats()["pending_acks"] == 0
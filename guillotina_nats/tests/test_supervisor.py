@@ -0,0 +1,83 @@
+from guillotina_nats.commands import process_settings
+from guillotina_nats.supervisor import Supervisor
+
+import json
+import os
+import signal
+import time
+
+
+def test_supervisor_restarts_and_aggregates(tmp_path):
+    marker = str(tmp_path / "crashed")
+
+    def worker(fd, slot):
+        os.write(fd, json.dumps({"processed": 5, "running": 1}).encode() + b"\n")
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            # Until the supervisor forwards SIGTERM
+            signal.pause()
+        else:
+            os._exit(1)
+
+    supervisor = Supervisor(worker, 2, interval=5)
+    previous = signal.signal(
+        signal.SIGALRM, lambda *args: os.kill(os.getpid(), signal.SIGTERM)
+    )
+    signal.setitimer(signal.ITIMER_REAL, 2)
+    try:
+        supervisor.run()
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    stats = supervisor.stats()
+    assert stats["workers"] == []
+    # The crashed process, the one started again and the other one
+    assert stats["processed"] == 15
+    assert sum(supervisor._restarts.values()) == 1
+
+
+def test_supervisor_terminates_then_kills(tmp_path):
+    marker = str(tmp_path / "hung")
+    terminated = str(tmp_path / "terminated")
+
+    def worker(fd, slot):
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            while True:
+                os.write(fd, json.dumps({"processed": 1}).encode() + b"\n")
+                time.sleep(0.05)
+        # Hung, stops reporting and ignores SIGTERM
+        signal.signal(
+            signal.SIGTERM, lambda *args: os.close(os.open(terminated, os.O_CREAT))
+        )
+        while True:
+            time.sleep(1)
+
+    supervisor = Supervisor(worker, 1, interval=0.2, stop_timeout=0.5)
+    previous = signal.signal(
+        signal.SIGALRM, lambda *args: os.kill(os.getpid(), signal.SIGTERM)
+    )
+    signal.setitimer(signal.ITIMER_REAL, 3)
+    try:
+        supervisor.run()
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    assert os.path.exists(terminated)
+    assert supervisor._restarts == {0: 1}
+    assert supervisor.stats()["processed"] == 1
+
+
+def test_process_settings_metrics_port():
+    settings = {"load_utilities": {"nats": {"settings": {"metrics_port": 9100}}}}
+    second = process_settings(settings, 1)
+    assert second["load_utilities"]["nats"]["settings"]["metrics_port"] == 9101
+    assert settings["load_utilities"]["nats"]["settings"]["metrics_port"] == 9100
+    settings = {"load_utilities": {"nats": {"settings": {}}}}
+    assert process_settings(settings, 1) is settings
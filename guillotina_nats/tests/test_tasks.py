@@ -0,0 +1,93 @@
+from guillotina.component import get_utility
+from guillotina_nats.interfaces import INatsUtility
+from guillotina_nats.models import Storage
+from guillotina_nats.tasks import TaskQueue
+from guillotina_nats.tasks import Worker
+
+import asyncio
+import json
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_task_queue(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        queue = TaskQueue(
+            "jobs", max_deliver=3, retry_backoff=0.05, storage=Storage.memory,
+        )
+        done = []
+        attempts = []
+
+        @queue.task()
+        async def add(a, b=0):
+            await asyncio.sleep(0.01)
+            done.append(a + b)
+
+        @queue.task("flaky")
+        async def flaky(name):
+            attempts.append(name)
+            if name == "broken" or len(attempts) < 2:
+                raise ValueError(name)
+            done.append(name)
+
+        for idx in range(10):
+            await queue.enqueue(add, idx, b=1)
+        await queue.enqueue("flaky", "retried")
+
+        worker = Worker(nats, [queue], concurrency=4, expires=0.5)
+        await worker.start()
+        await queue.enqueue("flaky", "broken")
+        for _ in range(50):
+            if worker.dead:
+                break
+            await asyncio.sleep(0.1)
+        await worker.stop()
+
+        assert sorted(value for value in done if isinstance(value, int)) == list(
+            range(1, 11)
+        )
+        assert "retried" in done
+        assert attempts.count("broken") == 3
+        assert worker.dead == 1
+        assert queue.stats()["add"]["requests"] == 10
+
+        dead = await nats.js_get_last_message("jobs_DLQ", "tasks.jobs_DLQ.flaky")
+        dead = json.loads(dead.data)
+        assert dead["request"] == {"args": ["broken"], "kwargs": {}}
+        assert dead["error"] == "ValueError: broken"
+        assert dead["delivered"] == 3
+
+        # Acked and dead lettered tasks are gone from the work queue
+        info = await nats.js_stream("jobs")
+        assert info["state"]["messages"] == 0
+
+
+@pytest.mark.asyncio
+async def test_worker_idle_queue(natsd, container_requester):
+    async with container_requester as requester:  # noqa
+        nats = get_utility(INatsUtility)
+
+        idle = TaskQueue("idle", storage=Storage.memory)
+        busy = TaskQueue("busy", storage=Storage.memory)
+        done = []
+
+        @busy.task()
+        async def work(idx):
+            await asyncio.sleep(0.05)
+            done.append(idx)
+
+        await idle.setup(nats)
+        for idx in range(8):
+            await busy.enqueue(work, idx)
+
+        # The idle queue pulls first and waits for expires seconds
+        worker = Worker(nats, [idle, busy], concurrency=4, expires=2)
+        await worker.start()
+        for _ in range(20):
+            if len(done) == 8:
+                break
+            await asyncio.sleep(0.05)
+        assert sorted(done) == list(range(8))
+        await worker.stop()
@@ -1,28 +1,133 @@
 # -*- coding: utf-8 -*-
+from collections import deque
+from datetime import datetime
+from datetime import timezone
 from functools import partial
+from guillotina_nats.acks import ACK
+from guillotina_nats.acks import AckBuffer
+from guillotina_nats.acks import NAK
+from guillotina_nats.acks import TERM
+from guillotina_nats.acks import WPI
+from guillotina_nats.buffer import PublishBuffer
+from guillotina_nats.codecs import config_payload
+from guillotina_nats.codecs import get_codec
+from guillotina_nats.compression import Compressor
+from guillotina_nats.events import DEFAULT_SUBJECT
+from guillotina_nats.events import EventBridge
+from guillotina_nats.exceptions import JetStreamError
+from guillotina_nats.metadata import MetadataCache
+from guillotina_nats.metrics import Metrics
+from guillotina_nats.metrics import PrometheusExporter
+from guillotina_nats.metrics import request_family
+from guillotina_nats.models import AckPolicy
 from guillotina_nats.models import ConsumerConfig
+from guillotina_nats.models import ConsumerInfo
+from guillotina_nats.models import DeliverPolicy
+from guillotina_nats.models import PubAck
+from guillotina_nats.models import Storage
+from guillotina_nats.models import StoredMessage
 from guillotina_nats.models import StreamConfig
+from guillotina_nats.models import StreamInfo
+from guillotina_nats.objects import ObjectStore
+from guillotina_nats.push import PushSubscription
+from guillotina_nats.serializers import SerializerRegistry
+from guillotina_nats.streaming import StanConsumer
+from guillotina_nats.streaming import StanPublisher
+from guillotina_nats.streaming import StanSession
+from guillotina_nats.subscription import BoundedSubscription
+from guillotina_nats.subscription import DEFAULT_PENDING_BYTES_LIMIT
+from guillotina_nats.subscription import DEFAULT_PENDING_MSGS_LIMIT
+from guillotina_nats.subscription import Overflow
+from itertools import count
 from nats.aio.client import Client as NATS
 from nats.aio.client import INBOX_PREFIX
+from nats.aio.client import Msg
 from nats.aio.errors import ErrConnectionClosed
 from nats.aio.errors import ErrConnectionReconnecting
 from nats.aio.errors import ErrNoServers
+from nats.aio.errors import ErrSlowConsumer
 from nats.aio.errors import ErrTimeout
-from stan.aio.client import Client as STAN
-from stan.aio.errors import StanError
+from typing import Any
+from typing import AsyncIterator
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
 
 import asyncio
-import base64
-import json
+import binascii
 import logging
 import os
+import time
 import uuid
+import zlib
 
 logger = logging.getLogger("guillotina_nats")
 
 
-async def wait_for_it(future: asyncio.Future, msg):
-    future.set_result(msg)
+def ack_consumer(reply: str):
+    """Extract (stream, consumer) from a JetStream $JS.ACK reply subject"""
+    tokens = reply.split(".")
+    if len(tokens) == 9:
+        # $JS.ACK.<stream>.<consumer>.<delivered>.<sseq>.<cseq>.<ts>.<pending>
+        return tokens[2], tokens[3]
+    elif len(tokens) >= 11:
+        # $JS.ACK.<domain>.<account>.<stream>.<consumer>.<delivered>...
+        return tokens[4], tokens[5]
+    return None
+
+
+def ack_metadata(reply: str):
+    """Stream and consumer sequences and timestamp of a delivered message"""
+    tokens = reply.split(".")
+    if len(tokens) >= 11:
+        tokens = tokens[:2] + tokens[4:]
+    return {
+        "stream": tokens[2],
+        "consumer": tokens[3],
+        "delivered": int(tokens[4]),
+        "stream_seq": int(tokens[5]),
+        "consumer_seq": int(tokens[6]),
+        "timestamp": datetime.fromtimestamp(int(tokens[7]) / 1e9, timezone.utc),
+        "pending": int(tokens[8]),
+    }
+
+
+def parse_headers(raw: bytes):
+    # NATS/1.0\r\nName: value\r\n...\r\n\r\n
+    headers = {}
+    for line in raw.decode().split("\r\n")[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip()] = value.strip()
+    return headers
+
+
+def config_differs(expected: dict, current: dict):
+    """Compare the set fields of a config with the server one, ignoring
+    the ones the server does not report back"""
+    for key, value in expected.items():
+        if value is not None and key in current and current[key] != value:
+            return True
+    return False
+
+
+class PullRequest(object):
+    """Messages collected for one $JS.API.CONSUMER.MSG.NEXT request"""
+
+    def __init__(self, batch: int):
+        self.batch = batch
+        self.messages: List[Msg] = []
+        self.done: asyncio.Future = asyncio.Future()
+
+    def add(self, msg):
+        self.messages.append(msg)
+        if len(self.messages) >= self.batch:
+            self.finish()
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(self.messages)
 
 
 # Configuration Utility
@@ -33,12 +138,39 @@ class NatsUtility(object):
         self._loop = loop
         self._hosts = settings["hosts"]
         self._timeout = float(settings["timeout"])
+        self._codec = get_codec(settings.get("json_codec", "auto"))
+        self._serializers = SerializerRegistry(self._codec)
+        self._compressor = None
+        if settings.get("compression", None):
+            self._compressor = Compressor(
+                settings["compression"],
+                threshold=int(settings.get("compression_threshold", 1024)),
+                level=settings.get("compression_level", None),
+            )
         self._subscriptions = []
+        self._bounded_subscriptions = {}
         self._stream_subscriptions = []
+        self._stream_consumers = []
         self._stan = settings.get("stan", None)
         self._stan_ping_interval = settings.get("stan_ping_interval", 5)
         self._stan_ping_max_out = settings.get("stan_ping_max_out", 3)
         self._stan_timeout = settings.get("stan_timeout", 2)
+        self._stan_max_pub_acks_inflight = int(
+            settings.get("stan_max_pub_acks_inflight", 1024)
+        )
+        self._stan_publisher = StanPublisher(
+            self,
+            max_inflight=self._stan_max_pub_acks_inflight,
+            ack_wait=float(settings.get("stan_ack_wait", 30)),
+            retries=int(settings.get("stan_publish_retries", 3)),
+            buffer_max_messages=int(
+                settings.get("stan_reconnect_buffer_max_messages", 8192)
+            ),
+            buffer_max_bytes=int(
+                settings.get("stan_reconnect_buffer_max_bytes", 8388608)
+            ),
+        )
+        self._stan_session = None
         self._name = settings.get("name", None)
         self._thread = settings.get("thread", False)
         self._uuid = os.environ.get("HOSTNAME", uuid.uuid4().hex)
@@ -46,10 +178,239 @@ class NatsUtility(object):
         self.lock = asyncio.Lock()
         self.sc = None
         self.nc = None
+        self.js_nc = None
+        self.connections = []
+        self._pool_size = int(settings.get("pool_size", 1))
+        # Connection used by each kind of operation: an index in the pool,
+        # "hash" of the subject or "round_robin" for publish and subscribe.
+        self._pool_routes = {"publish": 0, "subscribe": 0, "jetstream": 0}
+        self._pool_routes.update(settings.get("pool_routes", {}))
+        self._pool_next = count()
+        self._js_inbox_lock = asyncio.Lock()
+        self._js_inbox_prefix = None
+        self._inbox_lock = asyncio.Lock()
+        self._inbox_prefix = None
+        self._inbox_replies = {}
+        self._js_pulls = {}
+        self._js_pull_waiters = {}
+        self._js_replies = {}
+        # Tokens only need to be unique under the inbox prefix
+        self._js_tokens = count()
+        self._js_publish_window = asyncio.Semaphore(
+            int(settings.get("js_publish_max_inflight", 256))
+        )
+        self._js_pending_publishes = set()
+        self._push_subscriptions = []
+        self._js_cache = MetadataCache(
+            ttl=float(settings.get("js_cache_ttl", 0)),
+            max_size=int(settings.get("js_cache_size", 1024)),
+        )
+        self._js_cache_advisories = settings.get("js_cache_advisories", False)
+        self._publish_buffer = None
+        if settings.get("publish_buffer", False):
+            self._publish_buffer = PublishBuffer(
+                self,
+                max_bytes=int(settings.get("publish_buffer_max_bytes", 1048576)),
+                max_messages=int(settings.get("publish_buffer_max_messages", 1000)),
+            )
+        self._metrics = None
+        if settings.get("metrics", False):
+            self._metrics = Metrics()
+            if settings.get("metrics_prometheus", False):
+                self._metrics.hooks.append(
+                    PrometheusExporter(self, port=settings.get("metrics_port", None))
+                )
+        self._acks = AckBuffer(
+            self._publish_ack,
+            flush_interval=float(settings.get("ack_flush_interval", 0.05)),
+            flush_size=int(settings.get("ack_flush_size", 100)),
+        )
+        self._events = None
+        events = settings.get("events", None)
+        if events:
+            if events is True:
+                events = {}
+            self._events = EventBridge(
+                self,
+                subject=events.get("subject", DEFAULT_SUBJECT),
+                subjects=events.get("subjects", None),
+                jetstream=events.get("jetstream", False),
+                serializer=events.get("serializer", "json"),
+                max_pending=int(events.get("max_pending", 10000)),
+            )
+
+    def connection(self, role: str, subject: str = ""):
+        """Pooled connection for publish, subscribe or jetstream operations"""
+        route = self._pool_routes.get(role, 0)
+        if route == "hash":
+            index = zlib.crc32(subject.encode()) % len(self.connections)
+        elif route == "round_robin":
+            index = next(self._pool_next) % len(self.connections)
+        else:
+            index = int(route)
+        return self.connections[index]
 
-    async def subscribe(self, handler, key, group=""):
-        if self.nc.is_connected:
-            sid = await self.nc.subscribe(key, queue=group, cb=handler)
+    async def flush(self, timeout: float = 60):
+        """Wait until the server processed what was sent on every pool
+        connection, so messages published on one connection after it reach
+        the subscriptions made on the others"""
+        await asyncio.gather(
+            *[self._flush_connection(nc, timeout) for nc in self.connections]
+        )
+
+    async def _flush_connection(self, nc, timeout: float):
+        # The client writes the PING of flush() straight to the socket, ahead
+        # of the commands waiting for its flusher task, so the PONG can come
+        # back before a pending SUB is processed. The flusher runs before
+        # that PONG is read, a second PING goes out after those commands.
+        if nc.pending_data_size:
+            await nc.flush(timeout)
+        await nc.flush(timeout)
+
+    def _subscription_connection(self, sid):
+        # Subscription ids are per connection, the ones from other than the
+        # main connection are returned as (index, sid)
+        if isinstance(sid, tuple):
+            return self.connections[sid[0]], sid[1]
+        return self.nc, sid
+
+    def register_serializer(self, name, serializer):
+        """Serializer with dumps(obj) and loads(data) usable by name"""
+        self._serializers.register(name, serializer)
+
+    def compression_stats(self):
+        """Counters of the compression stage and its compression ratio"""
+        if self._compressor is None:
+            return None
+        return dict(self._compressor.stats, ratio=self._compressor.ratio)
+
+    def _encode(self, value, serializer):
+        if serializer is not None:
+            value = self._serializers.dumps(serializer, value)
+        if self._compressor is not None:
+            value = self._compressor.compress(value)
+        return value
+
+    def _message_handler(self, handler, serializer, key):
+        # Decompress first, then decode
+        if serializer is not None:
+            handler = self._serializers.wrap(handler, serializer)
+        if self._compressor is not None:
+            handler = self._compressor.wrap(handler)
+        if self._metrics is not None:
+            handler = self._timed_handler(handler, key)
+        return handler
+
+    def _timed_handler(self, handler, key):
+        metrics = self._metrics
+
+        async def callback(msg):
+            start = time.perf_counter()
+            try:
+                await handler(msg)
+            except Exception:
+                metrics.inc("callback_errors", subject=key)
+                raise
+            finally:
+                metrics.observe("callback", time.perf_counter() - start, subject=key)
+
+        return callback
+
+    def add_metrics_hook(self, hook):
+        """Call hook(kind, name, value, labels) on every recorded metric,
+        metrics must be enabled"""
+        if self._metrics is None:
+            raise ValueError("Metrics are not enabled")
+        self._metrics.hooks.append(hook)
+
+    def client_stats(self):
+        """Buffered bytes, queued messages and counters of the connections"""
+        stats = {
+            "pending_bytes": 0,
+            "subscription_pending_msgs": 0,
+            "subscription_pending_bytes": 0,
+            "reconnects": 0,
+            "connections": [],
+        }
+        for nc in self.connections:
+            stats["pending_bytes"] += nc._pending_data_size
+            stats["reconnects"] += nc.stats["reconnects"]
+            for sub in nc._subs.values():
+                if sub.pending_queue is not None:
+                    stats["subscription_pending_msgs"] += sub.pending_queue.qsize()
+                    stats["subscription_pending_bytes"] += sub.pending_size
+            stats["connections"].append(
+                dict(
+                    nc.stats,
+                    connected=nc.is_connected,
+                    server=nc.connected_url.netloc if nc.connected_url else None,
+                    subscriptions=len(nc._subs),
+                )
+            )
+        for bounded in self._bounded_subscriptions.values():
+            stats["subscription_pending_msgs"] += len(bounded)
+            stats["subscription_pending_bytes"] += bounded.pending_bytes
+        return stats
+
+    def stats(self):
+        """Client stats with the recorded metrics and compression stats"""
+        stats = {
+            "client": self.client_stats(),
+            "subscriptions": [
+                bounded.stats() for bounded in self._bounded_subscriptions.values()
+            ],
+        }
+        if self._metrics is not None:
+            stats.update(self._metrics.snapshot())
+        if self._compressor is not None:
+            stats["compression"] = self.compression_stats()
+        if self._events is not None:
+            stats["events"] = self._events.stats()
+        if self._stan_session is not None:
+            stats["stan"] = self._stan_session.stats()
+            stats["stan_publish"] = self.stream_publish_stats()
+            stats["stan_consumers"] = [
+                consumer.stats() for consumer in self._stream_consumers
+            ]
+        return stats
+
+    async def subscribe(
+        self,
+        handler,
+        key,
+        group="",
+        serializer=None,
+        pending_msgs_limit: Optional[int] = None,
+        pending_bytes_limit: Optional[int] = None,
+        overflow: Optional[Overflow] = None,
+        concurrency: Optional[int] = None,
+    ):
+        """Subscribe handler to key. With pending limits, an overflow policy
+        or concurrency the subscription is bounded, see BoundedSubscription"""
+        nc = self.connection("subscribe", key)
+        handler = self._message_handler(handler, serializer, key)
+        bounded = None
+        options = (pending_msgs_limit, pending_bytes_limit, overflow, concurrency)
+        if any(option is not None for option in options):
+            bounded = BoundedSubscription(
+                self,
+                key,
+                handler,
+                group=group,
+                pending_msgs_limit=pending_msgs_limit or DEFAULT_PENDING_MSGS_LIMIT,
+                pending_bytes_limit=pending_bytes_limit or DEFAULT_PENDING_BYTES_LIMIT,
+                overflow=overflow or Overflow.drop_newest,
+                concurrency=concurrency or 1,
+            )
+        if nc.is_connected:
+            if bounded is not None:
+                sid = await bounded.start(nc)
+            else:
+                sid = await nc.subscribe(key, queue=group, cb=handler)
+            if nc is not self.nc:
+                sid = (self.connections.index(nc), sid)
+            if bounded is not None:
+                self._bounded_subscriptions[sid] = bounded
             self._subscriptions.append(sid)
             logger.info("Subscribed to " + key)
             return sid
@@ -57,38 +418,95 @@ class NatsUtility(object):
             raise ErrConnectionClosed("Could not subscribe")
 
     async def unsubscribe(self, sid):
-        if self.nc.is_connected and sid is not None:
-            await self.nc.unsubscribe(sid)
+        if sid is None:
+            raise ErrConnectionClosed("Could not unsubscribe")
+        nc, nc_sid = self._subscription_connection(sid)
+        if nc.is_connected:
+            await nc.unsubscribe(nc_sid)
             self._subscriptions.remove(sid)
+            bounded = self._bounded_subscriptions.pop(sid, None)
+            if bounded is not None:
+                await bounded.stop()
         else:
             raise ErrConnectionClosed("Could not unsubscribe")
 
-    async def stream_subscribe(self, handler, key, **params):
-        if self.sc._conn_id:
-            sid = await self.sc.subscribe(key, cb=handler, **params)
-            self._stream_subscriptions.append(sid)
+    async def stream_subscribe(self, handler, key, serializer=None, **params):
+        """Subscription created again after a reconnection, while
+        reconnecting it is created once reconnected"""
+        handler = self._message_handler(handler, serializer, key)
+        if self._stan_session is not None:
+            sid = await self._stan_session.subscribe(key, handler, params)
             logger.info("Subscribed to " + key)
             return sid
         else:
             raise ErrConnectionClosed("Could not subscribe")
 
     async def stream_unsubscribe(self, sid):
-        if self.sc._conn_id:
+        if self._stan_session is not None:
             await sid.unsubscribe()
-            self._stream_subscriptions.remove(sid)
         else:
             raise ErrConnectionClosed("Could not unsubscribe")
 
-    async def publish(self, key, value):
-        if self.nc.is_connected:
-            await self.nc.publish(key, value)
+    async def stream_consumer(
+        self,
+        handler,
+        key,
+        max_inflight: int = 16,
+        ordered_by=None,
+        serializer=None,
+        ack_batch: Optional[int] = None,
+        ack_interval: float = 0.05,
+        **params,
+    ) -> StanConsumer:
+        """Subscribe with up to max_inflight handlers running at once and
+        batched acks, messages are acked when the handler returns. params
+        are the stream_subscribe ones, like durable_name or ack_wait"""
+        if self._stan_session is None:
+            raise ErrConnectionClosed("Could not subscribe")
+        consumer = StanConsumer(
+            self,
+            key,
+            handler,
+            max_inflight=max_inflight,
+            ordered_by=ordered_by,
+            serializer=serializer,
+            ack_batch=ack_batch,
+            ack_interval=ack_interval,
+        )
+        await consumer.start(self._stan_session, params)
+        self._stream_consumers.append(consumer)
+        logger.info("Subscribed to " + key)
+        return consumer
+
+    async def stream_consumer_stop(self, consumer: StanConsumer, close=False):
+        """Wait for the running handlers and their acks, close keeps the
+        position of a durable consumer"""
+        await consumer.stop(close=close)
+        self._stream_consumers.remove(consumer)
+
+    async def publish(self, key, value, serializer=None):
+        value = self._encode(value, serializer)
+        if self._metrics is not None:
+            self._metrics.inc("publish", kind="core")
+            self._metrics.inc("publish_bytes", len(value), kind="core")
+        if self._publish_buffer is not None:
+            await self._publish_buffer.add(key, value)
+            return
+        nc = self.connection("publish", key)
+        if nc.is_connected:
+            await nc.publish(key, value)
         else:
             raise ErrConnectionClosed("Could not publish")
 
+    async def publish_flush(self):
+        """Write buffered publishes right away"""
+        if self._publish_buffer is not None:
+            await self._publish_buffer.flush()
+
     # JETSTREAM
 
     def parse_response(self, message):
-        return json.loads(message.data)
+        return self._codec.loads(message.data)
 
     async def js_info(self):
         message = await self.request(f"$JS.API.INFO", b"")
@@ -97,39 +515,81 @@ class NatsUtility(object):
     # JETSTREAM STREAMS
 
     async def js_streams(self):
+        cached = self._js_cache.get(("streams",))
+        if cached is not None:
+            return cached
         message = await self.request(f"$JS.API.STREAM.LIST", b"")
-        return self.parse_response(message)
+        response = self.parse_response(message)
+        self._js_cache.set(("streams",), response)
+        return response
 
     async def js_stream(self, stream):
+        cached = self._js_cache.get(("stream", stream))
+        if cached is not None:
+            return cached
         message = await self.request(f"$JS.API.STREAM.INFO.{stream}", b"")
-        return self.parse_response(message)
+        response = self.parse_response(message)
+        self._js_cache.set(("stream", stream), response)
+        return response
 
     async def js_stream_create(self, streamconfig: StreamConfig):
         message = await self.request(
-            f"$JS.API.STREAM.CREATE.{streamconfig.name}", streamconfig.json().encode()
+            f"$JS.API.STREAM.CREATE.{streamconfig.name}",
+            self._codec.dumps(config_payload(streamconfig)),
         )
+        self._js_cache.invalidate_stream(streamconfig.name)
         return self.parse_response(message)
 
     async def js_stream_update(self, streamconfig: StreamConfig):
         message = await self.request(
-            f"$JS.API.STREAM.UPDATE.{streamconfig.name}", streamconfig.json().encode()
+            f"$JS.API.STREAM.UPDATE.{streamconfig.name}",
+            self._codec.dumps(config_payload(streamconfig)),
         )
+        self._js_cache.invalidate_stream(streamconfig.name)
         return self.parse_response(message)
 
     async def js_stream_delete(self, stream: str):
         message = await self.request(f"$JS.API.STREAM.DELETE.{stream}", b"")
+        self._js_cache.invalidate_stream(stream)
         return self.parse_response(message)
 
-    async def js_stream_purge(self, stream: str):
-        message = await self.request(f"$JS.API.STREAM.PURGE.{stream}", b"")
+    async def js_stream_purge(
+        self, stream: str, subject: Optional[str] = None, keep: Optional[int] = None
+    ):
+        """Purge the stream, only the messages of subject when given,
+        keeping the last keep ones"""
+        request: Dict[str, Any] = {}
+        if subject is not None:
+            request["filter"] = subject
+        if keep is not None:
+            request["keep"] = keep
+        message = await self.request(
+            f"$JS.API.STREAM.PURGE.{stream}",
+            self._codec.dumps(request) if request else b"",
+        )
+        self._js_cache.invalidate_stream(stream)
         return self.parse_response(message)
 
+    async def ensure_stream(self, streamconfig: StreamConfig):
+        """Create the stream or update it when its configuration differs,
+        without talking to the server when the cached info matches"""
+        info = await self.js_stream(streamconfig.name)
+        if "error" in info:
+            return await self.js_stream_create(streamconfig)
+        if config_differs(config_payload(streamconfig), info["config"]):
+            return await self.js_stream_update(streamconfig)
+        return info
+
     # JETSTREAM CONSUMER
 
     async def js_consumer_ephemeral_create(self, stream: str, consumer: ConsumerConfig):
         message = await self.request(
-            f"$JS.API.CONSUMER.CREATE.{stream}", consumer.json().encode()
+            f"$JS.API.CONSUMER.CREATE.{stream}",
+            self._codec.dumps(
+                {"stream_name": stream, "config": config_payload(consumer)}
+            ),
         )
+        self._js_cache.invalidate(("consumers", stream))
         return self.parse_response(message)
 
     async def js_consumer_durable_create(
@@ -137,97 +597,658 @@ class NatsUtility(object):
     ):
         message = await self.request(
             f"$JS.API.CONSUMER.DURABLE.CREATE.{stream}.{consumerconfig.durable_name}",
-            json.dumps(
-                {"stream_name": stream, "config": consumerconfig.dict()}
-            ).encode(),
+            self._codec.dumps(
+                {"stream_name": stream, "config": config_payload(consumerconfig)}
+            ),
         )
+        self._js_cache.invalidate_consumer(stream, consumerconfig.durable_name)
         return self.parse_response(message)
 
     async def js_consumer_list(self, stream: str):
+        cached = self._js_cache.get(("consumers", stream))
+        if cached is not None:
+            return cached
         message = await self.request(f"$JS.API.CONSUMER.LIST.{stream}", b"")
-        return self.parse_response(message)
+        response = self.parse_response(message)
+        self._js_cache.set(("consumers", stream), response)
+        return response
 
     async def js_consumer_delete(self, stream: str, consumer: str):
         message = await self.request(
             f"$JS.API.CONSUMER.DELETE.{stream}.{consumer}", b""
         )
+        self._js_cache.invalidate_consumer(stream, consumer)
         return self.parse_response(message)
 
     async def js_consumer_info(self, stream: str, consumer: str):
+        cached = self._js_cache.get(("consumer", stream, consumer))
+        if cached is not None:
+            return cached
         message = await self.request(f"$JS.API.CONSUMER.INFO.{stream}.{consumer}", b"")
-        return self.parse_response(message)
+        response = self.parse_response(message)
+        self._js_cache.set(("consumer", stream, consumer), response)
+        return response
+
+    async def ensure_consumer(self, stream: str, consumerconfig: ConsumerConfig):
+        """Create the durable consumer unless the cached or current one has
+        the same configuration"""
+        if consumerconfig.durable_name is None:
+            raise ValueError("ensure_consumer needs a durable_name")
+        info = await self.js_consumer_info(stream, consumerconfig.durable_name)
+        if "error" not in info and not config_differs(
+            config_payload(consumerconfig), info["config"]
+        ):
+            return info
+        return await self.js_consumer_durable_create(stream, consumerconfig)
+
+    # JETSTREAM LISTINGS
+
+    async def _js_list_page(self, subject: str, offset: int):
+        message = await self.request(subject, self._codec.dumps({"offset": offset}))
+        if message is None:
+            raise ErrTimeout
+        response = self.parse_response(message)
+        if "error" in response:
+            raise JetStreamError(
+                response["error"]["code"], response["error"]["description"]
+            )
+        return response
+
+    async def _js_list(self, subject: str, key: str, prefetch: bool = False):
+        """Walk a paginated listing, with prefetch the next page is requested
+        while the current one is consumed"""
+        offset = 0
+        page = asyncio.ensure_future(self._js_list_page(subject, offset))
+        try:
+            while True:
+                response = await page
+                items = response.get(key) or []
+                offset += len(items)
+                more = bool(items) and offset < response["total"]
+                if more and prefetch:
+                    page = asyncio.ensure_future(self._js_list_page(subject, offset))
+                for item in items:
+                    yield item
+                if not more:
+                    break
+                if not prefetch:
+                    page = asyncio.ensure_future(self._js_list_page(subject, offset))
+        finally:
+            if not page.done():
+                page.cancel()
+
+    async def js_streams_iter(
+        self, prefetch: bool = False
+    ) -> AsyncIterator[StreamInfo]:
+        async for item in self._js_list("$JS.API.STREAM.LIST", "streams", prefetch):
+            yield StreamInfo(**item)
+
+    async def js_consumers_iter(
+        self, stream: str, prefetch: bool = False
+    ) -> AsyncIterator[ConsumerInfo]:
+        async for item in self._js_list(
+            f"$JS.API.CONSUMER.LIST.{stream}", "consumers", prefetch
+        ):
+            yield ConsumerInfo(**item)
+
+    async def _js_advisory_cb(self, msg):
+        # $JS.EVENT.ADVISORY.STREAM.<action>.<stream>
+        # $JS.EVENT.ADVISORY.CONSUMER.<action>.<stream>.<consumer>
+        tokens = msg.subject.split(".")
+        if tokens[3] == "STREAM":
+            self._js_cache.invalidate_stream(tokens[5])
+        else:
+            self._js_cache.invalidate_consumer(tokens[5], tokens[6])
 
     async def js_get_message(self, stream: str, number: int):
         message = await self.request(
-            f"$JS.API.STREAM.MSG.GET.{stream}", json.dumps({"seq": number}).encode()
+            f"$JS.API.STREAM.MSG.GET.{stream}", self._codec.dumps({"seq": number})
         )
         if message:
             message = self.parse_response(message)
             if "error" not in message:
-                message = base64.b64decode(message["message"]["data"])
+                # Straight from the ASCII str, b64decode would encode it first
+                message = binascii.a2b_base64(message["message"]["data"])
+                if self._compressor is not None:
+                    message = self._compressor.decompress(message)
             elif message["error"]["code"] == 404:
                 return None
         return message
 
-    async def js_get_next(
-        self, stream: str, consumer: str, timeout: int = 5000000000, batch: int = 1
-    ):
-        next_inbox = INBOX_PREFIX[:]
-        next_inbox.extend(self.nc._nuid.next())
-        inbox = next_inbox.decode()
+    async def _js_inbox(self):
+        # Single wildcard subscription shared by all pull requests, replies are
+        # routed to the waiting request by token or by the ack subject.
+        if self._js_inbox_prefix is not None:
+            return self._js_inbox_prefix
+        async with self._js_inbox_lock:
+            if self._js_inbox_prefix is None:
+                prefix = INBOX_PREFIX[:]
+                prefix.extend(self.js_nc._nuid.next())
+                prefix.extend(b".")
+                await self.js_nc.subscribe(prefix.decode() + "*", cb=self._js_inbox_cb)
+                self._js_inbox_prefix = prefix.decode()
+        return self._js_inbox_prefix
 
-        future: asyncio.Future = asyncio.Future(loop=self._loop)
-        cb = partial(wait_for_it, future)
+    async def _js_inbox_cb(self, msg):
+        if msg.reply:
+            # Stored message, JetStream keeps the original subject so route
+            # it to the oldest pending request of its consumer.
+            waiters = self._js_pull_waiters.get(ack_consumer(msg.reply))
+            while waiters:
+                pull = self._js_pulls.get(waiters[0])
+                if pull is not None and not pull.done.done():
+                    if self._compressor is not None:
+                        self._compressor.decompress_msg(msg)
+                    pull.add(msg)
+                    if pull.done.done():
+                        waiters.popleft()
+                    return
+                waiters.popleft()
+            logger.debug("Dropped message without pending request " + msg.reply)
+        else:
+            token = msg.subject.rsplit(".", 1)[-1]
+            handler = self._js_replies.pop(token, None)
+            if handler is not None:
+                handler(msg)
+                return
+            # Status message (no messages, request expired), the request
+            # will not receive more messages.
+            pull = self._js_pulls.get(token)
+            if pull is not None:
+                pull.finish()
+
+    async def js_fetch(
+        self,
+        stream: str,
+        consumer: str,
+        batch: int = 1,
+        expires: int = 5000000000,
+        no_wait: bool = False,
+    ):
+        """Pull up to batch messages, returns early when the request expires
+        (nanoseconds) or, with no_wait, when no more messages are pending"""
+        inbox = await self._js_inbox()
+        token = str(next(self._js_tokens))
+        start = time.perf_counter()
 
-        sid = await self.nc.subscribe(inbox, cb=cb)
-        msg = None
+        pull = PullRequest(batch)
+        self._js_pulls[token] = pull
+        self._js_pull_waiters.setdefault((stream, consumer), deque()).append(token)
+        request = {"batch": batch}
+        if no_wait:
+            request["no_wait"] = True
+        else:
+            request["expires"] = expires
         try:
-            await self.nc.publish_request(
+            await self.js_nc.publish_request(
                 f"$JS.API.CONSUMER.MSG.NEXT.{stream}.{consumer}",
-                inbox,
-                json.dumps({"expires": timeout, "batch": batch}).encode(),
+                inbox + token,
+                self._codec.dumps(request),
             )
-            msg = await asyncio.wait_for(future, timeout / 1e9)
+            await asyncio.wait_for(pull.done, expires / 1e9 + self._timeout)
         except asyncio.TimeoutError:
+            pass
+        finally:
+            del self._js_pulls[token]
+            waiters = self._js_pull_waiters.get((stream, consumer))
+            if waiters is not None:
+                if token in waiters:
+                    waiters.remove(token)
+                if not waiters:
+                    del self._js_pull_waiters[(stream, consumer)]
+
+        if self._metrics is not None:
+            self._metrics.observe("fetch", time.perf_counter() - start)
+            self._metrics.inc("fetch_messages", len(pull.messages))
+        return pull.messages
+
+    async def _js_stored_message(self, stream: str, seq: int):
+        return await self._js_get_stored(stream, {"seq": seq})
+
+    async def js_get_last_message(
+        self, stream: str, subject: str
+    ) -> Optional[StoredMessage]:
+        """Last stored message of subject or None"""
+        return await self._js_get_stored(stream, {"last_by_subj": subject})
+
+    async def _js_get_stored(self, stream: str, request: dict):
+        message = await self.request(
+            f"$JS.API.STREAM.MSG.GET.{stream}", self._codec.dumps(request)
+        )
+        if message is None:
             raise ErrTimeout
+        response = self.parse_response(message)
+        if "error" in response:
+            if response["error"]["code"] == 404:
+                return None
+            raise JetStreamError(
+                response["error"]["code"], response["error"]["description"]
+            )
+        stored = response["message"]
+        headers = None
+        if stored.get("hdrs"):
+            headers = parse_headers(binascii.a2b_base64(stored["hdrs"]))
+        data = binascii.a2b_base64(stored.get("data", ""))
+        if self._compressor is not None:
+            data = self._compressor.decompress(data)
+        return StoredMessage(
+            subject=stored["subject"],
+            seq=stored["seq"],
+            data=data,
+            time=stored["time"],
+            headers=headers,
+        )
+
+    async def js_get_messages(
+        self,
+        stream: str,
+        start: int = 1,
+        end: Optional[int] = None,
+        subject: Optional[str] = None,
+        concurrency: int = 16,
+        batch: int = 256,
+    ) -> AsyncIterator[StoredMessage]:
+        """Stored messages from start to end (inclusive, last message by
+        default) in sequence order. Sequences are fetched with up to
+        concurrency requests in flight, when filtering by subject an
+        ephemeral consumer replays the stream instead, batch messages at
+        a time"""
+        if subject is not None:
+            async for stored in self._js_replay(stream, start, end, subject, batch):
+                yield stored
+            return
+        if end is None:
+            message = await self.request(f"$JS.API.STREAM.INFO.{stream}", b"")
+            if message is None:
+                raise ErrTimeout
+            response = self.parse_response(message)
+            if "error" in response:
+                raise JetStreamError(
+                    response["error"]["code"], response["error"]["description"]
+                )
+            end = response["state"]["last_seq"]
+        pending: Deque[asyncio.Future] = deque()
+        seq = start
+        try:
+            while pending or seq <= end:
+                while seq <= end and len(pending) < concurrency:
+                    pending.append(
+                        asyncio.ensure_future(self._js_stored_message(stream, seq))
+                    )
+                    seq += 1
+                stored = await pending.popleft()
+                if stored is not None:
+                    yield stored
         finally:
-            await self.nc.unsubscribe(sid)
+            for future in pending:
+                future.cancel()
 
-        return msg
+    async def _js_replay(
+        self, stream: str, start: int, end: Optional[int], subject: str, batch=256
+    ):
+        config = ConsumerConfig(
+            filter_subject=subject,
+            deliver_policy=DeliverPolicy.by_start_sequence,
+            opt_start_seq=start,
+            ack_policy=AckPolicy.none,
+        )
+        response = await self.js_consumer_ephemeral_create(stream, config)
+        if "error" in response:
+            raise JetStreamError(
+                response["error"]["code"], response["error"]["description"]
+            )
+        consumer = response["name"]
+        try:
+            while True:
+                messages = await self.js_fetch(stream, consumer, batch, no_wait=True)
+                for msg in messages:
+                    metadata = ack_metadata(msg.reply)
+                    if end is not None and metadata["stream_seq"] > end:
+                        return
+                    yield StoredMessage(
+                        subject=msg.subject,
+                        seq=metadata["stream_seq"],
+                        data=msg.data,
+                        time=metadata["timestamp"],
+                    )
+                if len(messages) < batch:
+                    return
+        finally:
+            await self.js_consumer_delete(stream, consumer)
+
+    async def js_get_next(
+        self,
+        stream: str,
+        consumer: str,
+        timeout: int = 5000000000,
+        batch: int = 1,
+        serializer=None,
+    ):
+        if batch != 1:
+            logger.warning("js_get_next returns one message, use js_fetch for batches")
+        messages = await self.js_fetch(stream, consumer, batch=1, expires=timeout)
+        if not messages:
+            if self._metrics is not None:
+                self._metrics.inc("fetch_timeouts")
+            raise ErrTimeout
+        if serializer is not None:
+            return self._serializers.loads(serializer, messages[0])
+        return messages[0]
 
     async def js_consumer_ack(self, reply: str):
         return await self.request(reply, b"")
 
+    async def js_push_subscribe(
+        self,
+        stream: str,
+        consumerconfig: ConsumerConfig,
+        handler,
+        concurrency: int = 1,
+        auto_ack: bool = True,
+        serializer=None,
+        stop_timeout: float = 30,
+    ):
+        """Create a push consumer and dispatch its messages to handler with
+        up to concurrency messages processed at once. With auto_ack messages
+        are acked when the handler returns and nacked when it raises.
+        Unsubscribing waits up to stop_timeout seconds for the handlers"""
+        config = consumerconfig.copy()
+        if config.deliver_subject is None:
+            config.deliver_subject = self.new_inbox()
+        sub = PushSubscription(
+            self,
+            stream,
+            config.deliver_subject,
+            self._message_handler(handler, serializer, stream),
+            concurrency=concurrency,
+            auto_ack=auto_ack,
+            idle_heartbeat=config.idle_heartbeat,
+            stop_timeout=stop_timeout,
+        )
+        # Subscribe first so no message is delivered before we listen
+        await sub.start()
+        if config.durable_name is not None:
+            res = await self.js_consumer_durable_create(stream, config)
+        else:
+            res = await self.js_consumer_ephemeral_create(stream, config)
+        if "error" in res:
+            await sub.stop()
+            raise JetStreamError(res["error"]["code"], res["error"]["description"])
+        sub.consumer = res["name"]
+        self._push_subscriptions.append(sub)
+        logger.info("Subscribed to " + config.deliver_subject)
+        return sub
+
+    async def js_push_unsubscribe(self, sub: PushSubscription):
+        await sub.stop()
+        self._push_subscriptions.remove(sub)
+
+    # JETSTREAM PUBLISH
+
+    def _js_puback(self, future: asyncio.Future, msg):
+        if future.done():
+            return
+        response = self.parse_response(msg)
+        if "error" in response:
+            future.set_exception(
+                JetStreamError(
+                    response["error"]["code"], response["error"]["description"]
+                )
+            )
+        else:
+            future.set_result(PubAck(**response))
+
+    def _js_reply_timeout(self, token: str, future: asyncio.Future):
+        self._js_replies.pop(token, None)
+        if not future.done():
+            future.set_exception(ErrTimeout())
+
+    async def js_publish_async(
+        self, subject: str, payload, timeout=None, serializer=None
+    ):
+        """Publish to a stream without waiting for the ack, returns a future
+        resolved with the PubAck. Waits only while js_publish_max_inflight
+        publishes are unacknowledged"""
+        payload = self._encode(payload, serializer)
+        if self._metrics is not None:
+            self._metrics.inc("publish", kind="jetstream")
+            self._metrics.inc("publish_bytes", len(payload), kind="jetstream")
+        if timeout is None:
+            timeout = self._timeout
+        await self._js_publish_window.acquire()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        try:
+            inbox = await self._js_inbox()
+        except Exception:
+            self._js_publish_window.release()
+            raise
+        token = str(next(self._js_tokens))
+        self._js_replies[token] = partial(self._js_puback, future)
+        timer = loop.call_later(timeout, self._js_reply_timeout, token, future)
+
+        def done(future):
+            timer.cancel()
+            self._js_pending_publishes.discard(future)
+            self._js_publish_window.release()
+
+        future.add_done_callback(done)
+        self._js_pending_publishes.add(future)
+        try:
+            if not self.js_nc.is_connected:
+                raise ErrConnectionClosed("Could not publish")
+            await self.js_nc.publish_request(subject, inbox + token, payload)
+        except Exception:
+            self._js_replies.pop(token, None)
+            future.cancel()
+            raise
+        return future
+
+    async def js_publish(
+        self, subject: str, payload, timeout=None, serializer=None
+    ) -> PubAck:
+        future = await self.js_publish_async(
+            subject, payload, timeout=timeout, serializer=serializer
+        )
+        return await future
+
+    async def js_publish_complete(self):
+        """Wait until every pending js_publish_async is acknowledged"""
+        if self._js_pending_publishes:
+            await asyncio.wait(list(self._js_pending_publishes))
+
+    # JETSTREAM ACKS, msg can be a message or its reply subject
+
+    async def _publish_ack(self, reply: str, payload: bytes):
+        # Raw, the server takes any payload it does not know for +ACK, and
+        # not counted as a core publish
+        if self.js_nc.is_connected:
+            await self.js_nc.publish(reply, payload)
+        else:
+            raise ErrConnectionClosed("Could not publish")
+
+    async def js_ack(self, msg, sync: bool = False):
+        reply = getattr(msg, "reply", msg)
+        if sync:
+            # Wait for the server to confirm the ack was processed
+            return await self.js_nc.request(reply, ACK, self._timeout)
+        await self._acks.add(reply, ACK)
+
+    async def js_ack_all(self, messages):
+        """Cumulative ack for AckPolicy.all consumers, only the last
+        message of the processed batch needs to be acknowledged"""
+        if messages:
+            await self.js_ack(messages[-1])
+
+    async def js_nak(self, msg, delay: Optional[int] = None):
+        payload = NAK
+        if delay is not None:
+            payload += b" " + self._codec.dumps({"delay": delay})
+        await self._acks.add(getattr(msg, "reply", msg), payload)
+
+    async def js_in_progress(self, msg):
+        # Reset the ack_wait timer right away, it can't wait for the flush
+        await self._publish_ack(getattr(msg, "reply", msg), WPI)
+
+    async def js_term(self, msg):
+        await self._acks.add(getattr(msg, "reply", msg), TERM)
+
+    async def js_ack_flush(self):
+        await self._acks.flush()
+
+    async def object_store(
+        self,
+        bucket: str,
+        chunk_size: int = 131072,
+        read_ahead: int = 4,
+        storage: Storage = Storage.file,
+    ) -> ObjectStore:
+        """Store of objects bigger than the max payload as chunks in the
+        OBJ_<bucket> stream, created when missing"""
+        if chunk_size > self.js_nc.max_payload:
+            raise ValueError(f"Chunks bigger than {self.js_nc.max_payload} bytes")
+        config = StreamConfig(
+            name=f"OBJ_{bucket}",
+            subjects=[f"$O.{bucket}.C.>", f"$O.{bucket}.M.>"],
+            storage=storage,
+            max_age=0,
+        )
+        res = await self.ensure_stream(config)
+        if "error" in res:
+            raise JetStreamError(res["error"]["code"], res["error"]["description"])
+        return ObjectStore(self, bucket, chunk_size=chunk_size, read_ahead=read_ahead)
+
+    def new_inbox(self):
+        next_inbox = INBOX_PREFIX[:]
+        next_inbox.extend(self.js_nc._nuid.next())
+        return next_inbox.decode()
+
     # STAN
 
-    async def stream_publish(self, key, value):
-        async def cb(ack):
-            pass
+    async def stream_publish(self, key, value, serializer=None) -> asyncio.Future:
+        """Publish without waiting for the ack, returns a future resolved
+        with the PubAck. Waits only while stan_max_pub_acks_inflight
+        publishes are unacknowledged, retries when the ack times out. While
+        reconnecting the message is buffered"""
+        if self._stan_session is None:
+            raise ErrConnectionClosed("Could not publish")
+        value = self._encode(value, serializer)
+        if self._metrics is not None:
+            self._metrics.inc("publish", kind="stan")
+            self._metrics.inc("publish_bytes", len(value), kind="stan")
+        if not isinstance(value, bytes):
+            # Protocol buffers only take bytes
+            value = bytes(value)
+        return await self._stan_publisher.publish(key, value)
+
+    async def stream_publish_complete(self):
+        """Wait for the acks of every pending stream_publish"""
+        await self._stan_publisher.complete()
 
-        await self.sc.publish(key, value, ack_handler=cb, ack_wait=60)
-        # try:
-        #     await self.sc.publish(key, value, ack_handler=cb, ack_wait=60)
-        # except AttributeError:
-        #     await self.sc.connect(self._stan, self._uuid, nats=self.nc)
-        #     await asyncio.sleep(2)
-        #     await self.sc.publish(key, value, ack_handler=cb, ack_wait=60)
+    def stream_publish_stats(self):
+        return self._stan_publisher.stats()
 
     async def request(self, key, value, timeout=None):
         if timeout is None:
             timeout = self._timeout
-        if self.nc.is_connected:
+        # Buffered publishes go first, a request must not overtake them
+        await self.publish_flush()
+        if key.startswith("$JS."):
+            nc = self.js_nc
+        else:
+            nc = self.connection("publish", key)
+        if nc.is_connected:
+            if self._metrics is not None:
+                return await self._timed_request(nc, key, value, timeout)
             try:
-                return await self.nc.request(key, value, timeout)
+                return await nc.request(key, value, timeout)
             except ErrTimeout:
                 return
         else:
             raise ErrConnectionClosed("Could not subscribe")
 
-    async def stream(self, channel_name, data):
-        if self.sc._conn_id:
-            await self.sc.publish(channel_name, data)
-        else:
-            raise ErrConnectionClosed("Could not publish")
+    async def _inbox(self):
+        # Single wildcard subscription for the replies of request_many
+        if self._inbox_prefix is not None:
+            return self._inbox_prefix
+        async with self._inbox_lock:
+            if self._inbox_prefix is None:
+                nc = self.connection("publish")
+                prefix = INBOX_PREFIX[:]
+                prefix.extend(nc._nuid.next())
+                prefix.extend(b".")
+                await nc.subscribe(prefix.decode() + "*", cb=self._inbox_cb)
+                self._inbox_prefix = prefix.decode()
+        return self._inbox_prefix
+
+    async def _inbox_cb(self, msg):
+        queue = self._inbox_replies.get(msg.subject.rsplit(".", 1)[-1])
+        if queue is not None:
+            queue.put_nowait(msg)
+
+    async def request_many(
+        self,
+        key: str,
+        value,
+        max_replies: Optional[int] = None,
+        timeout: Optional[float] = None,
+        stall_timeout: Optional[float] = None,
+        serializer=None,
+    ) -> AsyncIterator:
+        """Publish one request and yield the replies as they arrive until
+        max_replies are received, timeout seconds pass or no other reply
+        arrives stall_timeout seconds after the previous one. The serializer
+        encodes the request and decodes the replies"""
+        if timeout is None:
+            timeout = self._timeout
+        inbox = await self._inbox()
+        token = str(next(self._js_tokens))
+        queue: asyncio.Queue = asyncio.Queue()
+        self._inbox_replies[token] = queue
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        received = 0
+        try:
+            nc = self.connection("publish", key)
+            if not nc.is_connected:
+                raise ErrConnectionClosed("Could not publish")
+            await self.publish_flush()
+            await nc.publish_request(
+                key, inbox + token, self._encode(value, serializer)
+            )
+            while max_replies is None or received < max_replies:
+                wait = deadline - loop.time()
+                if received and stall_timeout is not None:
+                    wait = min(wait, stall_timeout)
+                if wait <= 0:
+                    break
+                try:
+                    msg = await asyncio.wait_for(queue.get(), wait)
+                except asyncio.TimeoutError:
+                    break
+                received += 1
+                if self._compressor is not None:
+                    self._compressor.decompress_msg(msg)
+                if serializer is not None:
+                    msg = self._serializers.loads(serializer, msg)
+                yield msg
+        finally:
+            del self._inbox_replies[token]
+
+    async def _timed_request(self, nc, key, value, timeout):
+        family = request_family(key)
+        start = time.perf_counter()
+        try:
+            return await nc.request(key, value, timeout)
+        except ErrTimeout:
+            self._metrics.inc("request_timeouts", family=family)
+            return
+        finally:
+            self._metrics.observe("request", time.perf_counter() - start, family=family)
+
+    async def stream(self, channel_name, data, serializer=None):
+        """Publish and wait for the ack, encoded as stream_publish does"""
+        await (await self.stream_publish(channel_name, data, serializer=serializer))
 
     async def initialized(self):
         if self._initialized:
@@ -239,78 +1260,143 @@ class NatsUtility(object):
     async def initialize(self, app=None):
         # No asyncio loop to run
         async with self.lock:
-            self.nc = NATS()
-            options = {
-                "servers": self._hosts,
-                "loop": self._loop,
-                "disconnected_cb": self.disconnected_cb,
-                "reconnected_cb": self.reconnected_cb,
-                "error_cb": self.error_cb,
-                "closed_cb": self.closed_cb,
-                "name": self._name,
-                "verbose": True,
-            }
+            self.connections = []
+            for index in range(self._pool_size):
+                nc = NATS()
+                name = self._name
+                if index > 0 and name is not None:
+                    name = f"{name}-{index}"
+                options = {
+                    "servers": self._hosts,
+                    "loop": self._loop,
+                    "disconnected_cb": self.disconnected_cb,
+                    "reconnected_cb": self._reconnected_cb(nc),
+                    "error_cb": self.error_cb,
+                    "closed_cb": self.closed_cb,
+                    "name": name,
+                    "verbose": True,
+                }
 
-            try:
-                await self.nc.connect(**options)
-            except ErrNoServers:
-                logger.exception("No servers found")
-                raise
+                try:
+                    await nc.connect(**options)
+                except ErrNoServers:
+                    logger.exception("No servers found")
+                    raise
+                self.connections.append(nc)
+
+            self.nc = self.connections[0]
+            self.js_nc = self.connections[int(self._pool_routes["jetstream"])]
+            self._js_inbox_prefix = None
+            self._inbox_prefix = None
+            self._js_cache.clear()
 
             logger.info("Connected to nats")
 
+            if self._js_cache.enabled and self._js_cache_advisories:
+                await self.subscribe(
+                    self._js_advisory_cb, "$JS.EVENT.ADVISORY.STREAM.*.*"
+                )
+                await self.subscribe(
+                    self._js_advisory_cb, "$JS.EVENT.ADVISORY.CONSUMER.*.*.*"
+                )
+
             if self._stan is not None:
-                self.sc = STAN()
-                await self.sc.connect(
+                self._stan_session = StanSession(
+                    self,
                     self._stan,
                     self._uuid,
-                    nats=self.nc,
                     ping_interval=self._stan_ping_interval,
                     ping_max_out=self._stan_ping_max_out,
-                    connect_timeout=self._stan_timeout,
+                    timeout=self._stan_timeout,
+                    max_pub_acks_inflight=self._stan_max_pub_acks_inflight,
                 )
+                await self._stan_session.connect()
                 logger.info("Connected to stan")
         self._initialized = True
 
     async def finalize(self, app):
-        if self.sc:
-            for sid in self._stream_subscriptions:
-                await sid.unsubscribe()
+        if self._stan_session is not None:
             try:
-                await self.sc.close()
-            except ErrTimeout:
-                pass
-            except StanError:
-                pass
+                await asyncio.wait_for(
+                    self._stan_publisher.complete(), self._stan_timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning("Closing with unacknowledged stream publishes")
+                self._stan_publisher.fail(ErrConnectionClosed("Could not publish"))
+            for consumer in list(self._stream_consumers):
+                await self.stream_consumer_stop(consumer)
+            for sid in list(self._stream_subscriptions):
+                await sid.unsubscribe()
+            await self._stan_session.close()
         if self.nc:
+            if self._events is not None:
+                await self._events.close()
+            for sub in self._push_subscriptions:
+                try:
+                    await sub.stop()
+                except ErrConnectionClosed:
+                    pass
             try:
-                await self.nc.flush()
-            except RuntimeError:
-                pass
-            except AttributeError:
-                pass
-            for key in self._subscriptions:
-                await self.nc.unsubscribe(key)
-            try:
-                await self.nc.drain()
-            except AttributeError:
-                pass
-            except ErrConnectionReconnecting:
-                pass
-            try:
-                await self.nc.close()
-            except RuntimeError:
-                pass
+                await self.publish_flush()
+                await self._acks.close()
+            except ErrConnectionClosed:
+                logger.warning("Could not flush pending acks")
+            for sid in self._subscriptions:
+                nc, nc_sid = self._subscription_connection(sid)
+                await nc.unsubscribe(nc_sid)
+            for bounded in self._bounded_subscriptions.values():
+                await bounded.stop()
+            self._bounded_subscriptions = {}
+            for nc in self.connections:
+                await self._close_connection(nc)
+
+    async def _close_connection(self, nc):
+        try:
+            await nc.flush()
+        except RuntimeError:
+            pass
+        except AttributeError:
+            pass
+        try:
+            await nc.drain()
+        except AttributeError:
+            pass
+        except ErrConnectionReconnecting:
+            pass
+        try:
+            await nc.close()
+        except RuntimeError:
+            pass
 
     async def disconnected_cb(self):
         logger.info("Got disconnected!")
+        if self._metrics is not None:
+            self._metrics.inc("disconnects")
+
+    def _reconnected_cb(self, nc):
+        # Bound to its connection, functools.partial is not taken as a
+        # coroutine function by the client on python 3.7
+        async def callback():
+            await self.reconnected_cb(nc)
 
-    async def reconnected_cb(self):
+        return callback
+
+    async def reconnected_cb(self, nc):
         # See who we are connected to on reconnect.
-        logger.info("Got reconnected to {url}".format(url=self.nc.connected_url.netloc))
+        logger.info("Got reconnected to {url}".format(url=nc.connected_url.netloc))
+        if self._metrics is not None:
+            self._metrics.inc("reconnects")
+        await self.publish_flush()
 
     async def error_cb(self, e):
-        logger.info("There was an error: {}".format(e))
+        if isinstance(e, ErrSlowConsumer):
+            logger.warning(f"Slow consumer on {e.subject}, messages dropped")
+            if self._metrics is not None:
+                self._metrics.inc("slow_consumers")
+        else:
+            logger.info("There was an error: {}".format(e))
+        if self._metrics is not None:
+            self._metrics.inc("errors")
 
     async def closed_cb(self):
         logger.info("Connection is closed")
@@ -37,5 +37,13 @@ setup(
     include_package_data=True,
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={
+        'orjson': ['orjson'],
+        'msgspec': ['msgspec'],
+        'msgpack': ['msgpack'],
+        'lz4': ['lz4'],
+        'zstd': ['zstandard'],
+        'prometheus': ['prometheus-client'],
+    },
     tests_require=test_requirements
 )